@@ -0,0 +1,325 @@
+# asyncio 的串口会话
+# 用法：
+#   async with open_session('/dev/ttyUSB0', 9600) as session:
+#       await session.write(b'\x01\x03\x00\x00\x00\x01\x84\x0a')
+#       frame = await session.read_frame(timeout=1.0)
+#
+# POSIX上直接把串口的文件描述符加到事件循环里边（add_reader/add_writer），
+# 不需要每个串口一个线程；没有文件描述符的（比如 loop://）就在一个任务里边轮询。
+# 接收缓冲区太大的时候暂停读取，发送缓冲区太大的时候 write() 会等待，这样有背压。
+
+import asyncio
+import os
+import time
+
+import serial
+
+from serial_session import resolve_parameters, silent_interval
+
+# 接收缓冲区超过这个大小就暂停读取，直到读取者取走一部分
+DEFAULT_READ_LIMIT = 1024 * 1024
+# 发送缓冲区超过这个大小 write() 就等待
+DEFAULT_WRITE_HIGH = 64 * 1024
+DEFAULT_WRITE_LOW = 16 * 1024
+# 轮询没有文件描述符的串口的间隔，秒
+POLL_INTERVAL = 0.001
+READ_SIZE = 64 * 1024
+
+
+class AsyncSerialSession:
+    '''asyncio 的串口会话，用 open_session() 创建'''
+    def __init__(self, serial_port, frame_gap, read_limit=DEFAULT_READ_LIMIT,
+                 write_high=DEFAULT_WRITE_HIGH, write_low=DEFAULT_WRITE_LOW) -> None:
+        self.serial = serial_port
+        self.frame_gap = frame_gap # read_frame() 默认的帧间隔，秒
+        self.read_limit = read_limit
+        self.write_high = write_high
+        self.write_low = write_low
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.last_recv_time = None # time.perf_counter()
+        self.error = None
+        self._loop = None
+        self._fd = None
+        self._buf = bytearray()
+        self._wbuf = bytearray()
+        self._read_waiter = None
+        self._drain_waiter = None
+        self._reading = False
+        self._writing = False
+        self._poll_task = None
+        self._closed = False
+
+    # 打开和关闭
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._fd = self.serial.fileno()
+        except (AttributeError, OSError, ValueError):
+            self._fd = None
+        if self._fd is not None:
+            os.set_blocking(self._fd, False)
+            self._resume_reading()
+        else:
+            self._poll_task = self._loop.create_task(self._poll())
+
+    async def aclose(self):
+        if self._closed:
+            return
+        try:
+            await self.drain()
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        # 立即关闭，没有发送完的数据丢弃
+        if self._closed:
+            return
+        self._closed = True
+        if self._fd is not None:
+            self._pause_reading()
+            if self._writing:
+                self._loop.remove_writer(self._fd)
+                self._writing = False
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        self.serial.close()
+        self._set_error(ConnectionError('串口已经关闭'), keep=True)
+
+    # 接收
+    def _resume_reading(self):
+        if not self._reading and self._fd is not None and not self._closed:
+            self._loop.add_reader(self._fd, self._on_readable)
+            self._reading = True
+
+    def _pause_reading(self):
+        if self._reading:
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            self._pause_reading()
+            self._set_error(err)
+            return
+        if not data:
+            self._pause_reading()
+            self._set_error(serial.SerialException('设备已经断开'))
+            return
+        self._feed(data)
+
+    async def _poll(self):
+        ser = self.serial
+        while True:
+            try:
+                if len(self._buf) < self.read_limit:
+                    waiting = ser.in_waiting
+                    if waiting:
+                        self._feed(ser.read(min(waiting, READ_SIZE)))
+            except Exception as err:
+                self._set_error(err)
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def _feed(self, data):
+        self.last_recv_time = time.perf_counter()
+        self.bytes_read += len(data)
+        self._buf += data
+        if len(self._buf) >= self.read_limit:
+            self._pause_reading()
+        self._wake_reader()
+
+    def _wake_reader(self):
+        waiter = self._read_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _set_error(self, err, keep=False):
+        if self.error is None or not keep:
+            self.error = err
+        self._wake_reader()
+        waiter = self._drain_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(self.error)
+
+    def _take(self, n):
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        if len(self._buf) < self.read_limit:
+            self._resume_reading()
+        return data
+
+    async def _wait_for_data(self, timeout=None):
+        # 等待新的数据，超时返回 False。取消的时候直接抛出 CancelledError
+        if self.error is not None:
+            raise self.error
+        waiter = self._loop.create_future()
+        self._read_waiter = waiter
+        try:
+            if timeout is None:
+                await waiter
+            else:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout)
+                except asyncio.TimeoutError:
+                    return False
+        finally:
+            self._read_waiter = None
+        if self.error is not None and not self._buf:
+            raise self.error
+        return True
+
+    async def _wait_deadline(self, deadline):
+        # 等待新的数据，到了 deadline 还没有就抛出 TimeoutError
+        if deadline is None:
+            await self._wait_for_data()
+            return
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0 or not await self._wait_for_data(remaining):
+            raise asyncio.TimeoutError()
+
+    async def read(self, n=-1):
+        '''至少等到一个字节，最多返回n个字节（-1表示全部）'''
+        while not self._buf:
+            await self._wait_for_data()
+        return self._take(len(self._buf) if n < 0 else n)
+
+    async def read_exactly(self, n, timeout=None):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while len(self._buf) < n:
+            await self._wait_deadline(deadline)
+        return self._take(n)
+
+    async def read_until(self, separator=b'\n', timeout=None):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            pos = self._buf.find(separator)
+            if pos >= 0:
+                return self._take(pos + len(separator))
+            await self._wait_deadline(deadline)
+
+    async def read_frame(self, timeout=None, gap=None):
+        '''读取一帧：收到数据以后，空闲超过 gap 秒就认为一帧结束。timeout 是等待第一个字节的时间'''
+        if gap is None:
+            gap = self.frame_gap
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self._buf:
+            await self._wait_deadline(deadline)
+        while True:
+            idle = time.perf_counter() - self.last_recv_time
+            if idle >= gap:
+                return self._take(len(self._buf))
+            await self._wait_for_data(gap - idle)
+
+    def reset_input_buffer(self):
+        self._buf.clear()
+        self._resume_reading()
+
+    # 发送
+    async def write(self, data):
+        '''发送数据，发送缓冲区满了的时候等待'''
+        if self.error is not None:
+            raise self.error
+        self.bytes_written += len(data)
+        if self._fd is None:
+            self.serial.write(data)
+            return
+        self._wbuf += data
+        self._flush()
+        if len(self._wbuf) > self.write_high:
+            await self._wait_drain(self.write_low)
+
+    async def drain(self):
+        '''等到发送缓冲区里边的数据全部写到串口'''
+        if self._fd is None:
+            return
+        await self._wait_drain(0)
+
+    async def _wait_drain(self, low):
+        while len(self._wbuf) > low:
+            if self.error is not None:
+                raise self.error
+            self._drain_waiter = self._loop.create_future()
+            try:
+                await self._drain_waiter
+            finally:
+                self._drain_waiter = None
+
+    def _flush(self):
+        try:
+            n = os.write(self._fd, self._wbuf)
+        except BlockingIOError:
+            n = 0
+        except OSError as err:
+            self._set_error(err)
+            return
+        del self._wbuf[:n]
+        if self._wbuf and not self._writing:
+            self._loop.add_writer(self._fd, self._on_writable)
+            self._writing = True
+        elif not self._wbuf and self._writing:
+            self._loop.remove_writer(self._fd)
+            self._writing = False
+        waiter = self._drain_waiter
+        if waiter is not None and not waiter.done() and len(self._wbuf) <= self.write_low:
+            waiter.set_result(None)
+
+    def _on_writable(self):
+        self._flush()
+
+    async def transact(self, request, timeout=1.0):
+        '''发送一帧，等待一帧回复'''
+        self.reset_input_buffer()
+        await self.write(request)
+        return await self.read_frame(timeout=timeout)
+
+
+def open_session(port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+                 stopbits=serial.STOPBITS_ONE, frame_gap=None, **kwargs):
+    '''打开串口，返回 AsyncSerialSession，用 async with 使用。
+    bytesize、parity、stopbits 可以用 dict_bytesize、dict_parity、dict_stopbits 的键'''
+    bytesize, parity, stopbits = resolve_parameters(bytesize, parity, stopbits)
+    serial_port = serial.serial_for_url(port, baudrate=baudrate, bytesize=bytesize, parity=parity,
+                                        stopbits=stopbits, timeout=0, **kwargs)
+    if frame_gap is None:
+        frame_gap = silent_interval(baudrate, bytesize, parity, stopbits)
+    return AsyncSerialSession(serial_port, frame_gap)
+
+
+async def _benchmark(url='loop://', count=2000):
+    # 用 loop:// 测试每秒能完成多少次请求/应答
+    async with open_session(url, 115200, '8', '无校验', '1', frame_gap=0.002) as session:
+        request = b'\x01\x03\x00\x00\x00\x01\x84\x0a'
+        start = time.perf_counter()
+        for _ in range(count):
+            reply = await session.transact(request)
+            assert reply == request
+        elapsed = time.perf_counter() - start
+    print('{}: {} 次请求/应答，{:.0f} 次/秒'.format(url, count, count / elapsed))
+    # 取消正在等待的读取
+    async with open_session(url, 115200) as session:
+        task = asyncio.ensure_future(session.read_frame())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await session.write(b'abc')
+        assert await session.read_frame(timeout=1.0) == b'abc'
+
+
+if __name__ == '__main__':
+    asyncio.run(_benchmark())
@@ -0,0 +1,282 @@
+# 收发路径的基准测试，不需要界面，可以在没有显示器的测试机上跑
+# 发送端按照波特率的速度（一个字节按 10 位算）一块一块地写，接收端走和界面一样的路径：
+#   SerialSession 的接收线程 → read_with_breaks() → recv_path.ReceivePath（空闲时间分帧、按照显示模式解码）
+#   → RenderPipeline → RecvLog，
+#   每次刷新以后再格式化最后一屏的行（界面只画看得见的行）。
+# 传输用 pyserial 的 loop://（发送走 SerialSession.write()）和 Linux 的 pty（从另一头 os.write()），
+# 这两种都不会按照波特率限速，所以发送端自己控制速度；波特率写 0 表示不限速，测最大的吞吐。
+# 每个组合测量：
+#   收到的字节/秒；每 MB 的 CPU 时间（整个进程，包括发送和接收线程）；
+#   端到端的延迟（每块数据写之前的时间到界面路径处理完这块数据的最后一个字节，不包括等刷新的时间）；
+#   丢失的字节（发送的减去收到的）和内容不对的字节。
+# 结果写成 json；加上 --compare 和上一次的结果比较，吞吐下降或者 CPU 上升超过阈值的时候返回 1。
+# 用法：
+#   python benchmark.py --output bench.json
+#   python benchmark.py --transports loop --bauds 9600 115200 0 --modes hex text --seconds 2 --compare bench.json
+
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+from codec import MODES, MODE_HEX, encode
+from recv_log import RecvLog
+from recv_path import ReceivePath
+from recv_render import RenderPipeline
+from serial_session import SerialSession, lst_baudrate
+from stats import Histogram
+
+TRANSPORTS = ('loop', 'pty')
+# 接收区的显示模式，dump 是十六进制转储
+DISPLAY_DUMP = 'dump'
+DISPLAY_MODES = MODES + (DISPLAY_DUMP,)
+# lst_baudrate 以外再测几个高速的，0 表示不限速
+EXTRA_BAUDS = [230400, 460800, 921600, 0]
+# 和界面的默认设置一样
+FRAMING = 'idle:0.2'
+BATCH_SIZE = 64 * 1024
+SCREEN_LINES = 40
+# 每块数据大概多少秒的量，不限速的时候每块的字节数
+CHUNK_TIME = 0.01
+UNPACED_CHUNK = 4096
+# 比较的时候算作变差的阈值
+RATE_DROP = 0.10
+CPU_RISE = 0.20
+
+
+def payload(mode, size=4096) -> bytes:
+    '''每种显示模式用的数据：十六进制是所有的字节值，文本是一行一行的 ascii，双字节是文本的十六进制'''
+    if mode in (MODE_HEX, DISPLAY_DUMP):
+        block = bytes(range(256))
+    else:
+        text = ''.join('{:06d} the quick brown fox jumps over the lazy dog\r\n'.format(i) for i in range(64))
+        block = encode(text, mode)
+    return (block * (size // len(block) + 1))[:size]
+
+
+class Receiver:
+    '''和界面的 serial_recv() 一样取数据，交给和界面一样的 ReceivePath，只是不画出来'''
+    def __init__(self, session, mode) -> None:
+        self.session = session
+        self.log = RecvLog()
+        self.render = RenderPipeline(self.log)
+        self.path = ReceivePath(self.render, FRAMING, MODE_HEX if mode == DISPLAY_DUMP else mode,
+                                hex_dump=mode == DISPLAY_DUMP)
+        session.reader.idle_gap = self.path.framer.gap
+        self.received = bytearray()
+
+    @property
+    def frames(self):
+        return self.path.frames
+
+    def poll(self, timeout=0.05):
+        '''取一批数据处理掉，返回取到的字节数'''
+        session = self.session
+        if not session.wait(timeout):
+            self.maybe_flush()
+            return 0
+        data, breaks = session.read_with_breaks(BATCH_SIZE)
+        self.received += data
+        self.path.feed(data, breaks)
+        self.maybe_flush()
+        return len(data)
+
+    def maybe_flush(self, force=False):
+        if (force or self.render.delay() == 0) and self.render.flush():
+            n = len(self.log)
+            for row in range(max(0, n - SCREEN_LINES), n):
+                self.log.line_text(row)
+
+    def finish(self):
+        self.path.flush()
+        self.maybe_flush(force=True)
+
+
+def run_case(transport, baudrate, mode, seconds=1.0) -> dict:
+    '''测一个组合，返回结果'''
+    rate = baudrate / 10 # 字节/秒
+    chunk_size = max(1, int(rate * CHUNK_TIME)) if rate else UNPACED_CHUNK
+    data = payload(mode, max(chunk_size, 4096))
+    master = slave = None
+    if transport == 'loop':
+        session = SerialSession('loop://', baudrate=baudrate or 115200)
+        write = session.write
+    else:
+        master, slave = os.openpty()
+        session = SerialSession(os.ttyname(slave), baudrate=baudrate or 115200)
+
+        def write(chunk):
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(master, view):]
+    path = Receiver(session, mode)
+    sent = bytearray()
+    marks = [] # (发送以后一共多少字节, 写之前的时间)
+    stop = threading.Event()
+    errors = []
+
+    def sender():
+        offset = 0
+        due = time.perf_counter()
+        try:
+            while not stop.is_set():
+                if rate:
+                    due += chunk_size / rate
+                    wait = due - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                elif len(sent) - len(path.received) > 1024 * 1024:
+                    # 不限速的时候也不能比接收快太多，不然 loop:// 的缓冲区满了会卡住
+                    time.sleep(0.001)
+                    continue
+                start = offset % len(data)
+                chunk = data[start:start + chunk_size]
+                if len(chunk) < chunk_size:
+                    chunk += data[:chunk_size - len(chunk)]
+                offset += len(chunk)
+                now = time.perf_counter()
+                write(chunk)
+                sent.extend(chunk)
+                marks.append((len(sent), now))
+        except OSError as err:
+            errors.append(err)
+
+    latency = Histogram(max_value=10.0)
+    mark_index = 0
+    thread = threading.Thread(target=sender, name='BenchmarkSender', daemon=True)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    thread.start()
+    try:
+        deadline = start + seconds
+        while True:
+            now = time.perf_counter()
+            if now >= deadline and not stop.is_set():
+                stop.set()
+                thread.join()
+                drain_deadline = time.perf_counter() + 1.0
+            if stop.is_set() and (len(path.received) >= len(sent) or time.perf_counter() > drain_deadline):
+                break
+            if path.poll():
+                # 这一批处理完的时间，就是里边每一块数据最后一个字节的延迟
+                done = time.perf_counter()
+                total = len(path.received)
+                while mark_index < len(marks) and marks[mark_index][0] <= total:
+                    latency.record(done - marks[mark_index][1])
+                    mark_index += 1
+        path.finish()
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+    finally:
+        stop.set()
+        session.close()
+        for fd in (master, slave):
+            if fd is not None:
+                os.close(fd)
+    received = bytes(path.received)
+    expected = bytes(sent[:len(received)])
+    corrupt = 0 if received == expected else sum(a != b for a, b in zip(received, expected))
+    mb = len(received) / 1e6
+    return {
+        'transport': transport,
+        'baudrate': baudrate,
+        'mode': mode,
+        'seconds': elapsed,
+        'bytes_sent': len(sent),
+        'bytes_received': len(received),
+        'bytes_per_s': len(received) / elapsed if elapsed else 0.0,
+        'target_bytes_per_s': rate,
+        'cpu_s': cpu,
+        'cpu_s_per_mb': cpu / mb if mb else None,
+        'latency_p50_ms': latency.percentile(50) * 1000,
+        'latency_p99_ms': latency.percentile(99) * 1000,
+        'latency_max_ms': (latency.max or 0.0) * 1000,
+        'lost_bytes': len(sent) - len(received),
+        'corrupt_bytes': corrupt,
+        'frames': path.frames,
+        'lines': len(path.log),
+        'summarized_bytes': path.render.summarized_bytes,
+        'error': str(errors[0]) if errors else None,
+    }
+
+
+def case_key(result):
+    return (result['transport'], result['baudrate'], result['mode'])
+
+
+def compare(results, baseline) -> list:
+    '''和以前的结果比较，返回变差的说明'''
+    old = {case_key(i): i for i in baseline}
+    problems = []
+    for result in results:
+        before = old.get(case_key(result))
+        if before is None:
+            continue
+        name = '{} {} {}'.format(*case_key(result))
+        if result['bytes_per_s'] < before['bytes_per_s'] * (1 - RATE_DROP):
+            problems.append('{}：吞吐 {:.0f} → {:.0f} 字节/秒'.format(name, before['bytes_per_s'], result['bytes_per_s']))
+        if before['cpu_s_per_mb'] and result['cpu_s_per_mb'] and \
+                result['cpu_s_per_mb'] > before['cpu_s_per_mb'] * (1 + CPU_RISE):
+            problems.append('{}：CPU {:.3f} → {:.3f} 秒/MB'.format(name, before['cpu_s_per_mb'], result['cpu_s_per_mb']))
+        if result['lost_bytes'] > before['lost_bytes'] or result['corrupt_bytes'] > before['corrupt_bytes']:
+            problems.append('{}：丢失 {} 字节，内容不对 {} 字节'.format(name, result['lost_bytes'], result['corrupt_bytes']))
+    return problems
+
+
+def format_result(r) -> str:
+    cpu = '-' if r['cpu_s_per_mb'] is None else '{:.3f}'.format(r['cpu_s_per_mb'])
+    return '{:<5} {:>7} {:<10} {:>12.0f} {:>9} {:>9.2f} {:>9.2f} {:>9.2f} {:>7} {:>7}'.format(
+        r['transport'], r['baudrate'] or '不限速', r['mode'], r['bytes_per_s'], cpu,
+        r['latency_p50_ms'], r['latency_p99_ms'], r['latency_max_ms'], r['lost_bytes'], r['corrupt_bytes'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='收发路径的基准测试')
+    parser.add_argument('--transports', nargs='+', choices=TRANSPORTS,
+                        default=list(TRANSPORTS) if hasattr(os, 'openpty') else ['loop'], help='传输，默认 loop 和 pty')
+    parser.add_argument('--bauds', nargs='+', type=int, default=[int(i) for i in lst_baudrate] + EXTRA_BAUDS,
+                        help='波特率，0 表示不限速，默认 lst_baudrate 加上 {}'.format(EXTRA_BAUDS))
+    parser.add_argument('--modes', nargs='+', choices=DISPLAY_MODES, default=list(DISPLAY_MODES), help='接收区的显示模式')
+    parser.add_argument('--seconds', type=float, default=1.0, help='每个组合发送的秒数')
+    parser.add_argument('--output', help='结果保存到这个 json 文件')
+    parser.add_argument('--compare', help='和这个 json 文件里边以前的结果比较')
+    args = parser.parse_args(argv)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print('{:<5} {:>7} {:<10} {:>12} {:>9} {:>9} {:>9} {:>9} {:>7} {:>7}'.format(
+        '传输', '波特率', '模式', '字节/秒', 'CPU秒/MB', 'p50(ms)', 'p99(ms)', '最大(ms)', '丢失', '错误'))
+    results = []
+    for transport in args.transports:
+        for baudrate in args.bauds:
+            for mode in args.modes:
+                result = run_case(transport, baudrate, mode, args.seconds)
+                results.append(result)
+                print(format_result(result))
+                if result['error']:
+                    print('  错误：{}'.format(result['error']))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'seconds': args.seconds,
+                'results': results,
+            }, f, ensure_ascii=False, indent=1)
+    failed = any(r['lost_bytes'] or r['corrupt_bytes'] or r['error'] for r in results)
+    if baseline is not None:
+        problems = compare(results, baseline)
+        for line in problems:
+            print('变差了：' + line)
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
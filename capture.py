@@ -0,0 +1,432 @@
+# 收发数据的录制
+# 每一段收发的数据都带着单调时钟的时间戳和方向写到二进制的录制文件里边。
+# 写文件在后台线程里边做，write() 只是放到队列里边，所以慢的硬盘也不会影响接收。
+# 支持按照大小或者时间分割文件，支持gzip或者zstd压缩（zstd需要安装 zstandard）。
+#
+# 文件格式，全部是小端：
+#   文件头：magic(6字节) 版本(u16) 墙上时间ns(i64) 对应的单调时间ns(i64)
+#   每条记录：单调时间ns(u64) 方向(u8) 长度(u32) 数据
+#
+# 没有压缩的录制文件旁边还有一个稀疏的索引文件（文件名加上 .idx），
+# 每隔 INDEX_INTERVAL 条记录保存一项：记录序号(u64) 时间ns(u64) 文件偏移(u64)。
+# CaptureReader 用 mmap 打开录制文件，用索引二分查找，只读取需要的那几条记录，
+# 所以再大的文件也可以很快地打开和跳转。
+
+import bisect
+import gzip
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'CHCAP\x00'
+VERSION = 1
+HEADER = struct.Struct('<6sHqq')
+RECORD = struct.Struct('<QBI')
+
+INDEX_MAGIC = b'CHIDX\x00'
+INDEX_HEADER = struct.Struct('<6sHI')
+INDEX_ENTRY = struct.Struct('<QQQ')
+INDEX_INTERVAL = 1024 # 每隔多少条记录保存一项索引
+INDEX_SUFFIX = '.idx'
+
+DIR_RECV = 0 # 接收
+DIR_SEND = 1 # 发送
+
+# 队列里边最多积压的字节数，超过了就丢弃并计数，不能阻塞接收。
+DEFAULT_MAX_PENDING = 64 * 1024 * 1024
+# 写文件用的缓冲区大小
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+COMPRESSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def compression_from_path(path):
+    # 根据文件的扩展名判断压缩方式
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def open_capture_file(path, mode='rb', compression=None):
+    '''打开录制文件，根据 compression 选择压缩方式'''
+    if compression is None:
+        return open(path, mode, buffering=WRITE_BUFFER_SIZE)
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=6)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd压缩需要安装 zstandard')
+        raw = open(path, mode)
+        if 'w' in mode:
+            return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    raise ValueError('不支持的压缩方式：{}'.format(compression))
+
+
+class CaptureWriter:
+    '''录制收发的数据，write() 可以在任何线程里边调用，不会阻塞'''
+    def __init__(self, path, rotate_bytes=None, rotate_seconds=None, compression=None,
+                 max_pending=DEFAULT_MAX_PENDING) -> None:
+        if compression not in COMPRESSIONS:
+            raise ValueError('不支持的压缩方式：{}'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd压缩需要安装 zstandard')
+        self.path = path
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compression = compression
+        self.max_pending = max_pending
+        self.files = [] # 已经写过的文件
+        self.error = None
+        # 统计信息
+        self.records = 0
+        self.bytes_written = 0 # 写到文件里边的数据字节数（不算记录头）
+        self.dropped = 0       # 因为积压太多丢弃的字节数
+        self._queue = deque()
+        self._lock = threading.Lock() # 接收线程和界面线程都会调用 write()
+        self._queued = 0  # 放到队列里边的总字节数
+        self._written = 0 # 从队列里边取出来写掉的总字节数
+        self._event = threading.Event()
+        self._stop = False
+        self._file = None
+        self._segment = 0
+        self._segment_bytes = 0
+        self._segment_start = 0.0
+        self._index = None # 当前文件的索引，压缩的文件没有索引
+        self._segment_records = 0
+        self._segment_offset = 0 # 下一条记录在文件里边的偏移
+        self._thread = threading.Thread(target=self._run, name='CaptureWriter', daemon=True)
+        self._open_segment()
+        self._thread.start()
+
+    def _segment_path(self):
+        # 不分割的时候就用原来的文件名，分割的时候加上序号
+        path = self.path
+        suffix = COMPRESSIONS[self.compression]
+        if suffix and path.endswith(suffix):
+            path = path[:-len(suffix)]
+        if self.rotate_bytes or self.rotate_seconds:
+            stem, ext = os.path.splitext(path)
+            path = '{}-{:04d}{}'.format(stem, self._segment, ext)
+        return path + suffix
+
+    def _open_segment(self):
+        path = self._segment_path()
+        f = open_capture_file(path, 'wb', self.compression)
+        f.write(HEADER.pack(MAGIC, VERSION, time.time_ns(), time.perf_counter_ns()))
+        self._file = f
+        if self.compression is None:
+            self._index = open(path + INDEX_SUFFIX, 'wb')
+            self._index.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, INDEX_INTERVAL))
+        self._segment_records = 0
+        self._segment_offset = HEADER.size
+        self.files.append(path)
+        self._segment += 1
+        self._segment_bytes = 0
+        self._segment_start = time.monotonic()
+
+    def _need_rotate(self):
+        if self.rotate_bytes and self._segment_bytes >= self.rotate_bytes:
+            return True
+        if self.rotate_seconds and time.monotonic() - self._segment_start >= self.rotate_seconds:
+            return True
+        return False
+
+    def write(self, data, direction=DIR_RECV, timestamp_ns=None):
+        if self._stop or not data:
+            return
+        if timestamp_ns is None:
+            timestamp_ns = time.perf_counter_ns()
+        size = len(data)
+        with self._lock:
+            if self._queued - self._written + size > self.max_pending:
+                self.dropped += size
+                return
+            self._queue.append((timestamp_ns, direction, bytes(data)))
+            self._queued += size
+        self._event.set()
+
+    def _run(self):
+        queue = self._queue
+        pack = RECORD.pack
+        while True:
+            self._event.wait(0.5)
+            self._event.clear()
+            try:
+                while queue:
+                    # 一次把队列里边的都写完，凑成一个大的写操作
+                    parts = []
+                    entries = []
+                    size = 0
+                    while queue and size < WRITE_BUFFER_SIZE:
+                        timestamp_ns, direction, data = queue.popleft()
+                        if self._segment_records % INDEX_INTERVAL == 0:
+                            entries.append(INDEX_ENTRY.pack(self._segment_records, timestamp_ns, self._segment_offset))
+                        parts.append(pack(timestamp_ns, direction, len(data)))
+                        parts.append(data)
+                        size += len(data)
+                        self._segment_records += 1
+                        self._segment_offset += RECORD.size + len(data)
+                        self.records += 1
+                    self._file.write(b''.join(parts))
+                    if self._index is not None and entries:
+                        self._index.write(b''.join(entries))
+                    self._written += size
+                    self.bytes_written += size
+                    self._segment_bytes += size
+                    if self._need_rotate():
+                        self._close_segment()
+                        self._open_segment()
+                if self._need_rotate() and self._segment_bytes:
+                    self._close_segment()
+                    self._open_segment()
+            except Exception as err:
+                # 写不下去了，后边的数据都丢弃
+                self.error = err
+                self._stop = True
+                break
+            if self._stop and not queue:
+                break
+        try:
+            self._close_segment()
+        except Exception as err:
+            self.error = self.error or err
+
+    def _close_segment(self):
+        # 先关闭录制文件再关闭索引，索引不会指向没有写到文件里边的数据
+        self._file.close()
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def close(self, timeout=5.0):
+        # 把队列里边的写完再关闭
+        self._stop = True
+        self._event.set()
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            'records': self.records,
+            'bytes_written': self.bytes_written,
+            'pending': self._queued - self._written,
+            'dropped': self.dropped,
+            'files': len(self.files),
+        }
+
+
+def iter_capture(path, compression=None):
+    '''依次读出录制文件里边的记录，返回 (单调时间ns, 方向, 数据)'''
+    if compression is None:
+        compression = compression_from_path(path)
+    with open_capture_file(path, 'rb', compression) as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise ValueError('不是录制文件：{}'.format(path))
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break
+            timestamp_ns, direction, size = RECORD.unpack(head)
+            data = f.read(size)
+            if len(data) < size:
+                break # 最后一条没有写完整
+            yield timestamp_ns, direction, data
+
+
+def _scan_records(buf, offset, record_no, entries, end=None):
+    # 从 offset 开始顺序扫描记录，把需要的索引项加到 entries 里边，返回 (记录数, 结束的偏移)
+    unpack_from = RECORD.unpack_from
+    head_size = RECORD.size
+    if end is None:
+        end = len(buf)
+    while offset + head_size <= end:
+        timestamp_ns, _, size = unpack_from(buf, offset)
+        if offset + head_size + size > end:
+            break # 最后一条没有写完整
+        if record_no % INDEX_INTERVAL == 0:
+            entries.append((record_no, timestamp_ns, offset))
+        offset += head_size + size
+        record_no += 1
+    return record_no, offset
+
+
+def build_index(path):
+    '''扫描整个录制文件，重新生成索引文件'''
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        entries = []
+        _scan_records(mm, HEADER.size, 0, entries)
+    with open(path + INDEX_SUFFIX, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, INDEX_INTERVAL))
+        f.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+    return entries
+
+
+class CaptureReader:
+    '''用mmap打开没有压缩的录制文件，按照序号或者时间随机访问记录'''
+    def __init__(self, path) -> None:
+        if compression_from_path(path) is not None:
+            raise ValueError('压缩的录制文件不能随机访问，请先解压：{}'.format(path))
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < HEADER.size:
+            self._file.close()
+            raise ValueError('不是录制文件：{}'.format(path))
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, self.wall_ns, self.mono_ns = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('不是录制文件：{}'.format(path))
+        self._load_index()
+        self._cursor = (0, HEADER.size) # 上一次访问的记录，顺序访问的时候从这里接着找
+
+    def _load_index(self):
+        entries = None
+        try:
+            with open(self.path + INDEX_SUFFIX, 'rb') as f:
+                raw = f.read()
+            magic, _, interval = INDEX_HEADER.unpack_from(raw, 0)
+            if magic == INDEX_MAGIC and interval == INDEX_INTERVAL:
+                body = raw[INDEX_HEADER.size:]
+                body = body[:len(body) - len(body) % INDEX_ENTRY.size]
+                flat = array('Q', body)
+                if sys.byteorder != 'little':
+                    flat.byteswap()
+                entries = flat
+        except (OSError, struct.error):
+            entries = None
+        if entries is None:
+            # 没有索引（或者是别的程序生成的文件），扫描一遍并且保存下来
+            try:
+                built = build_index(self.path)
+            except OSError:
+                built = []
+                _scan_records(self._mm, HEADER.size, 0, built)
+            entries = array('Q', [value for entry in built for value in entry])
+        self._records = entries[0::3]
+        self._times = entries[1::3]
+        self._offsets = entries[2::3]
+        # 索引最后一项之后的记录（可能还在录制中）扫描一下，最多 INDEX_INTERVAL 条
+        if len(self._records):
+            record_no, offset = self._records[-1], self._offsets[-1]
+        else:
+            record_no, offset = 0, HEADER.size
+        extra = []
+        self._count, _ = _scan_records(self._mm, offset, record_no, extra)
+        for entry in extra:
+            if not len(self._records) or entry[0] > self._records[-1]:
+                self._records.append(entry[0])
+                self._times.append(entry[1])
+                self._offsets.append(entry[2])
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _offset_of(self, i):
+        # 找到第i条记录的偏移：先用索引跳到前面最近的一项，再往后走
+        if i < 0 or i >= self._count:
+            raise IndexError(i)
+        k = bisect.bisect_right(self._records, i) - 1
+        record_no, offset = self._records[k], self._offsets[k]
+        cursor_no, cursor_offset = self._cursor
+        if record_no <= cursor_no <= i:
+            record_no, offset = cursor_no, cursor_offset
+        unpack_from = RECORD.unpack_from
+        while record_no < i:
+            _, _, size = unpack_from(self._mm, offset)
+            offset += RECORD.size + size
+            record_no += 1
+        self._cursor = (i, offset)
+        return offset
+
+    def record(self, i):
+        '''第i条记录，返回 (单调时间ns, 方向, 数据)'''
+        offset = self._offset_of(i)
+        timestamp_ns, direction, size = RECORD.unpack_from(self._mm, offset)
+        start = offset + RECORD.size
+        return timestamp_ns, direction, self._mm[start:start + size]
+
+    def wall_time(self, timestamp_ns):
+        # 单调时间转换成墙上时间，秒
+        return (self.wall_ns + timestamp_ns - self.mono_ns) / 1e9
+
+    def find_time(self, timestamp_ns):
+        '''第一条时间不早于 timestamp_ns 的记录的序号'''
+        k = bisect.bisect_left(self._times, timestamp_ns) - 1
+        if k < 0:
+            return 0
+        i = self._records[k]
+        while i < self._count and self.record(i)[0] < timestamp_ns:
+            i += 1
+        return i
+
+    def find_wall_time(self, seconds):
+        return self.find_time(int(seconds * 1e9) - self.wall_ns + self.mono_ns)
+
+
+if __name__ == '__main__':
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    for compression in (None, 'gzip') + (('zstd',) if zstandard else ()):
+        path = os.path.join(tmp, 'test.chcap' + COMPRESSIONS[compression])
+        writer = CaptureWriter(path, rotate_bytes=1 << 20, compression=compression)
+        chunk = bytes(range(256)) * 16
+        t = time.perf_counter()
+        for i in range(1000):
+            writer.write(chunk, DIR_RECV if i % 2 else DIR_SEND)
+        t_write = time.perf_counter() - t
+        writer.close()
+        total = sum(len(data) for f in writer.files for _, _, data in iter_capture(f))
+        assert total == 1000 * len(chunk) and writer.dropped == 0, writer.stats()
+        print('{}: write() 1000次 {:.1f} ms, {} 个文件'.format(compression, t_write * 1e3, len(writer.files)))
+        if compression is None:
+            with CaptureReader(writer.files[-1]) as reader:
+                n = len(reader)
+                first = reader.record(0)[0]
+                assert reader.find_time(first) == 0
+                assert reader.find_time(reader.record(n // 2)[0]) <= n // 2
+    # 打开大文件的速度
+    path = os.path.join(tmp, 'big.chcap')
+    writer = CaptureWriter(path)
+    chunk = bytes(range(64))
+    for i in range(1000000):
+        writer.write(chunk)
+    writer.close()
+    t = time.perf_counter()
+    with CaptureReader(path) as reader:
+        n = len(reader)
+        i = reader.find_time(reader.record(n * 3 // 4)[0])
+        assert bytes(reader.record(i)[2]) == chunk
+    print('打开 {} 条记录的文件并跳转: {:.1f} ms'.format(n, (time.perf_counter() - t) * 1e3))
+    os.remove(path + INDEX_SUFFIX)
+    t = time.perf_counter()
+    with CaptureReader(path) as reader:
+        assert len(reader) == n
+    print('没有索引的时候重建索引: {:.1f} ms'.format((time.perf_counter() - t) * 1e3))
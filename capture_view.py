@@ -0,0 +1,95 @@
+# 录制文件的查看窗口
+# 用 CaptureReader 打开录制文件，列表视图只请求看得见的行，
+# 所以只会读取这几条记录，很大的文件也可以马上打开。
+
+import time
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex
+from PySide6.QtGui import QFontDatabase
+from PySide6.QtWidgets import (QWidget, QListView, QAbstractItemView, QVBoxLayout,
+    QHBoxLayout, QLabel, QLineEdit, QPushButton)
+
+from capture import CaptureReader, DIR_SEND
+
+# 一行最多显示的字节数，超过的部分用省略号
+MAX_ROW_BYTES = 256
+
+
+class CaptureModel(QAbstractListModel):
+    '''录制文件的列表模型，每条记录一行'''
+    def __init__(self, reader, parent=None) -> None:
+        super().__init__(parent)
+        self.reader = reader
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.reader)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        timestamp_ns, direction, data = self.reader.record(index.row())
+        wall = self.reader.wall_time(timestamp_ns)
+        text = time.strftime('%H:%M:%S', time.localtime(wall)) + '.{:06d} '.format(int(wall * 1e6) % 1000000)
+        text += '发-> :' if direction == DIR_SEND else '收<- :'
+        text += data[:MAX_ROW_BYTES].hex(' ')
+        if len(data) > MAX_ROW_BYTES:
+            text += ' …(+{} 字节)'.format(len(data) - MAX_ROW_BYTES)
+        return text
+
+
+class CaptureViewer(QWidget):
+    '''查看录制文件的窗口，可以跳转到开始以后的某个时间'''
+    def __init__(self, path, parent=None) -> None:
+        super().__init__(parent)
+        self.setWindowTitle(path)
+        self.resize(800, 600)
+        self.reader = CaptureReader(path)
+        self.model = CaptureModel(self.reader, self)
+
+        self.view = QListView(self)
+        self.view.setUniformItemSizes(True)
+        self.view.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.view.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.view.setModel(self.model)
+
+        self.lbl_info = QLabel(self)
+        self.txt_seek = QLineEdit(self)
+        self.txt_seek.setPlaceholderText('开始以后的秒数')
+        self.btn_seek = QPushButton('跳转', self)
+        self.btn_seek.clicked.connect(self.seek)
+        self.txt_seek.returnPressed.connect(self.seek)
+
+        bar = QHBoxLayout()
+        bar.addWidget(self.lbl_info)
+        bar.addStretch()
+        bar.addWidget(self.txt_seek)
+        bar.addWidget(self.btn_seek)
+        layout = QVBoxLayout(self)
+        layout.addLayout(bar)
+        layout.addWidget(self.view)
+
+        n = len(self.reader)
+        if n:
+            self.start_ns = self.reader.record(0)[0]
+            span = (self.reader.record(n - 1)[0] - self.start_ns) / 1e9
+        else:
+            self.start_ns = self.reader.mono_ns
+            span = 0.0
+        self.lbl_info.setText('{} 条记录，{:.3f} 秒'.format(n, span))
+
+    def seek(self):
+        try:
+            seconds = float(self.txt_seek.text())
+        except ValueError:
+            return
+        row = self.reader.find_time(self.start_ns + int(seconds * 1e9))
+        row = min(row, len(self.reader) - 1)
+        if row >= 0:
+            index = self.model.index(row)
+            self.view.scrollTo(index, QAbstractItemView.PositionAtTop)
+            self.view.setCurrentIndex(index)
+
+    def closeEvent(self, event):
+        self.view.setModel(None)
+        self.reader.close()
+        super().closeEvent(event)
@@ -0,0 +1,166 @@
+# 收发数据的编码和解码
+# 界面和命令行都用这里的函数，有三种模式：
+#   十六进制：发送的时候把 "01 03" 转成字节，接收的时候显示成 "01 03"
+#   文本：按照 utf-8（或者 gbk、ascii）编码
+#   双字节：比如发送单字符'A'，实际发送的是双字符'41'，接收的时候反过来
+# 接收是增量解码的：一个多字节的字符被分到两次读取里边的时候，前一半留在解码器里边，下次接着解码；
+# 双字节模式最多留一个没有配对的十六进制字符，其他的直接从收到的数据转换，不再复制整个缓冲区。
+
+import binascii
+import codecs
+
+MODE_HEX = 'hex'
+MODE_TEXT = 'text'
+MODE_DOUBLEBYTE = 'doublebyte'
+MODES = (MODE_HEX, MODE_TEXT, MODE_DOUBLEBYTE)
+
+ENCODINGS = ('utf-8', 'gbk', 'ascii')
+
+# 不是十六进制字符的字节，双字节模式里边出现的时候去掉
+_NON_HEX = bytes(sorted(set(range(256)) - set(b'0123456789abcdefABCDEF')))
+
+
+def encode(text, mode=MODE_HEX, encoding='utf-8') -> bytes:
+    '''把要发送的文本转成字节'''
+    if mode == MODE_HEX:
+        return bytes.fromhex(text)
+    if mode == MODE_TEXT:
+        return text.encode(encoding)
+    if mode == MODE_DOUBLEBYTE:
+        return text.encode(encoding).hex().encode('ascii')
+    raise ValueError('不支持的模式：{}'.format(mode))
+
+
+class HexPairDecoder:
+    '''把 "4142" 这样的十六进制字符增量地转成字节，最多保留一个没有配对的字符'''
+    def __init__(self) -> None:
+        self.pending = b''
+        self.invalid = 0 # 丢掉的不是十六进制的字节数
+
+    def decode(self, data) -> bytes:
+        view = memoryview(data)
+        out = b''
+        while self.pending and len(view):
+            # 上次剩下的半个和这次的第一个字符拼起来
+            first, self.pending = self.pending + bytes(view[:1]), b''
+            out += self._unhexlify(first)
+            view = view[1:]
+        end = len(view) & ~1
+        if end:
+            out += self._unhexlify(view[:end])
+        if end < len(view):
+            rest, self.pending = self.pending + bytes(view[end:]), b''
+            if len(rest) > 1:
+                out += self._unhexlify(rest)
+            else:
+                self.pending = rest
+        return out
+
+    def _unhexlify(self, data):
+        # 调用之前 pending 必须是空的
+        try:
+            return binascii.a2b_hex(data)
+        except binascii.Error:
+            pass
+        # 有不是十六进制的字节（比如空格、换行），去掉以后再转，奇数个的时候留下最后一个
+        clean = bytes(data).translate(None, _NON_HEX)
+        self.invalid += len(data) - len(clean)
+        clean = self.pending + clean
+        end = len(clean) & ~1
+        self.pending = clean[end:]
+        return binascii.a2b_hex(clean[:end])
+
+    def reset(self):
+        self.pending = b''
+
+
+class Decoder:
+    '''接收数据的增量解码，没有凑齐的字符留到下次接着解码；不能解码的字节按照 errors 处理，默认替换成 �'''
+    def __init__(self, mode=MODE_HEX, encoding='utf-8', errors='replace') -> None:
+        if mode not in MODES:
+            raise ValueError('不支持的模式：{}'.format(mode))
+        self.mode = mode
+        self.encoding = encoding
+        self.text = codecs.getincrementaldecoder(encoding)(errors)
+        self.hex = HexPairDecoder() if mode == MODE_DOUBLEBYTE else None
+
+    def decode(self, data, final=False) -> str:
+        '''final 表示数据结束了，剩下的半个字符也要输出（按照 errors 处理）'''
+        if self.mode == MODE_HEX:
+            return data.hex(' ')
+        if self.mode == MODE_DOUBLEBYTE:
+            data = self.hex.decode(data)
+        return self.text.decode(data, final)
+
+    def pending(self) -> int:
+        '''还没有解码的字节数'''
+        count = len(self.text.getstate()[0])
+        if self.hex is not None:
+            count += len(self.hex.pending)
+        return count
+
+    def reset(self):
+        self.text.reset()
+        if self.hex is not None:
+            self.hex.reset()
+
+
+def _benchmark(size=16 * 1024 * 1024, chunk=4096):
+    # 每种模式按照 chunk 大小一块一块地解码，看吞吐量，和以前的做法比较
+    import time
+    text = ('串口助手 ComHelper 接收测试 0123456789\r\n' * (size // 40))
+    cases = [
+        ('hex', MODE_HEX, 'utf-8', text.encode('utf-8')[:size]),
+        ('text utf-8', MODE_TEXT, 'utf-8', text.encode('utf-8')[:size]),
+        ('text gbk', MODE_TEXT, 'gbk', text.encode('gbk')[:size]),
+        ('text ascii', MODE_TEXT, 'ascii', text.encode('ascii', 'replace')[:size]),
+        ('doublebyte', MODE_DOUBLEBYTE, 'utf-8', text.encode('utf-8').hex().encode('ascii')[:size]),
+    ]
+    for name, mode, encoding, data in cases:
+        decoder = Decoder(mode, encoding)
+        chunks = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+        start = time.perf_counter()
+        out = [decoder.decode(c) for c in chunks]
+        out.append(decoder.decode(b'', final=True))
+        elapsed = time.perf_counter() - start
+        if mode == MODE_TEXT:
+            assert ''.join(out) == data.decode(encoding, 'replace')
+        elif mode == MODE_DOUBLEBYTE:
+            assert ''.join(out) == bytes.fromhex(data.decode('ascii')).decode('utf-8', 'replace')
+        print('{:<12} {:>8.1f} MB/s'.format(name, len(data) / elapsed / 1e6))
+    # 以前的双字节：每次复制、ascii解码、fromhex
+    data = cases[-1][3]
+    buf = bytearray()
+    start = time.perf_counter()
+    for i in range(0, len(data), chunk):
+        buf.extend(data[i:i + chunk])
+        count = len(buf) // 4 * 4
+        try:
+            bytes.fromhex(buf[:count].decode('ascii')).decode('utf-8')
+        except UnicodeDecodeError:
+            pass # 以前的做法，汉字被切开的时候会出错
+        del buf[:count]
+    elapsed = time.perf_counter() - start
+    print('{:<12} {:>8.1f} MB/s（以前的做法）'.format('doublebyte', len(data) / elapsed / 1e6))
+
+
+def _self_test():
+    # 每个字节单独解码，结果和一次解码一样
+    text = '中文 abc ü €\r\n'
+    for encoding in ENCODINGS:
+        data = text.encode(encoding, 'replace')
+        for mode, raw in ((MODE_TEXT, data), (MODE_DOUBLEBYTE, data.hex().encode('ascii'))):
+            decoder = Decoder(mode, encoding)
+            out = ''.join(decoder.decode(raw[i:i + 1]) for i in range(len(raw)))
+            assert out == data.decode(encoding, 'replace') and decoder.pending() == 0, (encoding, mode, out)
+    decoder = Decoder(MODE_DOUBLEBYTE)
+    assert decoder.decode(b'41 4') + decoder.decode(b'2\r\n43') == 'ABC'
+    decoder = Decoder(MODE_TEXT)
+    assert decoder.decode('中'.encode('utf-8')[:2]) == '' and decoder.pending() == 2
+    assert decoder.decode(b'', final=True) == '�'
+    assert Decoder(MODE_HEX).decode(b'\x01\x03') == '01 03'
+
+
+if __name__ == '__main__':
+    _self_test()
+    _benchmark()
@@ -0,0 +1,697 @@
+# 命令行的串口助手，不需要界面，启动很快
+# 用法：
+#   python -m comhelper ports
+#   python -m comhelper open COM3 -b 115200
+#   python -m comhelper send COM3 "01 03 00 00 00 01 84 0a" --wait 0.5
+#   python -m comhelper send COM3 "01 03 00 00 00 01 84 0a" --period 10 --count 1000 --timestamps sent.csv
+#   python -m comhelper latency COM3 "01 03 00 00 00 01 84 0a" --count 1000 --json latency.json
+#   python -m comhelper send-file COM3 firmware.bin -b 115200 --flow rtscts
+#   python -m comhelper send-file COM3 boot.bin app.bin -b 115200 --protocol ymodem
+#   python -m comhelper receive-file COM3 downloads --protocol zmodem
+#   python -m comhelper monitor COM3 --mode text
+#   python -m comhelper record COM3 capture.chcap --duration 60
+#   python -m comhelper multi --all -b 115200 --record-dir captures
+#   python -m comhelper modbus COM3 -b 9600 --unit 1 --function 3 --address 0 --count 10
+#   python -m comhelper slave COM4 -b 9600 --units 1,2 --script sim.py
+#   python -m comhelper gateway COM3 -b 9600 --listen 502 --rtu-listen 503
+#   python -m comhelper macro COM3 macros.csv --duration 60
+
+import argparse
+import re
+import sys
+import time
+
+import serial
+
+from codec import MODES, MODE_HEX, ENCODINGS, encode, Decoder
+from serial_session import SerialSession, list_ports
+from modbus_decode import DATA_STYLES, BYTE_ORDERS
+from framing import make_framer
+from file_sender import FLOWS, FLOW_NONE, PROTOCOLS, PROTOCOL_RAW, make_sender, make_receiver
+from macros import POLICIES, POLICY_SKIP, PeriodicSender
+
+
+def add_port_arguments(parser):
+    # 打开串口需要的参数
+    parser.add_argument('port', help='串口名称或者pyserial的url，比如 COM3、/dev/ttyUSB0、loop://')
+    parser.add_argument('-b', '--baudrate', type=int, default=9600, help='波特率，默认9600')
+    parser.add_argument('--bytesize', type=int, choices=[5, 6, 7, 8], default=8, help='数据位')
+    parser.add_argument('--parity', choices=sorted(serial.PARITY_NAMES), default=serial.PARITY_NONE, help='校验')
+    parser.add_argument('--stopbits', type=float, choices=[1, 1.5, 2], default=1, help='停止位')
+
+
+def open_session(args, recorder=None):
+    stopbits = args.stopbits if args.stopbits == 1.5 else int(args.stopbits)
+    return SerialSession(
+        args.port,
+        baudrate=args.baudrate,
+        bytesize=args.bytesize,
+        parity=args.parity,
+        stopbits=stopbits,
+        recorder=recorder,
+    )
+
+
+def print_received(session, decoder, duration=None, out=sys.stdout, framer=None, dump=False):
+    # 打印收到的数据，直到超时或者 Ctrl+C
+    if framer is not None:
+        return print_frames(session, decoder, framer, duration, out)
+    if dump:
+        return print_dump(session, duration, out)
+    deadline = None if duration is None else time.monotonic() + duration
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            timeout = 0.2 if deadline is None else max(0.0, min(0.2, deadline - time.monotonic()))
+            if session.wait(timeout):
+                text = decoder.decode(session.read())
+                if decoder.mode == MODE_HEX:
+                    text += ' '
+                out.write(text)
+                out.flush()
+            if session.reader.error is not None:
+                raise session.reader.error
+    except KeyboardInterrupt:
+        pass
+
+
+def print_frames(session, decoder, framer, duration=None, out=sys.stdout):
+    # 分帧以后每一帧打印一行
+    session.reader.idle_gap = framer.gap
+    deadline = None if duration is None else time.monotonic() + duration
+
+    def write(frames):
+        for frame in frames:
+            out.write(decoder.decode(frame).rstrip('\r\n') + '\n')
+        out.flush()
+
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            timeout = 0.2 if framer.gap is None else min(0.2, framer.gap)
+            if deadline is not None:
+                timeout = max(0.0, min(timeout, deadline - time.monotonic()))
+            if session.wait(timeout):
+                write(framer.feed(*session.read_with_breaks()))
+            elif framer.gap is not None and framer.pending() and \
+                    time.perf_counter() - session.reader.last_recv_time > framer.gap:
+                write(framer.flush())
+            if session.reader.error is not None:
+                raise session.reader.error
+    except KeyboardInterrupt:
+        pass
+    write(framer.flush())
+
+
+def print_dump(session, duration=None, out=sys.stdout):
+    # 十六进制转储，凑够一行打印一行
+    from hexdump import HexDump
+    dump = HexDump()
+    deadline = None if duration is None else time.monotonic() + duration
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            timeout = 0.2 if deadline is None else max(0.0, min(0.2, deadline - time.monotonic()))
+            if session.wait(timeout):
+                out.write(dump.feed(session.read()))
+                out.flush()
+            if session.reader.error is not None:
+                raise session.reader.error
+    except KeyboardInterrupt:
+        pass
+    out.write(dump.flush())
+
+
+def cmd_hexdump(args):
+    # 文件（或者录制文件里边收到的数据）的十六进制转储
+    from hexdump import HexDump
+    dump = HexDump(args.width, args.group)
+    out = sys.stdout
+    if args.capture:
+        from capture import iter_capture, DIR_RECV
+        for _, direction, data in iter_capture(args.file):
+            if direction == DIR_RECV:
+                out.write(dump.feed(data))
+    else:
+        with open(args.file, 'rb') as f:
+            while True:
+                data = f.read(1 << 20)
+                if not data:
+                    break
+                out.write(dump.feed(data))
+    out.write(dump.flush())
+    return 0
+
+
+def add_framing_argument(parser):
+    parser.add_argument('--frame', default=None,
+                        help='分帧以后每一帧一行：idle:秒、fixed:字节数、delim:十六进制、length:偏移,字节数,big/little,调整、slip、cobs')
+
+
+def cmd_ports(args):
+    for device, name, description in list_ports():
+        print('{}\t{}\t{}'.format(device, name, description))
+    return 0
+
+
+def cmd_open(args):
+    with open_session(args) as session:
+        print('成功打开串口：{}'.format(session.serial))
+    return 0
+
+
+def cmd_send(args):
+    data = encode(args.data, args.mode, args.encoding)
+    if args.period:
+        return send_periodic(args, data)
+    with open_session(args) as session:
+        session.write(data)
+        session.serial.flush()
+        if args.wait:
+            print_received(session, Decoder(args.mode, args.encoding), args.wait)
+            print()
+    return 0
+
+
+def send_periodic(args, data):
+    # 按照固定的周期发送，统计实际的周期
+    deadline = None if args.duration is None else time.monotonic() + args.duration
+    with open_session(args) as session:
+        sender = PeriodicSender(session, data, args.period / 1000, args.policy, count=args.count).start()
+        try:
+            while sender.is_running() and (deadline is None or time.monotonic() < deadline):
+                # 收到的数据不显示，只是取走
+                if session.wait(0.2):
+                    session.read()
+        except KeyboardInterrupt:
+            pass
+        sender.stop()
+    if sender.error is not None:
+        print('发送错误：{}'.format(sender.error), file=sys.stderr)
+    print('发送 {sent} 次，{rate:.1f} 次/秒，跳过 {skipped} 次，补发 {bursts} 次'.format(**sender.stats()))
+    print('周期：' + sender.intervals.format())
+    print('抖动：' + sender.jitter.format())
+    if args.timestamps:
+        sender.save_timestamps(args.timestamps)
+    return 1 if sender.error is not None else 0
+
+
+def cmd_latency(args):
+    # 发送一次等一次应答，统计延迟
+    from latency import LatencyProbe, MATCH_FIRST, MATCH_PATTERN
+    from serial_session import char_time
+    data = encode(args.data, args.mode, args.encoding)
+    pattern = encode(args.pattern, args.mode, args.encoding) if args.pattern else b''
+    stopbits = args.stopbits if args.stopbits == 1.5 else int(args.stopbits)
+    probe = LatencyProbe(MATCH_PATTERN if pattern else MATCH_FIRST, pattern, args.timeout,
+                         char_time(args.baudrate, args.bytesize, args.parity, stopbits))
+    with open_session(args) as session:
+        session.reader.taps = [probe]
+        try:
+            for _ in range(args.count):
+                session.write(data)
+                probe.matched.wait(args.timeout)
+                probe.expire()
+                session.read()
+                if args.interval:
+                    time.sleep(args.interval / 1000)
+        except KeyboardInterrupt:
+            pass
+        # 最后一个请求的应答可能还在路上
+        probe.matched.wait(args.timeout)
+        probe.expire()
+    print(probe.format())
+    print('延迟：' + probe.histogram.format())
+    if args.csv:
+        probe.export_csv(args.csv)
+    if args.json:
+        probe.export_json(args.json)
+    return 0 if probe.responses else 1
+
+
+def run_transfer(transfer):
+    # 在命令行上显示进度，Ctrl+C 取消
+    transfer.start()
+    try:
+        while transfer.is_alive():
+            transfer.join(0.5)
+            print('\r{} {:.0%} {} / {} 字节，{:.0f} 字节/秒，重发 {} 次'.format(
+                transfer.file_name, transfer.progress(), transfer.transferred, transfer.total, transfer.rate(),
+                transfer.retries), end='', file=sys.stderr)
+    except KeyboardInterrupt:
+        transfer.cancel()
+        transfer.join()
+    print(file=sys.stderr)
+    if transfer.error is not None:
+        print('错误：{}'.format(transfer.error), file=sys.stderr)
+        return 1
+    if transfer.cancelled:
+        print('取消，已经传输 {} 字节'.format(transfer.transferred))
+        return 1
+    print('传输成功，{} 个文件，{} 字节，用时 {:.1f} 秒，{:.0f} 字节/秒，线路利用率 {:.0%}'.format(
+        len(transfer.files), transfer.transferred, transfer.elapsed(), transfer.rate(), transfer.wire_usage()))
+    return 0
+
+
+def cmd_send_file(args):
+    if args.protocol == PROTOCOL_RAW:
+        if len(args.files) > 1:
+            print('直接发送只能发送一个文件', file=sys.stderr)
+            return 2
+        kwargs = {'chunk_size': args.chunk, 'pace': args.pace, 'flow': args.flow}
+    elif args.protocol.startswith('xmodem') and len(args.files) > 1:
+        print('XMODEM 只能发送一个文件', file=sys.stderr)
+        return 2
+    else:
+        kwargs = {}
+    with open_session(args) as session:
+        return run_transfer(make_sender(args.protocol, session, args.files, **kwargs))
+
+
+def cmd_receive_file(args):
+    with open_session(args) as session:
+        return run_transfer(make_receiver(args.protocol, session, args.target))
+
+
+def cmd_macro(args):
+    from macros import MacroSequencer, load_macros
+    macros = load_macros(args.file, args.encoding)
+    if not macros:
+        print('宏文件是空的', file=sys.stderr)
+        return 2
+    deadline = None if args.duration is None else time.monotonic() + args.duration
+    with open_session(args) as session:
+        sequencer = MacroSequencer(session, macros).start()
+        try:
+            while sequencer.is_running() and (deadline is None or time.monotonic() < deadline):
+                # 收到的数据不显示，只是取走
+                if session.wait(0.2):
+                    session.read()
+        except KeyboardInterrupt:
+            pass
+        sequencer.stop()
+    if sequencer.error is not None:
+        print('发送错误：{}'.format(sequencer.error), file=sys.stderr)
+    for macro in macros:
+        print('{}：{} 字节，发送 {} 次，跳过 {} 次，抖动 p99 {:.3f} ms'.format(
+            macro.name, len(macro.data), macro.sent, macro.late, macro.jitter.percentile(99) * 1000))
+    print('抖动：' + sequencer.jitter().format())
+    return 1 if sequencer.error is not None else 0
+
+
+def cmd_monitor(args):
+    with open_session(args) as session:
+        server = None
+        if args.metrics_port is not None:
+            # 接收的计数和积压给 Prometheus 取
+            from metrics import REGISTRY, MetricsServer
+            reader = session.reader
+            REGISTRY.gauge('bytes_read', '接收的字节数', lambda: reader.bytes_read, kind='counter')
+            REGISTRY.gauge('read_calls', '读串口的次数', lambda: reader.read_calls, kind='counter')
+            REGISTRY.gauge('recv_dropped_bytes', '接收缓冲区满了丢弃的字节数', lambda: reader.ring.dropped, kind='counter')
+            REGISTRY.gauge('recv_buffered_bytes', '接收缓冲区里边还没有取走的字节数', lambda: len(reader.ring))
+            server = MetricsServer(REGISTRY, args.metrics_port).start()
+            print('指标：http://127.0.0.1:{}/metrics'.format(server.port), file=sys.stderr)
+        try:
+            print_received(session, Decoder(args.mode, args.encoding), args.duration,
+                           framer=make_framer(args.frame) if args.frame else None, dump=args.dump)
+        finally:
+            if server is not None:
+                server.stop()
+        stats = session.stats()
+    print('\n接收 {bytes_read} 字节，丢弃 {dropped} 字节'.format(**stats), file=sys.stderr)
+    return 0
+
+
+def cmd_record(args):
+    from capture import CaptureWriter, compression_from_path
+    recorder = CaptureWriter(
+        args.file,
+        rotate_bytes=args.rotate_bytes,
+        rotate_seconds=args.rotate_seconds,
+        compression=compression_from_path(args.file),
+    )
+    try:
+        with open_session(args, recorder=recorder) as session:
+            if args.quiet:
+                try:
+                    if args.duration:
+                        time.sleep(args.duration)
+                    else:
+                        while True:
+                            time.sleep(3600)
+                except KeyboardInterrupt:
+                    pass
+            else:
+                print_received(session, Decoder(args.mode, args.encoding), args.duration,
+                               framer=make_framer(args.frame) if args.frame else None)
+    finally:
+        recorder.close()
+    print('\n录制 {records} 条记录，{bytes_written} 字节，{files} 个文件，丢弃 {dropped} 字节'.format(
+        **recorder.stats()), file=sys.stderr)
+    return 0 if recorder.error is None else 1
+
+
+def cmd_multi(args):
+    # 一个IO线程同时监视多个串口，定时打印每个串口的统计信息
+    import os
+    from session_manager import SessionManager
+    from capture import CaptureWriter
+    stopbits = args.stopbits if args.stopbits == 1.5 else int(args.stopbits)
+    params = dict(baudrate=args.baudrate, bytesize=args.bytesize, parity=args.parity, stopbits=stopbits)
+    recorders = []
+    with SessionManager() as manager:
+        ports = list(args.ports)
+        if args.all:
+            ports += [device for device, _, _ in list_ports() if device not in ports]
+        for port in ports:
+            recorder = None
+            if args.record_dir:
+                os.makedirs(args.record_dir, exist_ok=True)
+                name = re.sub(r'[^\w.-]', '_', os.path.basename(port.rstrip('/'))) or 'port'
+                recorder = CaptureWriter(os.path.join(args.record_dir, name + '.chcap'))
+                recorders.append(recorder)
+            try:
+                manager.open(port, recorder=recorder, **params)
+            except serial.SerialException as err:
+                print('错误：{}'.format(err), file=sys.stderr)
+        deadline = None if args.duration is None else time.monotonic() + args.duration
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                time.sleep(args.interval if deadline is None else max(0.0, min(args.interval, deadline - time.monotonic())))
+                for session in list(manager.sessions.values()):
+                    session.read() # 这里只统计，不显示数据
+                for port, stats in sorted(manager.stats().items()):
+                    print('{}\t接收 {bytes_read}\t丢弃 {dropped}\t{throughput:.0f} 字节/秒{}'.format(
+                        port, '' if stats['error'] is None else '\t' + stats['error'], **stats))
+        except KeyboardInterrupt:
+            pass
+    for recorder in recorders:
+        recorder.close()
+    return 0
+
+
+def cmd_modbus(args):
+    from modbus_rtu import open_master, ModbusError, read_functions, \
+        READ_COILS, READ_DISCRETE_INPUTS, WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_COILS
+    from modbus_decode import decode, encode, parse_values, registers_per_value
+    stopbits = args.stopbits if args.stopbits == 1.5 else int(args.stopbits)
+    master = open_master(args.port, args.baudrate, args.bytesize, args.parity, stopbits,
+                         timeout=args.timeout, retries=args.retries)
+    function = args.function
+    try:
+        if function in read_functions:
+            step = 1
+            if function in (READ_COILS, READ_DISCRETE_INPUTS):
+                values = master.read_bits(args.unit, function, args.address, args.count)
+            else:
+                # --count 是数值的个数，按照数据类型换算成寄存器的个数
+                step = registers_per_value(args.type)
+                data = master.read_registers_raw(args.unit, function, args.address, args.count * step)
+                values = decode(data, args.type, args.order)
+            for i, value in enumerate(values):
+                print('{}\t{}'.format(args.address + i * step, value))
+        else:
+            if not args.write:
+                raise ValueError('没有要写的数据')
+            if function in (WRITE_SINGLE_COIL, WRITE_MULTIPLE_COILS):
+                values = [int(i, 0) for i in args.write]
+            else:
+                data = encode(parse_values(' '.join(args.write), args.type), args.type, args.order)
+            if function == WRITE_SINGLE_COIL:
+                master.write_single_coil(args.unit, args.address, values[0])
+            elif function == WRITE_SINGLE_REGISTER:
+                if len(data) != 2:
+                    raise ValueError('写单个寄存器只能写一个16位的数')
+                master.write_single_register(args.unit, args.address, int.from_bytes(data, 'big'))
+            elif function == WRITE_MULTIPLE_COILS:
+                master.write_multiple_coils(args.unit, args.address, values)
+            else:
+                master.write_multiple_registers(args.unit, args.address, data=data)
+            print('写入成功')
+    except ModbusError as err:
+        print('错误：{}'.format(err), file=sys.stderr)
+        return 2
+    finally:
+        master.transport.serial.close()
+    print('{:.1f} ms'.format(master.last_round_trip * 1000), file=sys.stderr)
+    return 0
+
+
+def cmd_slave(args):
+    import runpy
+    from modbus_slave import open_slave
+    stopbits = args.stopbits if args.stopbits == 1.5 else int(args.stopbits)
+    units = [int(i, 0) for i in args.units.split(',')]
+    # 脚本里边可以定义 setup(slave)、on_request(slave, store, request) 和 tick(slave)
+    script = runpy.run_path(args.script) if args.script else {}
+    slave = open_slave(args.port, args.baudrate, args.bytesize, args.parity, stopbits, units=units,
+                       on_request=script.get('on_request'))
+    if 'setup' in script:
+        script['setup'](slave)
+    slave.start()
+    deadline = None if args.duration is None else time.monotonic() + args.duration
+    last = 0
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            time.sleep(args.tick)
+            if 'tick' in script:
+                script['tick'](slave)
+            if slave.error is not None:
+                raise slave.error
+            stats = slave.stats()
+            print('请求 {requests}，应答 {responses}，异常 {exceptions}，CRC错误 {crc_errors}，超时应答 {late}，{rate:.0f} 次/秒'.format(
+                rate=(stats['requests'] - last) / args.tick, **stats))
+            last = stats['requests']
+    except KeyboardInterrupt:
+        pass
+    finally:
+        slave.stop()
+        slave.serial.close()
+    print('应答延迟：{}'.format(slave.latency.format()))
+    for line in slave.latency.bars():
+        print(line)
+    return 0
+
+
+def cmd_gateway(args):
+    import asyncio
+    from modbus_rtu import open_master
+    from modbus_gateway import Gateway, MODE_TCP, MODE_RTU
+    stopbits = args.stopbits if args.stopbits == 1.5 else int(args.stopbits)
+    master = open_master(args.port, args.baudrate, args.bytesize, args.parity, stopbits,
+                         timeout=args.timeout, retries=args.retries)
+
+    async def run():
+        gateway = await Gateway(master, cache_ttl=args.cache_ttl).start(args.host, args.listen, args.rtu_listen)
+        for mode, name in ((MODE_TCP, 'Modbus TCP'), (MODE_RTU, 'RTU over TCP')):
+            if mode in gateway.ports:
+                print('{} 监听 {}:{}'.format(name, args.host, gateway.ports[mode]))
+        try:
+            while True:
+                await asyncio.sleep(args.interval)
+                print('客户端 {clients}，请求 {requests}，总线上 {bus_requests}，合并 {merged}，缓存命中 {cache_hits}，'
+                      '失败 {failures}，最多排队 {max_queue}，总线占用 {bus_busy:.0%}'.format(**gateway.stats()))
+        finally:
+            await gateway.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        master.transport.serial.close()
+    return 0
+
+
+def cmd_sniff(args):
+    from modbus_sniffer import ModbusSniffer, describe
+    from serial_session import char_time, silent_interval
+    stopbits = args.stopbits if args.stopbits == 1.5 else int(args.stopbits)
+    parameters = (args.baudrate, args.bytesize, args.parity, stopbits)
+
+    def on_transaction(request, response, latency):
+        text = describe(request, response)
+        print(text if latency is None else '{}  {:.2f} ms'.format(text, latency * 1000))
+
+    sniffer = ModbusSniffer(silent_interval(*parameters), char_time(*parameters),
+                            on_transaction=None if args.quiet else on_transaction, timeout=args.timeout)
+    deadline = None if args.duration is None else time.monotonic() + args.duration
+    last = time.monotonic()
+    try:
+        with open_session(args) as session:
+            session.reader.taps = [sniffer]
+            while deadline is None or time.monotonic() < deadline:
+                # 解析在接收线程里边做，这里只是把数据取走
+                if session.wait(0.2):
+                    session.read()
+                if session.reader.error is not None:
+                    raise session.reader.error
+                if time.monotonic() - last >= args.interval:
+                    last = time.monotonic()
+                    print_sniffer_table(sniffer)
+    except KeyboardInterrupt:
+        pass
+    sniffer.flush()
+    print_sniffer_table(sniffer)
+    return 0
+
+
+def print_sniffer_table(sniffer):
+    print('{} 字节，{} 帧，丢弃 {} 字节，配不上请求的应答 {}'.format(sniffer.bytes, sniffer.frames, sniffer.bad_bytes,
+                                                         sniffer.orphans))
+    for row in sniffer.table():
+        print('  从站{}：{:.1f} 次/秒，错误率 {:.1%}，平均延迟 {:.2f} ms，p99 {:.2f} ms，请求 {} 应答 {} 异常 {} 超时 {}'.format(
+            row[0], row[1], row[2], row[3] * 1000, row[4] * 1000, *row[5:]))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='comhelper', description='串口助手命令行')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('ports', help='列出所有的串口')
+    p.set_defaults(func=cmd_ports)
+
+    p = sub.add_parser('open', help='打开串口，检查参数是否正确')
+    add_port_arguments(p)
+    p.set_defaults(func=cmd_open)
+
+    p = sub.add_parser('send', help='发送数据')
+    add_port_arguments(p)
+    p.add_argument('data', help='要发送的数据')
+    p.add_argument('--mode', choices=MODES, default=MODE_HEX, help='数据的格式，默认十六进制')
+    p.add_argument('--encoding', choices=ENCODINGS, default='utf-8', help='文本和双字节模式的编码')
+    p.add_argument('--wait', type=float, default=0, help='发送以后等待接收的秒数')
+    p.add_argument('--period', type=float, default=0, help='按照这个周期（ms）一直发送，统计实际的周期')
+    p.add_argument('--count', type=int, default=0, help='周期发送的次数，默认一直发送到 Ctrl+C')
+    p.add_argument('--duration', type=float, default=None, help='周期发送的秒数')
+    p.add_argument('--policy', choices=POLICIES, default=POLICY_SKIP, help='晚了一个周期以上的时候跳过还是补发')
+    p.add_argument('--timestamps', help='把每次发送的时间保存到这个 csv 文件')
+    p.set_defaults(func=cmd_send)
+
+    p = sub.add_parser('latency', help='发送一次等一次应答，统计请求到应答的延迟')
+    add_port_arguments(p)
+    p.add_argument('data', help='请求的数据')
+    p.add_argument('--mode', choices=MODES, default=MODE_HEX, help='请求和 --pattern 的格式，默认十六进制')
+    p.add_argument('--encoding', choices=ENCODINGS, default='utf-8', help='文本和双字节模式的编码')
+    p.add_argument('--pattern', help='应答里边要匹配的内容，默认发送以后第一次收到的数据就是应答')
+    p.add_argument('--count', type=int, default=100, help='请求的次数')
+    p.add_argument('--interval', type=float, default=0, help='收到应答以后等待的 ms，再发送下一个请求')
+    p.add_argument('--timeout', type=float, default=1.0, help='等应答的秒数')
+    p.add_argument('--csv', help='每个请求的延迟保存到这个 csv 文件')
+    p.add_argument('--json', help='统计信息、直方图和每个请求的延迟保存到这个 json 文件')
+    p.set_defaults(func=cmd_latency)
+
+    p = sub.add_parser('send-file', help='发送文件')
+    add_port_arguments(p)
+    p.add_argument('files', nargs='+', help='要发送的文件，YMODEM 和 ZMODEM 可以一次发送多个')
+    p.add_argument('--protocol', choices=PROTOCOLS, default=PROTOCOL_RAW, help='传输协议，默认直接发送文件的内容')
+    p.add_argument('--chunk', type=int, default=None, help='直接发送的时候每块的字节数，默认按照波特率大概50ms的数据')
+    p.add_argument('--pace', type=float, default=0.0, help='直接发送的时候每块之间等待的秒数')
+    p.add_argument('--flow', choices=FLOWS, default=FLOW_NONE, help='直接发送的时候的流控，默认没有')
+    p.set_defaults(func=cmd_send_file)
+
+    p = sub.add_parser('receive-file', help='用 XMODEM/YMODEM/ZMODEM 接收文件')
+    add_port_arguments(p)
+    p.add_argument('target', help='保存的目录（XMODEM 是保存的文件）')
+    p.add_argument('--protocol', choices=PROTOCOLS[1:], default='zmodem', help='传输协议，默认 ZMODEM')
+    p.set_defaults(func=cmd_receive_file)
+
+    p = sub.add_parser('macro', help='按照宏文件里边的周期发送，统计发送的抖动')
+    add_port_arguments(p)
+    p.add_argument('file', help='宏文件（csv：名称,模式,内容,CRC,周期(ms),延迟(ms),次数）')
+    p.add_argument('--encoding', choices=ENCODINGS, default='utf-8', help='文本和双字节模式的编码')
+    p.add_argument('--duration', type=float, default=None, help='运行的秒数，默认一直到所有的宏发完或者 Ctrl+C')
+    p.set_defaults(func=cmd_macro)
+
+    p = sub.add_parser('monitor', help='显示接收的数据')
+    add_port_arguments(p)
+    p.add_argument('--mode', choices=MODES, default=MODE_HEX, help='显示的格式，默认十六进制')
+    p.add_argument('--encoding', choices=ENCODINGS, default='utf-8', help='文本和双字节模式的编码')
+    p.add_argument('--duration', type=float, default=None, help='监视的秒数，默认一直到 Ctrl+C')
+    add_framing_argument(p)
+    p.add_argument('--dump', action='store_true', help='显示成十六进制转储（偏移、十六进制、可见字符）')
+    p.add_argument('--metrics-port', type=int, default=None, help='在本机的这个端口上提供 Prometheus 的 /metrics')
+    p.set_defaults(func=cmd_monitor)
+
+    p = sub.add_parser('hexdump', help='文件的十六进制转储，和 hexdump -C 的格式一样')
+    p.add_argument('file', help='文件')
+    p.add_argument('--capture', action='store_true', help='文件是录制文件，只转储收到的数据')
+    p.add_argument('--width', type=int, default=16, help='每行的字节数')
+    p.add_argument('--group', type=int, default=8, help='每多少个字节多一个空格，0表示不分组')
+    p.set_defaults(func=cmd_hexdump)
+
+    p = sub.add_parser('record', help='录制收到的数据，扩展名是 .gz 或者 .zst 的时候压缩')
+    add_port_arguments(p)
+    p.add_argument('file', help='录制文件')
+    p.add_argument('--mode', choices=MODES, default=MODE_HEX, help='显示的格式，默认十六进制')
+    p.add_argument('--encoding', choices=ENCODINGS, default='utf-8', help='文本和双字节模式的编码')
+    p.add_argument('--duration', type=float, default=None, help='录制的秒数，默认一直到 Ctrl+C')
+    add_framing_argument(p)
+    p.add_argument('--rotate-bytes', type=int, default=0, help='超过这个字节数就换一个文件')
+    p.add_argument('--rotate-seconds', type=float, default=0, help='超过这个秒数就换一个文件')
+    p.add_argument('-q', '--quiet', action='store_true', help='不显示收到的数据')
+    p.set_defaults(func=cmd_record)
+
+    p = sub.add_parser('multi', help='一个进程同时监视多个串口')
+    p.add_argument('ports', nargs='*', help='串口名称或者pyserial的url')
+    p.add_argument('--all', action='store_true', help='打开所有能找到的串口')
+    p.add_argument('-b', '--baudrate', type=int, default=9600, help='波特率，默认9600')
+    p.add_argument('--bytesize', type=int, choices=[5, 6, 7, 8], default=8, help='数据位')
+    p.add_argument('--parity', choices=sorted(serial.PARITY_NAMES), default=serial.PARITY_NONE, help='校验')
+    p.add_argument('--stopbits', type=float, choices=[1, 1.5, 2], default=1, help='停止位')
+    p.add_argument('--record-dir', default=None, help='每个串口录制到这个目录下的一个文件')
+    p.add_argument('--duration', type=float, default=None, help='监视的秒数，默认一直到 Ctrl+C')
+    p.add_argument('--interval', type=float, default=1.0, help='打印统计信息的间隔，秒')
+    p.set_defaults(func=cmd_multi)
+
+    p = sub.add_parser('modbus', help='modbus RTU 主站，读写一次')
+    add_port_arguments(p)
+    p.add_argument('-w', '--write', nargs='+', default=[], metavar='VALUE', help='写的功能码要写的值，0x开头是十六进制')
+    p.add_argument('-u', '--unit', type=int, default=1, help='从站地址，默认1')
+    p.add_argument('-f', '--function', type=int, choices=[1, 2, 3, 4, 5, 6, 15, 16], default=3, help='功能码，默认3')
+    p.add_argument('-a', '--address', type=lambda x: int(x, 0), default=0, help='起始地址，0x开头是十六进制')
+    p.add_argument('-c', '--count', type=int, default=1, help='读的个数')
+    p.add_argument('-t', '--type', choices=list(DATA_STYLES), default='uint16', help='寄存器的数据类型，默认uint16')
+    p.add_argument('-o', '--order', choices=BYTE_ORDERS, default='ABCD', help='字节顺序，默认ABCD')
+    p.add_argument('--timeout', type=float, default=1.0, help='等待应答的秒数')
+    p.add_argument('--retries', type=int, default=2, help='重试次数')
+    p.set_defaults(func=cmd_modbus)
+
+    p = sub.add_parser('slave', help='modbus RTU 从站模拟，用来测试主站')
+    add_port_arguments(p)
+    p.add_argument('--units', default='1', help='从站地址，逗号分开，默认1')
+    p.add_argument('--script', default=None, help='python脚本，可以定义 setup(slave)、on_request(slave, store, request)、tick(slave)')
+    p.add_argument('--tick', type=float, default=1.0, help='调用 tick() 和打印统计信息的间隔，秒')
+    p.add_argument('--duration', type=float, default=None, help='运行的秒数，默认一直到 Ctrl+C')
+    p.set_defaults(func=cmd_slave)
+
+    p = sub.add_parser('gateway', help='modbus 网关，把 Modbus TCP 和 RTU over TCP 的请求转发到串口')
+    add_port_arguments(p)
+    p.add_argument('--host', default='0.0.0.0', help='监听的地址，默认所有地址')
+    p.add_argument('--listen', type=int, default=502, help='Modbus TCP 的端口，默认502')
+    p.add_argument('--rtu-listen', type=int, default=None, help='RTU over TCP 的端口，默认不监听')
+    p.add_argument('--cache-ttl', type=float, default=0, help='同样的读请求在这么多秒以内直接用缓存的应答，默认不缓存')
+    p.add_argument('--timeout', type=float, default=1.0, help='等待从站应答的秒数')
+    p.add_argument('--retries', type=int, default=0, help='重试次数')
+    p.add_argument('--interval', type=float, default=5.0, help='打印统计信息的间隔，秒')
+    p.set_defaults(func=cmd_gateway)
+
+    p = sub.add_parser('sniff', help='modbus RTU 总线监听，只听不发，按照从站统计交易速率、错误率和应答延迟')
+    add_port_arguments(p)
+    p.add_argument('--interval', type=float, default=5.0, help='打印统计信息的间隔，秒')
+    p.add_argument('--duration', type=float, default=None, help='运行的秒数，默认一直到 Ctrl+C')
+    p.add_argument('-q', '--quiet', action='store_true', help='不打印每一个交易，只打印统计信息')
+    p.add_argument('--timeout', type=float, default=1.0, help='请求以后等应答的秒数，超过了算超时')
+    p.set_defaults(func=cmd_sniff)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except (serial.SerialException, OSError, ValueError) as err:
+        print('错误：{}'.format(err), file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# 诊断窗口
+# 上边是所有的指标（计数、积压和各个环节花的时间），定时刷新；下边是采样分析的结果，
+# 按一次开始采样，再按一次停止，显示最耗时的函数，可以保存成折叠的调用栈（flamegraph.pl、speedscope 能读）。
+
+from PySide6.QtCore import QTimer, Signal
+from PySide6.QtGui import QFontDatabase
+from PySide6.QtWidgets import QWidget, QTableWidget, QTableWidgetItem, QPlainTextEdit, QVBoxLayout, QHBoxLayout, \
+    QLabel, QPushButton, QFileDialog, QMessageBox
+
+from metrics import REGISTRY, SamplingProfiler, Timer
+
+# 刷新的间隔，ms
+REFRESH_INTERVAL = 1000
+# 采样分析显示的函数个数
+TOP_FUNCTIONS = 30
+
+COLUMNS = ('名称', '值', '次数', 'p50(ms)', 'p99(ms)', '最大(ms)', '说明')
+
+
+class DiagnosticsView(QWidget):
+    '''显示运行时的指标和采样分析，关闭窗口的时候发 closed 信号'''
+    closed = Signal()
+
+    def __init__(self, registry=REGISTRY, parent=None) -> None:
+        super().__init__(parent)
+        self.setWindowTitle('诊断')
+        self.resize(900, 700)
+        self.registry = registry
+        self.profiler = None
+        self.lbl_info = QLabel(self)
+        self.table = QTableWidget(0, len(COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.btn_profile = QPushButton('开始采样', self)
+        self.btn_profile.clicked.connect(self.toggleProfile)
+        self.btn_save = QPushButton('保存调用栈...', self)
+        self.btn_save.clicked.connect(self.saveProfile)
+        self.btn_save.setEnabled(False)
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.btn_profile)
+        buttons.addWidget(self.btn_save)
+        buttons.addStretch(1)
+        self.txt_profile = QPlainTextEdit(self)
+        self.txt_profile.setReadOnly(True)
+        self.txt_profile.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.lbl_info)
+        layout.addWidget(self.table, 2)
+        layout.addLayout(buttons)
+        layout.addWidget(self.txt_profile, 1)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(REFRESH_INTERVAL)
+        self.refresh()
+
+    def refresh(self):
+        metrics = self.registry.collect()
+        self.table.setRowCount(len(metrics))
+        for row, metric in enumerate(metrics):
+            if isinstance(metric, Timer):
+                h = metric.histogram
+                texts = [metric.name, '{:.3f} s'.format(h.total), str(h.count), '{:.3f}'.format(h.percentile(50) * 1000),
+                         '{:.3f}'.format(h.percentile(99) * 1000), '{:.3f}'.format((h.max or 0.0) * 1000)]
+            else:
+                value = metric.value
+                texts = [metric.name, '' if value is None else '{:g}'.format(value), '', '', '', '']
+            texts.append(metric.help)
+            for column, text in enumerate(texts):
+                self.table.setItem(row, column, QTableWidgetItem(text))
+        if self.profiler is not None and self.profiler.is_running():
+            self.lbl_info.setText('正在采样：{} 次'.format(self.profiler.samples))
+        else:
+            self.lbl_info.setText('{} 个指标'.format(len(metrics)))
+
+    def toggleProfile(self):
+        if self.profiler is not None and self.profiler.is_running():
+            self.profiler.stop()
+            self.btn_profile.setText('开始采样')
+            self.btn_save.setEnabled(True)
+            self.txt_profile.setPlainText(self.profiler.report(TOP_FUNCTIONS))
+        else:
+            self.profiler = SamplingProfiler().start()
+            self.btn_profile.setText('停止采样')
+            self.btn_save.setEnabled(False)
+            self.txt_profile.setPlainText('正在采样，再按一次停止')
+
+    def saveProfile(self):
+        if self.profiler is None:
+            return
+        file_path, _ = QFileDialog.getSaveFileName(self, '保存调用栈', '', '折叠的调用栈 (*.txt);;所有文件 (*)')
+        if not file_path:
+            return
+        try:
+            self.profiler.save(file_path)
+        except OSError as err:
+            QMessageBox.critical(self, '', '保存失败：{}'.format(err))
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.closed.emit()
+        super().closeEvent(event)
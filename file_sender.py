@@ -0,0 +1,346 @@
+# 发送文件
+# 在后台线程里边一块一块地读文件、写串口，文件再大也只占一块的内存，界面不会卡住。
+# 每块的大小按照波特率算，大概是 CHUNK_SECONDS 秒的数据：
+#   写串口是阻塞的，写完一块的时候系统的发送缓冲区里边还有数据，下一块马上接上，线路一直是满的；
+#   每块之间检查一次是否取消，取消的时候丢掉系统缓冲区里边还没有发出去的数据，所以取消很快。
+# 流控：RTS/CTS 或者 XON/XOFF 由驱动处理（发送期间打开，发完了恢复原来的设置），对方来不及的时候写串口会等待。
+# 可以设置每块之间的间隔（比如对方写 flash 需要时间），这个时候每块的大小也可以自己指定。
+# XMODEM、YMODEM、ZMODEM（xmodem.py、zmodem.py）也是 Transfer 的子类，进度、速度、取消都一样，
+# 它们通过 Channel 带超时地读取对方的应答。
+
+import os
+import threading
+import time
+
+# 流控
+FLOW_NONE = 'none'
+FLOW_RTSCTS = 'rtscts'
+FLOW_XONXOFF = 'xonxoff'
+FLOWS = (FLOW_NONE, FLOW_RTSCTS, FLOW_XONXOFF)
+
+# 传输协议，raw 是直接发送文件的内容
+PROTOCOL_RAW = 'raw'
+PROTOCOLS = (PROTOCOL_RAW, 'xmodem', 'xmodem-1k', 'ymodem', 'ymodem-g', 'zmodem')
+
+CHUNK_SECONDS = 0.05 # 每块大概多少秒的数据
+MIN_CHUNK = 64
+MAX_CHUNK = 64 * 1024
+
+POLL_INTERVAL = 0.1 # 等待数据的时候多久检查一次是否取消
+
+
+class TransferError(Exception):
+    '''传输失败，比如对方取消、重试次数太多'''
+
+
+class TransferCancelled(TransferError):
+    '''本地取消'''
+
+
+def default_chunk_size(char_time) -> int:
+    '''按照一个字符的传输时间算每块的大小'''
+    if not char_time:
+        return MAX_CHUNK
+    return max(MIN_CHUNK, min(MAX_CHUNK, int(CHUNK_SECONDS / char_time)))
+
+
+class Channel:
+    '''带超时地读取对方发过来的数据，port 是 SerialSession（从接收线程的缓冲区里边取）或者有 read()/timeout 的串口'''
+    def __init__(self, port, stop_event=None) -> None:
+        self.port = port
+        self.session = port if hasattr(port, 'reader') else None
+        self.serial = getattr(port, 'serial', port)
+        self.stop_event = stop_event
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self.port.write(data)
+
+    def flush(self):
+        # 等到数据都发出去
+        flush = getattr(self.serial, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def _fill(self, wait):
+        # 最多等待 wait 秒，收到的数据追加到缓冲区
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise TransferCancelled('取消')
+        wait = min(wait, POLL_INTERVAL)
+        session = self.session
+        if session is not None:
+            if session.reader.error is not None:
+                raise TransferError('接收错误：{}'.format(session.reader.error))
+            if session.wait(wait):
+                self._buffer += session.read()
+        else:
+            port = self.port
+            if port.timeout != wait:
+                port.timeout = wait
+            self._buffer += port.read(max(1, getattr(port, 'in_waiting', 0)))
+
+    def available(self) -> int:
+        '''不等待，已经收到的字节数'''
+        if self.session is not None:
+            self._buffer += self.session.read()
+        elif getattr(self.port, 'in_waiting', 0):
+            self._fill(0)
+        return len(self._buffer)
+
+    def read(self, size, timeout) -> bytes:
+        '''读取 size 个字节，超时的时候返回收到的部分'''
+        deadline = time.perf_counter() + timeout
+        buf = self._buffer
+        while len(buf) < size:
+            wait = deadline - time.perf_counter()
+            if wait <= 0:
+                break
+            self._fill(wait)
+        data = bytes(buf[:size])
+        del buf[:size]
+        return data
+
+    def read_some(self, timeout) -> bytes:
+        '''读取已经收到的全部数据，没有的时候最多等待 timeout 秒'''
+        deadline = time.perf_counter() + timeout
+        while not self.available():
+            wait = deadline - time.perf_counter()
+            if wait <= 0:
+                return b''
+            self._fill(wait)
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def read_byte(self, timeout):
+        '''读取一个字节，超时返回 None'''
+        data = self.read(1, timeout)
+        return data[0] if data else None
+
+    def purge(self, quiet=0.0):
+        '''丢掉收到的数据，quiet 大于0的时候一直丢到线路上安静 quiet 秒'''
+        self.available()
+        self._buffer.clear()
+        while quiet > 0 and self.read_some(quiet):
+            pass
+
+
+class Transfer(threading.Thread):
+    '''后台传输文件的线程，子类实现 transfer()，进度、速度、取消在这里统一处理'''
+    def __init__(self, session, char_time=None) -> None:
+        super().__init__(name=type(self).__name__, daemon=True)
+        self.session = session
+        self.serial = getattr(session, 'serial', session)
+        if char_time is None:
+            reader = getattr(session, 'reader', None)
+            char_time = reader.char_time if reader is not None else 0.0
+        self.char_time = char_time
+        self.error = None
+        self.cancelled = False
+        # 统计信息
+        self.total = 0       # 要传输的字节数，不知道的时候是 0
+        self.transferred = 0 # 已经传输的文件内容的字节数
+        self.retries = 0     # 重发的次数
+        self.file_name = ''  # 正在传输的文件
+        self.files = []      # 传输完的文件
+        self.start_time = None
+        self.end_time = None
+        self._stop_event = threading.Event()
+        self.channel = Channel(session, self._stop_event)
+
+    def cancel(self):
+        self.cancelled = True
+        self._stop_event.set()
+
+    @property
+    def done(self):
+        return self.end_time is not None
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def rate(self):
+        '''平均速度，字节/秒'''
+        elapsed = self.elapsed()
+        return self.transferred / elapsed if elapsed > 0 else 0.0
+
+    def wire_usage(self):
+        '''有效数据占线路的比例，按照波特率满速是 1.0'''
+        elapsed = self.elapsed()
+        return self.transferred * self.char_time / elapsed if elapsed > 0 and self.char_time else 0.0
+
+    def progress(self):
+        if not self.total:
+            return 1.0 if self.done else 0.0
+        return min(1.0, self.transferred / self.total)
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        try:
+            self.transfer()
+        except TransferCancelled:
+            self.abort()
+        except Exception as err:
+            self.error = err
+            self.abort()
+        finally:
+            self.end_time = time.perf_counter()
+
+    def transfer(self):
+        raise NotImplementedError
+
+    def abort(self):
+        '''取消或者出错以后通知对方，子类实现'''
+
+    def stats(self) -> dict:
+        return {
+            'transferred': self.transferred,
+            'total': self.total,
+            'files': len(self.files),
+            'retries': self.retries,
+            'elapsed': self.elapsed(),
+            'rate': self.rate(),
+            'wire_usage': self.wire_usage(),
+        }
+
+
+class FileSender(Transfer):
+    '''直接发送一个文件的内容，session 是 SerialSession（发送的数据会录制），也可以是有 write() 的串口'''
+    def __init__(self, session, path, chunk_size=None, pace=0.0, flow=FLOW_NONE, char_time=None) -> None:
+        super().__init__(session, char_time)
+        if flow not in FLOWS:
+            raise ValueError('不支持的流控：{}'.format(flow))
+        self.path = path
+        self.file_name = os.path.basename(path)
+        self.total = os.path.getsize(path)
+        self.chunk_size = chunk_size or default_chunk_size(self.char_time)
+        self.pace = pace # 每块之间等待的秒数
+        self.flow = flow
+        self.chunks = 0
+
+    def _set_flow(self, flow):
+        # 返回原来的设置，发完了恢复
+        ser = self.serial
+        old = (getattr(ser, 'rtscts', False), getattr(ser, 'xonxoff', False))
+        if flow != FLOW_NONE:
+            ser.rtscts = flow == FLOW_RTSCTS
+            ser.xonxoff = flow == FLOW_XONXOFF
+        return old
+
+    def transfer(self):
+        write = self.session.write
+        buf = bytearray(self.chunk_size) # 一直用这一块内存
+        view = memoryview(buf)
+        old_flow = self._set_flow(self.flow)
+        try:
+            with open(self.path, 'rb', buffering=0) as f:
+                while not self._stop_event.is_set():
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    write(view[:n])
+                    self.transferred += n
+                    self.chunks += 1
+                    if self.pace and self._stop_event.wait(self.pace):
+                        break
+            if self.cancelled:
+                raise TransferCancelled('取消')
+            self.channel.flush() # 等到最后一个字节发出去，速度才准确
+            self.files.append(self.path)
+        finally:
+            if self.flow != FLOW_NONE:
+                try:
+                    self.serial.rtscts, self.serial.xonxoff = old_flow
+                except Exception:
+                    pass
+            view.release()
+
+    def abort(self):
+        # 系统缓冲区里边还没有发出去的也不要了
+        reset = getattr(self.serial, 'reset_output_buffer', None)
+        if reset is not None:
+            reset()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['chunks'] = self.chunks
+        return stats
+
+
+def make_sender(protocol, session, paths, **kwargs) -> Transfer:
+    '''按照协议创建发送的线程，paths 是文件列表（XMODEM 和直接发送只能发一个文件）'''
+    if protocol == PROTOCOL_RAW:
+        return FileSender(session, paths[0], **kwargs)
+    if protocol in ('xmodem', 'xmodem-1k'):
+        from xmodem import XmodemSender
+        return XmodemSender(session, paths[0], block_size=1024 if protocol == 'xmodem-1k' else 128, **kwargs)
+    if protocol in ('ymodem', 'ymodem-g'):
+        from xmodem import YmodemSender
+        return YmodemSender(session, paths, **kwargs) # 按照对方发的 'C' 或者 'G' 决定是否等待应答
+    if protocol == 'zmodem':
+        from zmodem import ZmodemSender
+        return ZmodemSender(session, paths, **kwargs)
+    raise ValueError('不支持的协议：{}'.format(protocol))
+
+
+def make_receiver(protocol, session, target, **kwargs) -> Transfer:
+    '''按照协议创建接收的线程，XMODEM 的 target 是保存的文件，其他的是保存的目录'''
+    if protocol in ('xmodem', 'xmodem-1k'):
+        from xmodem import XmodemReceiver
+        return XmodemReceiver(session, target, **kwargs)
+    if protocol in ('ymodem', 'ymodem-g'):
+        from xmodem import YmodemReceiver
+        return YmodemReceiver(session, target, streaming=protocol == 'ymodem-g', **kwargs)
+    if protocol == 'zmodem':
+        from zmodem import ZmodemReceiver
+        return ZmodemReceiver(session, target, **kwargs)
+    raise ValueError('不支持接收的协议：{}'.format(protocol))
+
+
+def _benchmark(size=4 * 1024 * 1024, baudrate=921600):
+    # 用pty发送一个文件，另一头收下来比较，看速度和取消
+    import tempfile
+    from serial_session import SerialSession
+    master, slave = os.openpty()
+    path = os.path.join(tempfile.mkdtemp(), 'firmware.bin')
+    data = os.urandom(size)
+    with open(path, 'wb') as f:
+        f.write(data)
+    received = bytearray()
+
+    def drain():
+        while len(received) < size:
+            chunk = os.read(master, 65536)
+            if not chunk:
+                break
+            received.extend(chunk)
+
+    receiver = threading.Thread(target=drain, daemon=True)
+    receiver.start()
+    with SerialSession(os.ttyname(slave), baudrate=baudrate) as session:
+        sender = FileSender(session, path)
+        sender.start()
+        while sender.is_alive():
+            time.sleep(0.2)
+            print('\r{:.0%} {:.0f} 字节/秒'.format(sender.progress(), sender.rate()), end='')
+        receiver.join(5)
+        print()
+        assert sender.error is None, sender.error
+        assert bytes(received) == data
+        print('发送 {} 字节，每块 {} 字节，{:.0f} 字节/秒'.format(sender.transferred, sender.chunk_size, sender.rate()))
+        # 取消
+        sender = FileSender(session, path, chunk_size=1024, pace=0.01)
+        sender.start()
+        time.sleep(0.1)
+        sender.cancel()
+        sender.join(1)
+        assert not sender.is_alive() and sender.cancelled and sender.transferred < size
+        print('取消：已经发送 {} 字节，{:.0f} ms 以后停止'.format(sender.transferred, sender.elapsed() * 1000))
+    os.close(master)
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -0,0 +1,379 @@
+# 接收数据的分帧
+# 串口收到的是连续的字节流，这里按照规则切成一帧一帧的，显示、录制、协议解析都按照帧来处理。
+# 支持的规则：
+#   idle    空闲时间：两块数据之间空闲超过 gap 秒就是新的一帧，空闲时间是接收线程里边测的（SerialReader.idle_gap）
+#   fixed   固定长度
+#   delim   分隔符，比如 \r\n 或者 0x7E
+#   length  长度前缀：帧头里边有长度字段
+#   slip    SLIP（RFC 1055），0xC0 结束，去掉转义
+#   cobs    COBS，0x00 结束
+# 所有的分帧都是增量的：没有凑齐的数据留在缓冲区里边，下次只从上次找到的位置往后找，不会重复扫描；
+# 每次 feed() 最后只删除一次缓冲区开头已经处理的数据。
+
+# 一帧最多的字节数，超过了强制切开，避免一直没有分隔符的时候缓冲区无限增长
+DEFAULT_MAX_SIZE = 4096
+
+SLIP_END = 0xC0
+SLIP_ESC = 0xDB
+SLIP_ESC_END = 0xDC
+SLIP_ESC_ESC = 0xDD
+
+
+class Framer:
+    '''分帧的基类，feed() 返回这次凑齐的帧'''
+    gap = None # 空闲时间分帧的时候是秒，其他的是 None
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self._buf = bytearray()
+        # 统计信息
+        self.frames = 0
+        self.overflows = 0 # 超过 max_size 强制切开的次数
+        self.errors = 0 # 格式不对丢掉的次数
+
+    def feed(self, data, breaks=()) -> list:
+        '''data 是收到的数据，breaks 是 data 里边空闲超过 gap 的位置（升序）'''
+        frames = []
+        pos = 0
+        for index in breaks:
+            if index > pos:
+                self._scan(data[pos:index], frames)
+            self._idle(frames)
+            pos = index
+        if pos < len(data):
+            self._scan(data[pos:] if pos else data, frames)
+        self.frames += len(frames)
+        return frames
+
+    def flush(self) -> list:
+        '''数据结束了（或者空闲超时了），剩下没有凑齐的数据当成一帧'''
+        if not self._buf:
+            return []
+        frame = bytes(self._buf)
+        self.reset()
+        self.frames += 1
+        return [frame]
+
+    def pending(self):
+        '''缓冲区里边还没有凑齐的字节数'''
+        return len(self._buf)
+
+    def reset(self):
+        self._buf.clear()
+
+    def _idle(self, frames):
+        # 空闲超过 gap，默认不处理
+        pass
+
+    def _scan(self, data, frames):
+        raise NotImplementedError
+
+
+class IdleGapFramer(Framer):
+    '''空闲超过 gap 秒是新的一帧'''
+    def __init__(self, gap=0.02, max_size=DEFAULT_MAX_SIZE) -> None:
+        super().__init__(max_size)
+        self.gap = gap
+
+    def _idle(self, frames):
+        if self._buf:
+            frames.append(bytes(self._buf))
+            self._buf.clear()
+
+    def _scan(self, data, frames):
+        buf = self._buf
+        buf += data
+        start = 0
+        while len(buf) - start >= self.max_size:
+            frames.append(bytes(buf[start:start + self.max_size]))
+            start += self.max_size
+            self.overflows += 1
+        if start:
+            del buf[:start]
+
+
+class FixedLengthFramer(Framer):
+    '''每 size 个字节一帧'''
+    def __init__(self, size, max_size=DEFAULT_MAX_SIZE) -> None:
+        if size <= 0:
+            raise ValueError('帧长度必须大于0')
+        super().__init__(max_size)
+        self.size = size
+
+    def _scan(self, data, frames):
+        buf = self._buf
+        buf += data
+        size = self.size
+        start = 0
+        while len(buf) - start >= size:
+            frames.append(bytes(buf[start:start + size]))
+            start += size
+        if start:
+            del buf[:start]
+
+
+class DelimiterFramer(Framer):
+    '''按照分隔符分帧，keep_delimiter 表示帧里边保留分隔符，skip_empty 表示两个分隔符连在一起的时候不算一帧'''
+    def __init__(self, delimiter=b'\r\n', keep_delimiter=True, skip_empty=True, max_size=DEFAULT_MAX_SIZE) -> None:
+        if not delimiter:
+            raise ValueError('分隔符不能是空的')
+        super().__init__(max_size)
+        self.delimiter = bytes(delimiter)
+        self.keep_delimiter = keep_delimiter
+        self.skip_empty = skip_empty
+        self._searched = 0 # 缓冲区里边已经找过的长度
+
+    def reset(self):
+        super().reset()
+        self._searched = 0
+
+    def _scan(self, data, frames):
+        buf = self._buf
+        buf += data
+        delimiter = self.delimiter
+        size = len(delimiter)
+        start = 0
+        # 分隔符可能跨在两块数据中间，往回退 size - 1 个字节
+        find_from = max(self._searched - size + 1, 0)
+        while True:
+            index = buf.find(delimiter, find_from)
+            if index < 0:
+                break
+            end = index + size
+            if index > start or not self.skip_empty:
+                frames.append(bytes(buf[start:end if self.keep_delimiter else index]))
+            start = find_from = end
+        # 没有分隔符的数据超过 max_size 就按照 max_size 切开，最后不够 max_size 的留着，分隔符可能在后边
+        while len(buf) - start > self.max_size:
+            frames.append(bytes(buf[start:start + self.max_size]))
+            start += self.max_size
+            self.overflows += 1
+        if start:
+            del buf[:start]
+        self._searched = len(buf)
+
+
+class LengthPrefixFramer(Framer):
+    '''帧头里边有长度字段：从 offset 开始 size 个字节，帧的总长度是 帧头（offset + size）+ 长度字段 + adjust
+    长度不对（小于帧头或者超过 max_size）的时候丢掉一个字节重新同步'''
+    def __init__(self, offset=0, size=1, byteorder='big', adjust=0, max_size=DEFAULT_MAX_SIZE) -> None:
+        if size not in (1, 2, 4):
+            raise ValueError('长度字段只能是1、2、4个字节')
+        if byteorder not in ('big', 'little'):
+            raise ValueError('字节序只能是 big 或者 little')
+        super().__init__(max_size)
+        self.offset = offset
+        self.size = size
+        self.byteorder = byteorder
+        self.adjust = adjust
+
+    def _scan(self, data, frames):
+        buf = self._buf
+        buf += data
+        header = self.offset + self.size
+        start = 0
+        while len(buf) - start >= header:
+            length = header + self.adjust + int.from_bytes(buf[start + self.offset:start + header], self.byteorder)
+            if length < header or length > self.max_size:
+                start += 1
+                self.errors += 1
+                continue
+            if len(buf) - start < length:
+                break
+            frames.append(bytes(buf[start:start + length]))
+            start += length
+        if start:
+            del buf[:start]
+
+
+class DecodingFramer(DelimiterFramer):
+    '''按照结束符分帧以后再解码（SLIP、COBS），格式不对的帧丢掉；
+    超过 max_size 的帧切开的几块和结束符之前剩下的部分都不是完整的帧，整个丢掉，算一次错误'''
+    def __init__(self, end, max_size=DEFAULT_MAX_SIZE) -> None:
+        super().__init__(end, keep_delimiter=False, skip_empty=True, max_size=max_size)
+        self._truncated = False # 正在丢掉超长的帧，到下一个结束符为止
+
+    def reset(self):
+        super().reset()
+        self._truncated = False
+
+    def decode(self, data) -> bytes:
+        raise NotImplementedError
+
+    def _scan(self, data, frames):
+        raw = []
+        overflows = self.overflows
+        super()._scan(data, raw)
+        # 超长切开的几块在最后边
+        pieces = self.overflows - overflows
+        for frame in raw[:len(raw) - pieces]:
+            if self._truncated:
+                self._truncated = False
+                continue
+            try:
+                frames.append(self.decode(frame))
+            except ValueError:
+                self.errors += 1
+        if pieces and not self._truncated:
+            self._truncated = True
+            self.errors += 1
+
+
+class SlipFramer(DecodingFramer):
+    '''SLIP，帧是去掉转义以后的数据，转义不对的帧丢掉'''
+    def __init__(self, max_size=DEFAULT_MAX_SIZE) -> None:
+        super().__init__(bytes([SLIP_END]), max_size=max_size)
+
+    def decode(self, data):
+        return slip_decode(data)
+
+
+class CobsFramer(DecodingFramer):
+    '''COBS，帧是解码以后的数据，格式不对的帧丢掉'''
+    def __init__(self, max_size=DEFAULT_MAX_SIZE) -> None:
+        super().__init__(b'\x00', max_size=max_size)
+
+    def decode(self, data):
+        return cobs_decode(data)
+
+
+def slip_encode(data) -> bytes:
+    '''编码成一个 SLIP 帧，前后都加上 END'''
+    data = bytes(data).replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc')
+    return b'\xc0' + data + b'\xc0'
+
+
+def slip_decode(data) -> bytes:
+    '''去掉转义，data 不包括 END'''
+    data = bytes(data)
+    if SLIP_ESC not in data:
+        return data
+    # ESC 后边只能是 ESC_END 或者 ESC_ESC
+    if data.count(b'\xdb') != data.count(b'\xdb\xdc') + data.count(b'\xdb\xdd'):
+        raise ValueError('SLIP 转义不对')
+    return data.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+
+
+def cobs_encode(data) -> bytes:
+    '''COBS 编码，结果里边没有 0x00，不包括结尾的 0x00'''
+    out = bytearray()
+    for part in bytes(data).split(b'\x00'):
+        while len(part) >= 254:
+            out.append(0xFF)
+            out += part[:254]
+            part = part[254:]
+        out.append(len(part) + 1)
+        out += part
+    return bytes(out)
+
+
+def cobs_decode(data) -> bytes:
+    '''COBS 解码，data 不包括结尾的 0x00'''
+    out = bytearray()
+    pos = 0
+    size = len(data)
+    while pos < size:
+        code = data[pos]
+        end = pos + code
+        if code == 0 or end > size:
+            raise ValueError('COBS 数据不对')
+        out += data[pos + 1:end]
+        pos = end
+        if code < 0xFF and pos < size:
+            out.append(0)
+    return bytes(out)
+
+
+# 分帧的名字 -> (说明, 参数的格式)
+FRAMINGS = {
+    'idle': ('空闲时间', '秒，比如 0.02'),
+    'fixed': ('固定长度', '字节数，比如 8'),
+    'delim': ('分隔符', '十六进制，比如 0d0a'),
+    'length': ('长度前缀', '偏移,字节数,big/little,调整，比如 2,1,big,2'),
+    'slip': ('SLIP', ''),
+    'cobs': ('COBS', ''),
+}
+
+
+def make_framer(spec, max_size=DEFAULT_MAX_SIZE) -> Framer:
+    '''按照 "名字:参数" 创建分帧，比如 idle:0.02、fixed:8、delim:0d0a、length:2,1,big,2、slip、cobs'''
+    name, _, arg = spec.strip().partition(':')
+    name = name.strip().lower()
+    arg = arg.strip()
+    if name == 'idle':
+        return IdleGapFramer(float(arg) if arg else 0.02, max_size=max_size)
+    if name == 'fixed':
+        return FixedLengthFramer(int(arg, 0), max_size=max_size)
+    if name == 'delim':
+        return DelimiterFramer(bytes.fromhex(arg) if arg else b'\r\n', max_size=max_size)
+    if name == 'length':
+        parts = [i.strip() for i in arg.split(',')] if arg else []
+        offset = int(parts[0], 0) if len(parts) > 0 else 0
+        size = int(parts[1], 0) if len(parts) > 1 else 1
+        byteorder = parts[2] if len(parts) > 2 else 'big'
+        adjust = int(parts[3], 0) if len(parts) > 3 else 0
+        return LengthPrefixFramer(offset, size, byteorder, adjust, max_size=max_size)
+    if name == 'slip':
+        return SlipFramer(max_size=max_size)
+    if name == 'cobs':
+        return CobsFramer(max_size=max_size)
+    raise ValueError('不支持的分帧：{}'.format(spec))
+
+
+def _self_test():
+    import random
+    rnd = random.Random(0)
+
+    def feed_random(framer, data):
+        # 随机切成小块喂进去，结果应该和一次喂进去一样
+        frames = []
+        pos = 0
+        while pos < len(data):
+            n = rnd.randint(1, 17)
+            frames += framer.feed(data[pos:pos + n])
+            pos += n
+        return frames
+
+    payloads = [bytes(rnd.randrange(256) for _ in range(rnd.randint(1, 600))) for _ in range(200)]
+    payloads += [b'\x00' * 300, b'\xc0\xdb' * 100, bytes(range(1, 255)), bytes(range(1, 255)) + b'\x00']
+    assert feed_random(SlipFramer(), b''.join(slip_encode(p) for p in payloads)) == payloads
+    assert feed_random(CobsFramer(), b''.join(cobs_encode(p) + b'\x00' for p in payloads)) == payloads
+    for p in payloads:
+        assert b'\x00' not in cobs_encode(p) and cobs_decode(cobs_encode(p)) == p
+    lines = [b'line %d\r\n' % i for i in range(1000)]
+    assert feed_random(DelimiterFramer(b'\r\n'), b''.join(lines)) == lines
+    assert feed_random(DelimiterFramer(b'\r\n', keep_delimiter=False), b''.join(lines)) == [i[:-2] for i in lines]
+    assert feed_random(FixedLengthFramer(7), bytes(70)) == [bytes(7)] * 10
+    # 长度前缀：2字节帧头 + 1字节长度 + 数据 + 2字节校验
+    frames = [b'\xaa\x55' + bytes([len(p)]) + p + b'\x00\x00' for p in payloads if len(p) < 256]
+    assert feed_random(LengthPrefixFramer(2, 1, 'big', 2), b''.join(frames)) == frames
+    # 超长：按照 max_size 切开；SLIP 和 COBS 整个丢掉，后边的帧不受影响
+    assert feed_random(DelimiterFramer(b'\r\n', max_size=16), bytes(40) + b'\r\n') == [bytes(16), bytes(16), bytes(8) + b'\r\n']
+    framer = SlipFramer(max_size=16)
+    assert feed_random(framer, slip_encode(bytes(range(1, 41))) + slip_encode(b'ok')) == [b'ok'] and framer.errors == 1
+    framer = CobsFramer(max_size=16)
+    assert feed_random(framer, cobs_encode(bytes(40)) + b'\x00' + cobs_encode(b'ok') + b'\x00') == [b'ok']
+    assert framer.errors == 1
+    framer = IdleGapFramer(0.01)
+    assert framer.feed(b'abcdef', [3]) == [b'abc'] and framer.flush() == [b'def']
+    assert framer.feed(b'abc', [0]) == [] and framer.feed(b'de', [0]) == [b'abc'] and framer.pending() == 2
+
+
+def _benchmark(size=16 * 1024 * 1024, chunk=1024):
+    # 一直没有分隔符的时候，每次收到一块数据只看新的数据，时间和数据量成正比
+    import time
+    for name, data in (('delim 没有分隔符', bytes(size)), ('delim 每行80字节', (b'x' * 78 + b'\r\n') * (size // 80)),
+                       ('slip', b''.join(slip_encode(bytes(range(200))) for _ in range(size // 200)))):
+        for max_size in (DEFAULT_MAX_SIZE, size):
+            framer = make_framer('slip' if name == 'slip' else 'delim:0d0a', max_size=max_size)
+            start = time.perf_counter()
+            count = 0
+            for pos in range(0, len(data), chunk):
+                count += len(framer.feed(data[pos:pos + chunk]))
+            elapsed = time.perf_counter() - start
+            print('{}，max_size {}：{} 帧，{:.1f} MB/s'.format(name, max_size, count, len(data) / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    _self_test()
+    _benchmark()
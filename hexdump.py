@@ -0,0 +1,252 @@
+# 十六进制转储，和 hexdump -C 的格式一样：
+#   00000000  48 65 6c 6c 6f 20 57 6f  72 6c 64 0d 0a 00 01 02  |Hello World.....|
+# 整行的数据一次性格式化，不按行循环：
+#   十六进制用 b2a_hex(data, ' ') 一次转好，每一组（8个字节是24个字符）正好是整数个 64 位，
+#   可见字符（16个）、偏移（8个十六进制数字）也是整数个 64 位；
+#   一行是 79 个字节，每 8 行正好是 79 个 64 位，所以把输出缓冲区按照 0~7 的错位各看成一个 64 位的数组，
+#   每一列、每一个错位是一次 64 位的步长切片赋值，一共几十次，和行数没有关系。
+# 偏移是把整块的偏移当成一个大整数一次算出来的：offset * (1, 1, 1...) + width * (0, 1, 2...)。
+# 缓冲区按照最多的行数分配一次，空格、'|'、换行这些固定的字符不会被覆盖，下次直接复用。
+# 每行的字节数或者分组不是8的倍数的时候，按照每一个字节一列来填（慢一些）。
+# 不满一行的数据（最后一行，或者界面上的一行）用 format_row() 单独格式化。
+
+import binascii
+import math
+import sys
+from array import array
+
+DEFAULT_WIDTH = 16 # 每行的字节数
+DEFAULT_GROUP = 8  # 每多少个字节中间多一个空格，0表示不分组
+OFFSET_DIGITS = 8  # 偏移显示的十六进制位数
+
+# 不可见的字符显示成 '.'
+ASCII_TABLE = bytes(i if 0x20 <= i < 0x7f else 0x2e for i in range(256))
+
+
+class HexDumpFormatter:
+    '''格式化十六进制转储，format() 返回的是内部缓冲区的 memoryview，下次调用之前有效'''
+    def __init__(self, width=DEFAULT_WIDTH, group=DEFAULT_GROUP) -> None:
+        if width <= 0:
+            raise ValueError('每行的字节数必须大于0')
+        self.width = width
+        self.group = group
+        # 每个字节的十六进制在一行里边的位置
+        self.hex_columns = [OFFSET_DIGITS + 2 + 3 * j + (j // group if group else 0) for j in range(width)]
+        self.hex_width = self.hex_columns[-1] + 2 - (OFFSET_DIGITS + 2)
+        self.ascii_column = self.hex_columns[-1] + 2 + 3 # 两个空格和 '|' 以后
+        self.row_size = self.ascii_column + width + 2 # 最后是 '|' 和换行
+        row = bytearray(b' ' * self.row_size)
+        row[self.ascii_column - 1] = ord('|')
+        row[self.ascii_column + width] = ord('|')
+        row[-1] = ord('\n')
+        self._template = bytes(row)
+        # 按照 64 位填的条件：每一组十六进制（带一个空格是 3 * group 个字符）和可见字符都是 8 的倍数
+        group_size = group or width
+        self.aligned = OFFSET_DIGITS == 8 and width % group_size == 0 and group_size % 8 == 0
+        self._period = 8 // math.gcd(self.row_size, 8) # 多少行以后错位重复
+        self._buffer = bytearray()
+        self._views = []
+        self._rows = 0 # 缓冲区能放的行数
+        self._offset_rows = 0
+        self._ones = 0  # (1, 1, 1...) 每个 64 位一个，大端
+        self._steps = 0 # width * (0, 1, 2...)
+
+    def _reserve(self, rows):
+        if rows > self._rows:
+            rows = -(-rows // self._period) * self._period
+            self._buffer = bytearray(self._template * rows + bytes(8))
+            size = len(self._buffer)
+            self._views = [memoryview(self._buffer)[s:s + (size - s) // 8 * 8].cast('Q') for s in range(8)]
+            self._rows = rows
+
+    def _offset_digits(self, offset, rows):
+        # 每行的偏移，16 个十六进制字符一行
+        if rows != self._offset_rows:
+            self._ones = ((1 << 64 * rows) - 1) // ((1 << 64) - 1)
+            steps = array('Q', range(rows))
+            if sys.byteorder == 'little':
+                steps.byteswap()
+            self._steps = self.width * int.from_bytes(steps.tobytes(), 'big')
+            self._offset_rows = rows
+        value = offset * self._ones + self._steps
+        return binascii.hexlify(value.to_bytes(8 * rows, 'big'))
+
+    def format(self, data, offset=0):
+        '''格式化整行的数据（长度是 width 的整数倍），返回 memoryview'''
+        width = self.width
+        rows = len(data) // width
+        if rows * width != len(data):
+            raise ValueError('数据的长度必须是 {} 的整数倍'.format(width))
+        if not rows:
+            return memoryview(b'')
+        self._reserve(rows)
+        if self.aligned:
+            self._format_aligned(data, offset, rows)
+        else:
+            self._format_columns(data, offset, rows)
+        return memoryview(self._buffer)[:rows * self.row_size]
+
+    def _format_aligned(self, data, offset, rows):
+        width = self.width
+        size = self.row_size
+        period = self._period
+        views = self._views
+        group = self.group or width
+        # 每个字节 "hh "，每行 3 * width 个字符
+        digits = memoryview(binascii.b2a_hex(data, b' ') + b' ').cast('Q')
+        text = memoryview(bytes(data).translate(ASCII_TABLE)).cast('Q')
+        offsets = memoryview(self._offset_digits(offset, rows)).cast('Q')
+        # (源数组, 每行的个数, 这一列在源里边的下标, 在一行里边的位置)
+        columns = [(offsets, 2, 1, 0)]
+        hex_words = 3 * width // 8
+        for k in range(hex_words):
+            block, index = divmod(8 * k, 3 * group)
+            columns.append((digits, hex_words, k, OFFSET_DIGITS + 2 + block * (3 * group + 1) + index))
+        for k in range(width // 8):
+            columns.append((text, width // 8, k, self.ascii_column + 8 * k))
+        step = period * size // 8 # 错位一样的两行之间隔了多少个 64 位
+        for r in range(min(period, rows)):
+            count = (rows - r + period - 1) // period
+            for source, per_row, index, column in columns:
+                position = r * size + column
+                view = views[position % 8]
+                start = position // 8
+                first = r * per_row + index
+                view[start:start + step * (count - 1) + 1:step] = \
+                    source[first:first + per_row * period * (count - 1) + 1:per_row * period]
+
+    def _format_columns(self, data, offset, rows):
+        width = self.width
+        out = self._buffer
+        size = self.row_size
+        end = rows * size
+        digits = binascii.hexlify(data)
+        step = 2 * width
+        for j, column in enumerate(self.hex_columns):
+            out[column:end:size] = digits[2 * j::step]
+            out[column + 1:end:size] = digits[2 * j + 1::step]
+        text = bytes(data).translate(ASCII_TABLE)
+        column = self.ascii_column
+        for j in range(width):
+            out[column + j:end:size] = text[j::width]
+        digits = self._offset_digits(offset, rows)
+        for k in range(OFFSET_DIGITS):
+            out[k:end:size] = digits[16 - OFFSET_DIGITS + k::16]
+
+    def format_row(self, data, offset=0) -> str:
+        '''格式化一行（最多 width 个字节），没有换行符'''
+        data = bytes(data[:self.width])
+        group = self.group or self.width
+        digits = '  '.join(data[i:i + group].hex(' ') for i in range(0, len(data), group))
+        return '{:0{}x}  {}  |{}|'.format(offset & (1 << 4 * OFFSET_DIGITS) - 1, OFFSET_DIGITS,
+                                          digits.ljust(self.hex_width), data.translate(ASCII_TABLE).decode('ascii'))
+
+    def format_text(self, data, offset=0) -> str:
+        '''格式化任意长度的数据，最后一行可以不满'''
+        full = len(data) // self.width * self.width
+        text = str(self.format(data[:full], offset), 'ascii')
+        if full < len(data):
+            text += self.format_row(data[full:], offset + full) + '\n'
+        return text
+
+
+class HexDump:
+    '''增量的十六进制转储，feed() 返回凑齐的整行，不满一行的留到下次'''
+    def __init__(self, width=DEFAULT_WIDTH, group=DEFAULT_GROUP, offset=0) -> None:
+        self.formatter = HexDumpFormatter(width, group)
+        self.offset = offset # 下一行的偏移
+        self._partial = bytearray()
+
+    def feed(self, data) -> str:
+        width = self.formatter.width
+        if self._partial:
+            # 先把上次剩下的凑成一行
+            need = width - len(self._partial)
+            self._partial += data[:need]
+            data = data[need:]
+            if len(self._partial) < width:
+                return ''
+            head = str(self.formatter.format(self._partial, self.offset), 'ascii')
+            self.offset += width
+            self._partial.clear()
+        else:
+            head = ''
+        full = len(data) // width * width
+        if full < len(data):
+            self._partial += data[full:]
+        if not full:
+            return head
+        text = str(self.formatter.format(data[:full] if full < len(data) else data, self.offset), 'ascii')
+        self.offset += full
+        return head + text if head else text
+
+    def flush(self) -> str:
+        '''最后不满一行的数据'''
+        if not self._partial:
+            return ''
+        text = self.formatter.format_row(self._partial, self.offset) + '\n'
+        self.offset += len(self._partial)
+        self._partial.clear()
+        return text
+
+    def pending(self):
+        return len(self._partial)
+
+
+def _self_test():
+    import os
+    import random
+    rnd = random.Random(0)
+    data = bytes(rnd.randrange(256) for _ in range(1000)) + b'Hello World\r\n'
+    for width, group in ((16, 8), (16, 0), (8, 4), (32, 8), (5, 2)):
+        formatter = HexDumpFormatter(width, group)
+        # 整块格式化和一行一行格式化的结果一样
+        expected = ''.join(formatter.format_row(data[i:i + width], 0x1000 + i) + '\n' for i in range(0, len(data), width))
+        assert formatter.format_text(data, 0x1000) == expected, (width, group)
+        dump = HexDump(width, group, 0x1000)
+        pos = 0
+        out = []
+        while pos < len(data):
+            n = rnd.randint(0, 40)
+            out.append(dump.feed(data[pos:pos + n]))
+            pos += n
+        out.append(dump.flush())
+        assert ''.join(out) == expected
+    assert HexDumpFormatter().format_row(b'Hello World\r\n', 0x10) == \
+        '00000010  48 65 6c 6c 6f 20 57 6f  72 6c 64 0d 0a           |Hello World..|'
+    if os.path.exists('/usr/bin/hexdump'):
+        # 和 hexdump -C 的输出比较（hexdump 最后还有一行总长度）
+        import subprocess
+        out = subprocess.run(['hexdump', '-C', '-v'], input=data, capture_output=True).stdout.decode('ascii')
+        assert out.splitlines()[:-1] == HexDumpFormatter().format_text(data).splitlines()
+
+
+def _benchmark(size=64 * 1024 * 1024, chunk=64 * 1024):
+    import os
+    import time
+    data = os.urandom(size)
+    dump = HexDump()
+    start = time.perf_counter()
+    for pos in range(0, size, chunk):
+        dump.feed(data[pos:pos + chunk])
+    elapsed = time.perf_counter() - start
+    print('整块格式化：{:.0f} MB 用时 {:.2f} 秒，{:.1f} MB/s'.format(size / 1e6, elapsed, size / elapsed / 1e6))
+    # 界面上一行一行地格式化（只格式化看得见的行）
+    formatter = HexDumpFormatter()
+    rows = 100000
+    start = time.perf_counter()
+    for i in range(rows):
+        formatter.format_row(data[i * 16:i * 16 + 16], i * 16)
+    elapsed = time.perf_counter() - start
+    print('一行一行格式化：{:.2f} 微秒/行，{:.1f} MB/s'.format(elapsed / rows * 1e6, rows * 16 / elapsed / 1e6))
+    # 以前的做法
+    start = time.perf_counter()
+    for pos in range(0, size, chunk):
+        data[pos:pos + chunk].hex(' ') + ' '
+    elapsed = time.perf_counter() - start
+    print('hex(\' \')：{:.1f} MB/s'.format(size / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    _self_test()
+    _benchmark()
@@ -0,0 +1,248 @@
+# 请求应答的延迟测量
+# LatencyProbe 挂到 SerialReader.taps 上，SerialSession.write() 发送的数据和接收线程收到的数据都交给 write()，
+# 时间戳都是 perf_counter_ns（发送是开始写串口之前，接收是读到这块数据的时候）。
+# 每次发送开始一个交易，两种配对的方法：
+#   first：发送以后收到的第一块数据就是应答，延迟算到应答的第一个字节（按照波特率从最后一个字节往前推）
+#   pattern：发送以后收到的数据里边出现了 pattern 才算应答，中间的其他数据不算，延迟算到 pattern 的最后一个字节
+# 超过 timeout 还没有应答算超时；上一个交易还没有应答又发送了，上一个也算超时。
+# 应答不可能比请求发送完还早，往前推过头了（时间戳不准或者波特率不对）就算到请求发送完，记到 clamped 里边。
+# 延迟记到 stats.Histogram 里边（对数分桶，相对误差不超过 1/16），最近的交易保存下来，可以导出成 csv 和 json。
+
+import csv
+import json
+import threading
+import time
+from collections import deque
+
+from capture import DIR_SEND
+from stats import Histogram
+
+MATCH_FIRST = 'first'
+MATCH_PATTERN = 'pattern'
+MATCHES = (MATCH_FIRST, MATCH_PATTERN)
+
+# 保留最近的多少个交易
+HISTORY = 100000
+
+
+class LatencyProbe:
+    '''测量每次发送到应答的延迟，write() 在发送的线程和接收线程里边调用'''
+    def __init__(self, match=MATCH_FIRST, pattern=b'', timeout=1.0, char_time=0.0, history=HISTORY,
+                 max_buffer=64 * 1024) -> None:
+        if match not in MATCHES:
+            raise ValueError('不支持的配对方法：{}'.format(match))
+        if match == MATCH_PATTERN and not pattern:
+            raise ValueError('按照内容配对的时候 pattern 不能是空的')
+        self.match = match
+        self.pattern = bytes(pattern)
+        self.timeout_ns = int(timeout * 1e9)
+        self.char_time_ns = int(char_time * 1e9) # 一个字节的时间，用来推算一块数据里边每个字节到的时间
+        self.max_buffer = max(max_buffer, 2 * len(self.pattern))
+        self.histogram = Histogram(max_value=max(10.0, timeout * 2))
+        # 最近的交易：(发送的时间 ns, 延迟 ns，超时是 None, 发送的字节数)
+        self.samples = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.matched = threading.Event() # 有应答或者超时了就 set，命令行等应答用
+        self.start_ns = time.perf_counter_ns()
+        self._pending = None # (发送的时间 ns, 发送的字节数)
+        self._buf = bytearray()
+        # 统计信息
+        self.requests = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.unmatched = 0 # 没有等应答的时候收到的数据块
+        self.clamped = 0   # 推算出来的应答时间早于请求发送完，按照请求发送完算的次数
+
+    def write(self, data, direction=None, timestamp_ns=None):
+        # 和录制一样的接口
+        if timestamp_ns is None:
+            timestamp_ns = time.perf_counter_ns()
+        with self.lock:
+            self._expire(timestamp_ns)
+            if direction == DIR_SEND:
+                if self._pending is not None:
+                    self._finish(None)
+                self._pending = (timestamp_ns, len(data))
+                self._buf.clear()
+                self.requests += 1
+                self.matched.clear()
+            elif self._pending is None:
+                self.unmatched += 1
+            elif self.match == MATCH_FIRST:
+                self._finish(timestamp_ns - (len(data) - 1) * self.char_time_ns)
+            else:
+                self._find(data, timestamp_ns)
+
+    def _find(self, data, timestamp_ns):
+        buf = self._buf
+        start = max(0, len(buf) - len(self.pattern) + 1)
+        buf += data
+        pos = buf.find(self.pattern, start)
+        if pos >= 0:
+            # 数据块的最后一个字节是 timestamp_ns 到的，往前推到 pattern 的最后一个字节
+            self._finish(timestamp_ns - (len(buf) - pos - len(self.pattern)) * self.char_time_ns)
+        elif len(buf) > self.max_buffer:
+            del buf[:len(buf) - len(self.pattern) + 1]
+
+    def _finish(self, response_ns):
+        sent_ns, size = self._pending
+        self._pending = None
+        self._buf.clear()
+        if response_ns is None:
+            self.timeouts += 1
+            self.samples.append((sent_ns, None, size))
+        else:
+            earliest_ns = sent_ns + size * self.char_time_ns
+            if response_ns < earliest_ns:
+                self.clamped += 1
+                response_ns = earliest_ns
+            latency_ns = response_ns - sent_ns
+            self.responses += 1
+            self.histogram.record(latency_ns / 1e9)
+            self.samples.append((sent_ns, latency_ns, size))
+        self.matched.set()
+
+    def _expire(self, now_ns):
+        if self._pending is not None and now_ns - self._pending[0] > self.timeout_ns:
+            self._finish(None)
+
+    def expire(self):
+        '''检查等应答是不是超时了，界面和命令行定时调用'''
+        with self.lock:
+            self._expire(time.perf_counter_ns())
+
+    def reset(self):
+        with self.lock:
+            self.histogram.reset()
+            self.samples.clear()
+            self._pending = None
+            self._buf.clear()
+            self.requests = self.responses = self.timeouts = self.unmatched = self.clamped = 0
+            self.start_ns = time.perf_counter_ns()
+
+    def stats(self) -> dict:
+        with self.lock:
+            h = self.histogram
+            return {
+                'requests': self.requests,
+                'responses': self.responses,
+                'timeouts': self.timeouts,
+                'unmatched': self.unmatched,
+                'clamped': self.clamped,
+                'min': h.min or 0.0,
+                'mean': h.mean(),
+                'p50': h.percentile(50),
+                'p95': h.percentile(95),
+                'p99': h.percentile(99),
+                'max': h.max or 0.0,
+            }
+
+    def format(self) -> str:
+        return '请求 {requests}，应答 {responses}（早于请求发送完 {clamped}），超时 {timeouts}，p50 {p50_ms:.3f}，p95 {p95_ms:.3f}，' \
+               'p99 {p99_ms:.3f}，最大 {max_ms:.3f} ms'.format(**self._stats_ms())
+
+    def _stats_ms(self):
+        stats = self.stats()
+        for key in ('min', 'mean', 'p50', 'p95', 'p99', 'max'):
+            stats[key + '_ms'] = stats[key] * 1000
+        return stats
+
+    def export_csv(self, path):
+        '''每个交易一行：序号,发送时间(秒，从开始测量算起),延迟(ms，超时是空的),发送的字节数'''
+        with self.lock:
+            samples = list(self.samples)
+            start_ns = self.start_ns
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['index', 'time', 'latency_ms', 'request_bytes'])
+            for i, (sent_ns, latency_ns, size) in enumerate(samples):
+                writer.writerow([i, '{:.6f}'.format((sent_ns - start_ns) / 1e9),
+                                 '' if latency_ns is None else '{:.3f}'.format(latency_ns / 1e6), size])
+
+    def export_json(self, path):
+        '''统计信息、直方图的桶和每个交易，时间都是秒'''
+        stats = self.stats()
+        with self.lock:
+            samples = list(self.samples)
+            start_ns = self.start_ns
+            buckets = self.histogram.items()
+        data = {
+            'match': self.match,
+            'pattern': self.pattern.hex(' '),
+            'timeout': self.timeout_ns / 1e9,
+            'stats': stats,
+            'histogram': [{'lower': lower, 'upper': upper, 'count': n} for lower, upper, n in buckets],
+            'samples': [{'time': (sent_ns - start_ns) / 1e9,
+                         'latency': None if latency_ns is None else latency_ns / 1e9,
+                         'request_bytes': size} for sent_ns, latency_ns, size in samples],
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+
+
+def _test():
+    from capture import DIR_RECV
+    # first：第一块数据就是应答，按照波特率往前推到第一个字节
+    probe = LatencyProbe(char_time=0.0001)
+    probe.write(b'\x01\x03', DIR_SEND, 1000000)
+    probe.write(b'\x01\x83\x02\xc0\xf1', DIR_RECV, 3000000)
+    probe.write(b'xx', DIR_RECV, 4000000) # 没有在等应答
+    assert probe.samples[-1] == (1000000, 1600000, 2) and probe.unmatched == 1
+    # 往前推到了请求发送完之前：按照请求发送完算，记下来
+    probe.write(b'\x01\x03', DIR_SEND, 5000000)
+    probe.write(bytes(20), DIR_RECV, 6000000)
+    assert probe.samples[-1] == (5000000, 200000, 2) and probe.clamped == 1
+    # pattern：中间的数据不算，跨两块数据的 pattern 也能找到
+    probe = LatencyProbe(MATCH_PATTERN, b'OK\r\n', timeout=0.01)
+    probe.write(b'AT\r\n', DIR_SEND, 0)
+    probe.write(b'AT\r\nO', DIR_RECV, 1000000)
+    assert probe.responses == 0
+    probe.write(b'K\r\n', DIR_RECV, 2000000)
+    assert probe.samples[-1] == (0, 2000000, 4)
+    # 超时：没有应答又发送了，以及超过 timeout 以后收到的
+    probe.write(b'AT\r\n', DIR_SEND, 3000000)
+    probe.write(b'AT\r\n', DIR_SEND, 4000000)
+    probe.write(b'OK\r\n', DIR_RECV, 20000000)
+    assert (probe.requests, probe.responses, probe.timeouts, probe.unmatched) == (3, 1, 2, 1)
+    # 缓冲区不会一直变大
+    probe = LatencyProbe(MATCH_PATTERN, b'\x7e\x7e', max_buffer=16)
+    probe.write(b'?', DIR_SEND, 0)
+    for i in range(100):
+        probe.write(b'0123456789', DIR_RECV, i)
+    assert len(probe._buf) <= 16 + 10
+    probe.write(b'~', DIR_RECV, 200)
+    probe.write(b'~', DIR_RECV, 300)
+    assert probe.samples[-1] == (0, 300, 1)
+
+
+def _benchmark(count=2000):
+    # loop:// 上发送以后自己收到，测量的就是接收线程的延迟（没有真的传输，所以不按照波特率往前推，
+    # 按照波特率推的话几乎都比请求发送完还早）；
+    # 也看看每次 write() 多花的时间
+    import os
+    import tempfile
+    from serial_session import SerialSession
+    with SerialSession('loop://', baudrate=115200) as session:
+        probe = LatencyProbe(timeout=0.5)
+        session.reader.taps = [probe]
+        for _ in range(count):
+            session.write(b'\x01\x03\x00\x00\x00\x01\x84\x0a')
+            probe.matched.wait(0.5)
+            session.read()
+        print('loop://：' + probe.format())
+        print('  ' + probe.histogram.format())
+        t = time.perf_counter()
+        for _ in range(count):
+            probe.write(b'12345678', DIR_SEND)
+        print('write() 一次 {:.2f} 微秒'.format((time.perf_counter() - t) / count * 1e6))
+    with tempfile.TemporaryDirectory() as tmp:
+        probe.export_csv(os.path.join(tmp, 'latency.csv'))
+        probe.export_json(os.path.join(tmp, 'latency.json'))
+        with open(os.path.join(tmp, 'latency.json'), encoding='utf-8') as f:
+            data = json.load(f)
+        assert data['stats']['responses'] == probe.responses and len(data['samples']) == len(probe.samples)
+
+
+if __name__ == '__main__':
+    _test()
+    _benchmark()
@@ -0,0 +1,86 @@
+# 延迟测量的窗口
+# 上边是 p50/p95/p99/最大，下边是延迟的直方图，定时从 LatencyProbe 里边取，配对在发送和接收线程里边做。
+
+from PySide6.QtCore import QTimer, Signal
+from PySide6.QtGui import QFontDatabase
+from PySide6.QtWidgets import QWidget, QPlainTextEdit, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QFileDialog, \
+    QMessageBox
+
+# 刷新的间隔，ms
+REFRESH_INTERVAL = 500
+
+
+class LatencyView(QWidget):
+    '''显示延迟测量的结果，关闭窗口的时候发 closed 信号'''
+    closed = Signal()
+
+    def __init__(self, probe, parent=None) -> None:
+        super().__init__(parent)
+        self.setWindowTitle('延迟测量')
+        self.resize(600, 500)
+        self.probe = probe
+        self.lbl_count = QLabel(self)
+        self.lbl_latency = QLabel(self)
+        font = self.lbl_latency.font()
+        font.setPointSize(font.pointSize() * 3 // 2)
+        self.lbl_latency.setFont(font)
+        self.txt_histogram = QPlainTextEdit(self)
+        self.txt_histogram.setReadOnly(True)
+        self.txt_histogram.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        buttons = QHBoxLayout()
+        for text, slot in (('清零', self.reset), ('导出CSV...', self.exportCsv), ('导出JSON...', self.exportJson)):
+            button = QPushButton(text, self)
+            button.clicked.connect(slot)
+            buttons.addWidget(button)
+        buttons.addStretch(1)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.lbl_count)
+        layout.addWidget(self.lbl_latency)
+        layout.addWidget(self.txt_histogram, 1)
+        layout.addLayout(buttons)
+        self.last_count = None
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(REFRESH_INTERVAL)
+        self.refresh()
+
+    def refresh(self):
+        probe = self.probe
+        probe.expire()
+        stats = probe.stats()
+        match = '第一次接收' if probe.pattern == b'' else '匹配 {}'.format(probe.pattern.hex(' '))
+        self.lbl_count.setText('配对：{}，请求 {requests}，应答 {responses}（早于请求发送完 {clamped}），超时 {timeouts}，'
+                               '没有请求的接收 {unmatched}'.format(
+            match, **stats))
+        self.lbl_latency.setText('p50 {:.3f}   p95 {:.3f}   p99 {:.3f}   最大 {:.3f} ms'.format(
+            stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000, stats['max'] * 1000))
+        if stats['responses'] != self.last_count:
+            # 有新的应答才刷新直方图
+            self.last_count = stats['responses']
+            with probe.lock:
+                lines = probe.histogram.bars()
+            self.txt_histogram.setPlainText('\n'.join(lines))
+
+    def reset(self):
+        self.probe.reset()
+        self.refresh()
+
+    def exportCsv(self):
+        self.export('导出延迟', 'csv (*.csv)', self.probe.export_csv)
+
+    def exportJson(self):
+        self.export('导出延迟', 'json (*.json)', self.probe.export_json)
+
+    def export(self, title, filter, save):
+        file_path, _ = QFileDialog.getSaveFileName(self, title, '', filter)
+        if not file_path:
+            return
+        try:
+            save(file_path)
+        except OSError as err:
+            QMessageBox.critical(self, '', '保存失败：{}'.format(err))
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.closed.emit()
+        super().closeEvent(event)
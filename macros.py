@@ -0,0 +1,345 @@
+# 发送宏和自动发送序列
+# 宏是一条有名字的发送内容，加载的时候就转成字节（需要的话加上 modbus 的 CRC），发送的时候不再解析。
+# 每个宏有自己的周期、第一次发送之前的延迟和发送次数，序列在自己的线程里边按照截止时间调度：
+#   到期时间按照周期累加，不会越来越慢；晚了一整个周期以上的跳过错过的那几次。
+#   等待的时候先用 Event.wait() 睡到到期之前 SPIN_TIME，剩下的一小段用 perf_counter 循环等待，
+#   这样 1ms 的周期也比较准（Windows 的 sleep 精度大概 15.6ms，所以循环等待的时间长一些）。
+# 每次发送的实际时间和到期时间的差记到直方图里边（抖动）。
+# 宏文件的格式（csv，#开头的行是注释）：
+#   名称,模式,内容,CRC,周期(ms),延迟(ms),次数
+#   读温度,hex,01 03 00 00 00 01,crc,1000,0,0
+# 模式是 hex、text、doublebyte；CRC 写 crc 表示在后边加上 modbus 的 CRC16；
+# 周期是 0 表示只发送一次；次数是 0 表示一直发送。text 模式的内容可以用 \r、\n、\x00 这样的转义。
+# PeriodicSender 是界面上的自动发送：一段数据按照固定的周期一直发送，到期时间对齐到开始时间 + n * 周期，
+# 晚了的时候按照策略跳过错过的次数或者连续补发，记录每次实际发送的时间和相邻两次的间隔。
+
+import codecs
+import csv
+import heapq
+from collections import deque
+import sys
+import threading
+import time
+
+from codec import MODES, MODE_HEX, MODE_TEXT, encode
+from modbus_crc import append_crc
+from stats import Histogram
+
+SPIN_TIME = 0.02 if sys.platform == 'win32' else 0.002
+
+# 自动发送晚了一个周期以上的时候怎么办
+POLICY_SKIP = 'skip'   # 跳过错过的次数，下一次还是对齐到原来的时间点
+POLICY_BURST = 'burst' # 连续补发错过的次数（最多 max_burst 次），总次数和时间对得上
+POLICIES = (POLICY_SKIP, POLICY_BURST)
+
+
+def wait_until(deadline, stop_event, spin=SPIN_TIME) -> bool:
+    '''等到 deadline（perf_counter 的时间），中途停止返回 False'''
+    remaining = deadline - time.perf_counter()
+    if remaining > spin:
+        if stop_event.wait(remaining - spin):
+            return False
+    while time.perf_counter() < deadline:
+        time.sleep(0) # 让出 GIL，接收线程不会被卡住
+    return not stop_event.is_set()
+
+
+class Macro:
+    '''一条发送宏，data 是已经转好的字节'''
+    def __init__(self, name, text, mode=MODE_HEX, crc=False, period=0.0, delay=0.0, repeat=0, encoding='utf-8') -> None:
+        if mode not in MODES:
+            raise ValueError('不支持的模式：{}'.format(mode))
+        self.name = name
+        self.text = text
+        self.mode = mode
+        self.crc = crc
+        self.period = period # 秒，0 表示只发送一次
+        self.delay = delay   # 第一次发送之前等待的秒数
+        self.repeat = repeat if period else 1 # 0 表示一直发送
+        if mode == MODE_TEXT:
+            data = codecs.escape_decode(encode(text, mode, encoding))[0]
+        else:
+            data = encode(text, mode, encoding)
+        self.data = append_crc(data) if crc else bytes(data)
+        # 统计信息
+        self.sent = 0
+        self.late = 0 # 晚了跳过的次数
+        self.jitter = Histogram(max_value=10.0)
+
+    def reset(self):
+        self.sent = 0
+        self.late = 0
+        self.jitter.reset()
+
+    def __repr__(self):
+        return 'Macro({!r}, {}, {} 字节, {})'.format(self.name, self.mode, len(self.data), self.period)
+
+
+def load_macros(path, encoding='utf-8') -> list:
+    '''读取宏文件，encoding 是 text 模式的内容发送的编码'''
+    macros = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            row = [i.strip() for i in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if len(row) < 3:
+                raise ValueError('宏文件格式不对：{}'.format(','.join(row)))
+            row += [''] * (7 - len(row))
+            macros.append(Macro(row[0], row[2], row[1] or MODE_HEX, row[3].lower() in ('crc', '1', 'y', 'yes'),
+                                float(row[4] or 0) / 1000, float(row[5] or 0) / 1000, int(row[6] or 0), encoding))
+    return macros
+
+
+class MacroSequencer:
+    '''按照各自的周期发送一组宏，在自己的线程里边执行；所有的宏都发完了线程就结束。
+    clock 和 wait 和 PeriodicSender 的一样，测试的时候用假的时间'''
+    def __init__(self, session, macros, spin=SPIN_TIME, on_send=None, clock=time.perf_counter, wait=wait_until) -> None:
+        self.session = session
+        self.macros = list(macros)
+        self.spin = spin
+        self.clock = clock
+        self.wait = wait
+        self.on_send = on_send # 每次发送以后在发送线程里边调用，参数是 (macro, 发送的时间)
+        self.error = None
+        self.start_time = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        for macro in self.macros:
+            macro.reset()
+        self._thread = threading.Thread(target=self.run, name='MacroSequencer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join(1.0)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self):
+        write = self.session.write
+        clock = self.clock
+        now = clock()
+        self.start_time = now
+        # (到期时间, 序号, 宏)，序号保证到期时间一样的时候按照顺序
+        heap = [(now + macro.delay, i, macro) for i, macro in enumerate(self.macros)]
+        heapq.heapify(heap)
+        try:
+            while heap:
+                due, i, macro = heap[0]
+                if not self.wait(due, self._stop, self.spin):
+                    break
+                now = clock()
+                if macro.period:
+                    # 晚了一个周期以上：跳过错过的时间点，还是对齐到原来的相位
+                    missed = int((now - due) / macro.period)
+                    if missed > 0:
+                        due += missed * macro.period
+                        macro.late += missed
+                write(macro.data)
+                heapq.heappop(heap)
+                macro.jitter.record(now - due)
+                macro.sent += 1
+                if self.on_send is not None:
+                    self.on_send(macro, now)
+                if macro.repeat and macro.sent >= macro.repeat:
+                    continue
+                heapq.heappush(heap, (due + macro.period, i, macro))
+        except OSError as err:
+            self.error = err
+
+    def jitter(self) -> Histogram:
+        '''所有的宏合在一起的抖动'''
+        total = Histogram(max_value=10.0)
+        for macro in self.macros:
+            total.merge(macro.jitter)
+        return total
+
+    def stats(self) -> dict:
+        elapsed = self.clock() - self.start_time if self.start_time is not None else 0.0
+        jitter = self.jitter()
+        return {
+            'macros': len(self.macros),
+            'sent': sum(macro.sent for macro in self.macros),
+            'late': sum(macro.late for macro in self.macros),
+            'elapsed': elapsed,
+            'jitter_p50': jitter.percentile(50),
+            'jitter_p99': jitter.percentile(99),
+            'jitter_max': jitter.max or 0.0,
+        }
+
+
+class PeriodicSender:
+    '''按照固定的周期一直发送同一段数据，在自己的线程里边执行；data 可以在发送的过程中替换。
+    clock 和 wait（参数和 wait_until 一样）可以换掉，测试的时候用假的时间'''
+    def __init__(self, session, data, period, policy=POLICY_SKIP, max_burst=100, count=0, spin=SPIN_TIME,
+                 history=100000, clock=time.perf_counter, wait=wait_until) -> None:
+        if period <= 0:
+            raise ValueError('周期必须大于0')
+        if policy not in POLICIES:
+            raise ValueError('不支持的策略：{}'.format(policy))
+        self.session = session
+        self.data = bytes(data)
+        self.period = period
+        self.policy = policy
+        self.max_burst = max_burst
+        self.count = count # 0 表示一直发送
+        self.spin = spin
+        self.clock = clock
+        self.wait = wait
+        self.timestamps = deque(maxlen=history) # 最近的实际发送时间（perf_counter）
+        self.intervals = Histogram(max_value=max(10.0, period * 10))
+        self.jitter = Histogram(max_value=10.0)
+        self.sent = 0
+        self.skipped = 0 # 跳过的次数
+        self.bursts = 0  # 补发的次数
+        self.error = None
+        self.start_time = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='PeriodicSender', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join(1.0)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self):
+        write = self.session.write
+        clock = self.clock
+        period = self.period
+        self.start_time = due = clock()
+        last = None
+        try:
+            while not self.count or self.sent < self.count:
+                if not self.wait(due, self._stop, self.spin):
+                    break
+                now = clock()
+                # 晚了一个周期以上：跳过错过的时间点，或者按照原来的时间点连续补发，都不改变时间点的相位
+                missed = int((now - due) / period)
+                if missed > 0:
+                    if self.policy == POLICY_SKIP or missed > self.max_burst:
+                        due += missed * period
+                        self.skipped += missed
+                    else:
+                        self.bursts += 1
+                write(self.data)
+                self.jitter.record(now - due)
+                if last is not None:
+                    self.intervals.record(now - last)
+                last = now
+                self.timestamps.append(now)
+                self.sent += 1
+                due += period
+        except OSError as err:
+            self.error = err
+
+    def stats(self) -> dict:
+        elapsed = self.clock() - self.start_time if self.start_time is not None else 0.0
+        return {
+            'sent': self.sent,
+            'skipped': self.skipped,
+            'bursts': self.bursts,
+            'elapsed': elapsed,
+            'rate': self.sent / elapsed if elapsed else 0.0,
+            'period_p50': self.intervals.percentile(50),
+            'period_p99': self.intervals.percentile(99),
+            'period_max': self.intervals.max or 0.0,
+            'jitter_p99': self.jitter.percentile(99),
+        }
+
+    def save_timestamps(self, path):
+        '''保存最近的发送时间，csv：序号,距离开始的秒数,和上一次的间隔'''
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['index', 'time', 'interval'])
+            first = self.sent - len(self.timestamps)
+            last = None
+            for i, t in enumerate(list(self.timestamps)):
+                writer.writerow([first + i, '{:.6f}'.format(t - self.start_time),
+                                 '' if last is None else '{:.6f}'.format(t - last)])
+                last = t
+
+
+def _benchmark(seconds=3.0):
+    # 1ms 周期发送到 loop://，看实际的次数和抖动，再和只用 Event.wait() 的比较
+    # （loop:// 的缓冲区满了写会卡住，所以要用 SerialSession 的接收线程把数据读掉）
+    from serial_session import SerialSession
+    with SerialSession('loop://', baudrate=115200) as session:
+        for name, spin in (('循环等待', SPIN_TIME), ('只用 sleep', 0.0)):
+            macros = [
+                Macro('1ms', '01 03 00 00 00 01', crc=True, period=0.001),
+                Macro('10ms', 'AT\\r\\n', mode=MODE_TEXT, period=0.010, delay=0.0005),
+                Macro('三次', '02', period=0.5, repeat=3),
+            ]
+            assert macros[0].data == bytes.fromhex('01 03 00 00 00 01 84 0a') and macros[1].data == b'AT\r\n'
+            sequencer = MacroSequencer(session, macros, spin=spin).start()
+            time.sleep(seconds)
+            sequencer.stop()
+            session.read()
+            stats = sequencer.stats()
+            print('{}：一共发送 {} 次，1ms 的发送 {} 次（应该是 {} 次），跳过 {} 次'.format(
+                name, stats['sent'], macros[0].sent, int(seconds / 0.001), stats['late']))
+            print('  抖动：' + sequencer.jitter().format())
+            assert macros[2].sent == 3
+        # 自动发送：1ms 周期，两种补发的策略
+        for policy in POLICIES:
+            sender = PeriodicSender(session, b'\x55' * 8, 0.001, policy).start()
+            time.sleep(seconds)
+            sender.stop()
+            session.read()
+            stats = sender.stats()
+            print('自动发送 {}：{} 次（应该是 {} 次），跳过 {} 次，补发 {} 次'.format(
+                policy, stats['sent'], int(stats['elapsed'] / 0.001) + 1, stats['skipped'], stats['bursts']))
+            print('  周期：' + sender.intervals.format())
+    # 错过的时间点：跳过以后还是对齐到原来的相位，补发的总次数对得上。
+    # 用假的时间，第三次发送花了 35ms（10ms 的周期），到 95ms 的时候停
+    class Clock:
+        def __init__(self):
+            self.now = 0.0
+        def __call__(self):
+            return self.now
+        def wait(self, deadline, stop_event, spin):
+            self.now = max(self.now, deadline)
+            return self.now < 0.095
+    class Slow:
+        def __init__(self, clock):
+            self.clock = clock
+            self.calls = 0
+        def write(self, data):
+            self.calls += 1
+            if self.calls == 3:
+                self.clock.now += 0.035
+    for policy, expected in ((POLICY_SKIP, [0, 10, 20, 55, 60, 70, 80, 90]),
+                             (POLICY_BURST, [0, 10, 20, 55, 55, 55, 60, 70, 80, 90])):
+        clock = Clock()
+        sender = PeriodicSender(Slow(clock), b'x', 0.010, policy, clock=clock, wait=clock.wait)
+        sender.run()
+        assert [round(t * 1000) for t in sender.timestamps] == expected, (policy, list(sender.timestamps))
+        assert (sender.skipped, sender.bursts) == ((2, 0) if policy == POLICY_SKIP else (0, 2)), policy
+    # 宏序列也一样：跳过错过的时间点，late 是跳过的次数
+    clock = Clock()
+    macro = Macro('10ms', '01', period=0.010)
+    sent = []
+    sequencer = MacroSequencer(Slow(clock), [macro], on_send=lambda m, t: sent.append(round(t * 1000)),
+                               clock=clock, wait=clock.wait)
+    sequencer.run()
+    assert sent == [0, 10, 20, 55, 60, 70, 80, 90] and macro.late == 2, (sent, macro.late)
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -1,17 +1,39 @@
 from MainWindow import Ui_MainWindow
-from PySide6.QtGui import QTextCursor
-from PySide6.QtWidgets import QMainWindow, QApplication, QFileDialog, QMessageBox
+from PySide6.QtWidgets import QMainWindow, QApplication, QFileDialog, QMessageBox, QHBoxLayout, QLabel, QLineEdit, QComboBox, QCheckBox, QInputDialog, QProgressDialog
 from PySide6.QtCore import QTimer
+from PySide6.QtGui import QAction, QActionGroup
 from PySide6 import QtCore
 import sys
 from PySide6.QtUiTools import QUiLoader
-import serial
 import serial.tools.list_ports
 import pyperclip
 import os
-import datetime
 import time
+import threading
 from modbus_crc import modbus_crc
+from serial_session import SerialSession, lst_baudrate, dict_bytesize, dict_parity, dict_stopbits, char_time, silent_interval
+from codec import MODE_HEX, MODE_TEXT, MODE_DOUBLEBYTE, ENCODINGS, encode
+from framing import FRAMINGS, make_framer
+from recv_log import RecvLog, FLAG_SEND, FLAG_TIME, FLAG_HEX, FLAG_DUMP
+from recv_view import RecvLogView
+from recv_path import ReceivePath
+from recv_render import RenderPipeline
+from capture import CaptureWriter, compression_from_path
+from capture_view import CaptureViewer
+from modbus_rtu import ModbusMaster, SessionTransport, ModbusError, function_names, read_functions, write_functions, \
+    READ_COILS, READ_DISCRETE_INPUTS, WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_COILS
+from modbus_poll import PollItem, PollScheduler, load_poll_table
+from modbus_slave import open_slave
+from modbus_gateway import Gateway
+from modbus_sniffer import ModbusSniffer
+from modbus_sniffer_view import SnifferView
+from file_sender import FileSender, FLOWS, PROTOCOLS, PROTOCOL_RAW, make_sender, make_receiver
+from latency import LatencyProbe, MATCH_FIRST, MATCH_PATTERN
+from latency_view import LatencyView
+from metrics import REGISTRY, MetricsServer
+from diagnostics_view import DiagnosticsView
+from macros import MacroSequencer, PeriodicSender, POLICY_BURST, POLICY_SKIP, load_macros
+from modbus_decode import BYTE_ORDERS, decode as decode_registers, encode as encode_registers, parse_values, registers_per_value
 
 import logging
 logger = logging.getLogger(__name__)
@@ -25,34 +47,15 @@ console.setLevel(logging.INFO)
 logger.addHandler(handler)
 logger.addHandler(console)
 
-# 波特率纯数字
-lst_baudrate = [str(i) for i in [600, 1200, 2400, 4800, 9600, 19200, 38400, 56000, 57600, 115200]] # 常用的波特率
-# 数据位，一个字典
-dict_bytesize = {
-    '5':serial.FIVEBITS, 
-    '6':serial.SIXBITS, 
-    '7':serial.SEVENBITS, 
-    '8':serial.EIGHTBITS
-    }
-# 校验，也是一个字典。
-dict_parity = {
-    '无校验':serial.PARITY_NONE, 
-    '奇校验':serial.PARITY_ODD, 
-    '偶校验':serial.PARITY_EVEN,
-    'PARITY_MARK':serial.PARITY_MARK, 
-    'PARITY_SPACE':serial.PARITY_SPACE
-}
-# 停止位，也是一个字典。
-dict_stopbits = {
-    '1':serial.STOPBITS_ONE,
-    '1.5':serial.STOPBITS_ONE_POINT_FIVE,
-    '2':serial.STOPBITS_TWO
-}
-
-# modbus的数据类型
+# modbus的数据类型，界面上的名字 -> modbus_decode 的数据类型
 modbus_data_style = {
-    ''
-
+    '16位无符号': 'uint16',
+    '16位有符号': 'int16',
+    '32位无符号': 'uint32',
+    '32位有符号': 'int32',
+    '64位有符号': 'int64',
+    '32位浮点': 'float32',
+    '64位浮点': 'float64',
 }
 
 
@@ -64,9 +67,56 @@ key_stopbits = "停止位"
 
 # 接收的定时器的计时器。
 receive_timer_interval = 100
+# 默认的分帧：空闲超过 2 * receive_timer_interval ms 就换行
+recv_framing = 'idle:{}'.format(2 * receive_timer_interval / 1000)
+# 文本和双字节模式默认的编码
+text_encoding = 'utf-8'
+# 十六进制默认是否显示成转储的格式
+recv_hex_dump = False
+# 界面每次从接收缓冲区取的最多字节数，剩下的下次事件循环再取，避免界面卡住。
+receive_batch_size = 64 * 1024
+# 接收区最多保留的字节数和行数，超过了以后丢弃最早的数据。
+recv_log_max_bytes = 32 * 1024 * 1024
+recv_log_max_lines = 1000000
+# 接收区每秒最多刷新的次数，以及每秒最多显示的字节数（超过了只显示汇总）。
+render_max_fps = 20
+render_max_display_rate = 200000
+# 录制文件按照大小和时间分割，0表示不分割。
+record_rotate_bytes = 256 * 1024 * 1024
+record_rotate_seconds = 0
+# modbus 等待应答的时间（秒）和重试次数
+modbus_timeout = 1.0
+modbus_retries = 2
+# modbus 网关默认监听的端口，以及读请求缓存的时间（秒）
+modbus_gateway_port = 502
+modbus_gateway_cache_ttl = 0.0
+# 循环轮询的时候刷新结果的间隔，ms；地址中间空着不超过几个寄存器的也合并成一个请求（0 是只合并相邻的）
+modbus_poll_display_interval = 500
+modbus_poll_max_gap = 0
+# 发送文件默认的协议（raw、xmodem、xmodem-1k、ymodem、ymodem-g、zmodem）
+file_protocol = 'raw'
+# 直接发送文件默认的流控（none、rtscts、xonxoff）和每块之间的间隔（秒），以及刷新进度的间隔，ms
+send_file_flow = 'none'
+send_file_pace = 0.0
+send_file_progress_interval = 200
+# 宏序列运行的时候刷新状态栏的间隔，ms
+macro_display_interval = 500
+# 自动发送晚了一个周期以上的时候跳过（skip）还是补发（burst）；周期短于这个秒数的时候发送的数据不显示在接收区
+auto_send_policy = 'skip'
+auto_send_echo_min_period = 0.1
+# 延迟测量等应答的时间（秒）
+latency_timeout = 1.0
+# Prometheus 指标默认的端口（只监听本机），以及检查界面事件循环延迟的间隔，ms
+metrics_port = 9100
+event_loop_probe_interval = 100
 
 class MainWindow(QMainWindow):
     '''这个是主窗口'''
+    # 接收线程有新数据的时候发出这个信号，跨线程自动排队到界面线程。
+    data_ready = QtCore.Signal()
+    # modbus 的请求在后台线程里边执行，完成以后发这个信号，参数是 (读还是写, 结果或者异常)
+    modbus_done = QtCore.Signal(object)
+
     def __init__(self) -> None:
         super().__init__()
         # 这里调用的是窗口的ui界面
@@ -94,17 +144,20 @@ class MainWindow(QMainWindow):
 
         return result
     
-    def show_state(self, msg):
-        # 显示当前的状态
+    def show_state(self, msg=None):
+        # 显示当前的状态，msg 是空的时候只更新刷新的统计信息
+        if msg is not None:
+            self.state_msg = msg
         self.ui.lbl_state.setText(
-            "串口状态：{} , {}".format(
-            "打开" if self.serial is not None and self.serial.isOpen() else "关闭",
-            msg)
+            "串口状态：{} , {} | {}".format(
+            "打开" if self.session is not None and self.session.is_open() else "关闭",
+            self.state_msg, self.render.status())
         )
 
     # 如下的几个函数是对log日志的包装，同时也发到界面上。
     def log_error(self, msg):
         logger.error(msg)
+        self.metric_errors.inc()
         self.show_state(msg)
     
     def log_info(self, msg):
@@ -134,24 +187,173 @@ class MainWindow(QMainWindow):
         self.ui.radio_send_hex_mode.setChecked(True)
 
         #
-        self.serial = None
-        self.thread_serial_recv = None
+        self.session = None # 打开的串口，后台线程接收
         self.serial_recv_state = False # 线程的状态
         self.serial_state = False # 串口的连接状态
 
+        # 接收区换成只显示看得见的行的列表视图，原来的 txt_recv 隐藏起来。
+        self.recv_log = RecvLog(max_bytes=recv_log_max_bytes, max_lines=recv_log_max_lines)
+        self.recv_view = RecvLogView(self.recv_log, self.ui.groupBox)
+        self.ui.verticalLayout_4.replaceWidget(self.ui.txt_recv, self.recv_view)
+        self.ui.txt_recv.hide()
+        # 接收的数据先放到刷新的管道里边，定时器按照固定的帧率批量显示。
+        self.render = RenderPipeline(self.recv_log, max_fps=render_max_fps, max_display_rate=render_max_display_rate)
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.timeout.connect(self.flushReceive)
+        self.state_msg = ''
+        self.ui.btn_recv_clear.clicked.disconnect()
+        self.ui.btn_recv_clear.clicked.connect(self.clearReceive)
+        self.ui.btn_recv_copy.clicked.disconnect()
+        self.ui.btn_recv_copy.clicked.connect(self.recv_view.copy)
+        self.setupMetrics()
+
+        # 录制的菜单
+        self.recorder = None
+        menu_record = self.ui.menubar.addMenu('录制')
+        self.action_record_start = menu_record.addAction('开始录制...')
+        self.action_record_start.triggered.connect(self.startRecord)
+        self.action_record_stop = menu_record.addAction('停止录制')
+        self.action_record_stop.triggered.connect(self.stopRecord)
+        self.action_record_stop.setEnabled(False)
+        menu_record.addSeparator()
+        menu_record.addAction('打开录制文件...').triggered.connect(self.openCapture)
+        self.capture_viewers = [] # 打开的录制文件窗口
+
+        # 分帧的菜单，接收的数据按照帧显示，每一帧一行
+        menu_framing = self.ui.menubar.addMenu('分帧')
+        self.framing_group = QActionGroup(self)
+        for name, (label, hint) in FRAMINGS.items():
+            action = menu_framing.addAction(label + ('...' if hint else ''))
+            action.setCheckable(True)
+            action.setData(name)
+            action.setChecked(recv_framing.startswith(name + ':') or recv_framing == name)
+            self.framing_group.addAction(action)
+        self.framing_group.triggered.connect(self.selectFraming)
+        # 文本和双字节模式的编码，收发都用
+        menu_encoding = self.ui.menubar.addMenu('编码')
+        self.encoding_group = QActionGroup(self)
+        for encoding in ENCODINGS:
+            action = menu_encoding.addAction(encoding)
+            action.setCheckable(True)
+            action.setChecked(encoding == text_encoding)
+            self.encoding_group.addAction(action)
+        self.encoding_group.triggered.connect(self.selectEncoding)
+        self.text_encoding = text_encoding
+        # 十六进制显示成转储的格式：偏移、十六进制、可见字符，每行16个字节，只对以后的数据起作用
+        menu_view = self.ui.menubar.addMenu('显示')
+        self.action_hex_dump = menu_view.addAction('十六进制转储')
+        self.action_hex_dump.setCheckable(True)
+        self.action_hex_dump.setChecked(recv_hex_dump)
+        # 延迟测量：每次发送到应答的时间，在单独的窗口里边显示
+        self.latency_probe = None
+        self.latency_view = None
+        self.action_latency = menu_view.addAction('延迟测量...')
+        self.action_latency.setCheckable(True)
+        self.action_latency.triggered.connect(self.toggleLatency)
+        # 文件传输的协议，发送文件按钮和接收文件都用
+        menu_transfer = self.ui.menubar.addMenu('文件传输')
+        self.protocol_group = QActionGroup(self)
+        for protocol in PROTOCOLS:
+            action = menu_transfer.addAction('直接发送' if protocol == PROTOCOL_RAW else protocol.upper())
+            action.setCheckable(True)
+            action.setData(protocol)
+            action.setChecked(protocol == file_protocol)
+            self.protocol_group.addAction(action)
+        self.protocol_group.triggered.connect(self.selectProtocol)
+        self.file_protocol = file_protocol
+        menu_transfer.addSeparator()
+        menu_transfer.addAction('发送文件...').triggered.connect(self.sendFile)
+        menu_transfer.addAction('接收文件...').triggered.connect(self.receiveFile)
+        # 发送宏：加载宏文件以后按照各自的周期在后台线程里边发送，也可以单独发送一条
+        self.macros = []
+        self.macro_sequencer = None
+        menu_macro = self.ui.menubar.addMenu('宏')
+        menu_macro.addAction('加载宏...').triggered.connect(self.loadMacros)
+        self.action_macro_start = menu_macro.addAction('运行宏序列')
+        self.action_macro_start.triggered.connect(self.startMacros)
+        self.action_macro_start.setEnabled(False)
+        self.action_macro_stop = menu_macro.addAction('停止宏序列')
+        self.action_macro_stop.triggered.connect(self.stopMacros)
+        self.action_macro_stop.setEnabled(False)
+        self.menu_macro_send = menu_macro.addMenu('发送宏')
+        self.menu_macro_send.setEnabled(False)
+        self.menu_macro_send.triggered.connect(self.sendMacro)
+        self.macro_timer = QTimer(self)
+        self.macro_timer.timeout.connect(self.showMacros)
+        menu_macro.addSeparator()
+        self.action_auto_send_burst = menu_macro.addAction('自动发送补发错过的次数')
+        self.action_auto_send_burst.setCheckable(True)
+        self.action_auto_send_burst.setChecked(auto_send_policy == POLICY_BURST)
+        self.recv_framing = recv_framing
+        # 分帧、解码、放到显示队列里边，和 benchmark.py 走同一条路径
+        self.recv_path = ReceivePath(self.render, recv_framing)
+        # 空闲时间分帧的时候，最后一帧要等空闲超时了才能显示
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.flushFrame)
+
+        # modbus 的从站地址和功能码，界面文件里边没有，这里加上
+        self.txt_modbus_read_unit, self.combo_modbus_read_function = self.addModbusRow(self.ui.verticalLayout_6, read_functions)
+        self.txt_modbus_write_unit, self.combo_modbus_write_function = self.addModbusRow(self.ui.verticalLayout_12, write_functions)
+        for combo in (self.ui.combo_modbus_read_data_style, self.ui.combo_modbus_write_data_style):
+            combo.addItems(list(modbus_data_style.keys()))
+        for combo in (self.ui.combo_modbus_read_byte_sort, self.ui.combo_modbus_write_byte_sort):
+            combo.addItems(BYTE_ORDERS)
+        self.modbus_busy = False # 正在执行 modbus 请求，这个时候接收的数据不显示
+        self.modbus_done.connect(self.modbusDone)
+        # 循环读取：勾上以后读取按钮按照周期一直读，再按一次停止；也可以从菜单加载轮询表
+        self.chk_modbus_poll = QCheckBox('循环(ms):')
+        self.txt_modbus_poll_period = QLineEdit('1000')
+        self.txt_modbus_poll_period.setMaximumWidth(60)
+        self.ui.horizontalLayout_13.insertWidget(0, self.chk_modbus_poll)
+        self.ui.horizontalLayout_13.insertWidget(1, self.txt_modbus_poll_period)
+        self.poll_scheduler = None
+        self.poll_timer = QTimer(self)
+        self.poll_timer.timeout.connect(self.showPoll)
+        menu_modbus = self.ui.menubar.addMenu('Modbus')
+        menu_modbus.addAction('加载轮询表...').triggered.connect(self.loadPollTable)
+        self.action_poll_stop = menu_modbus.addAction('停止轮询')
+        self.action_poll_stop.triggered.connect(self.stopPoll)
+        self.action_poll_stop.setEnabled(False)
+        menu_modbus.addSeparator()
+        # 从站模拟，用当前的串口参数单独打开串口
+        self.modbus_slave = None
+        self.action_slave = menu_modbus.addAction('从站模拟')
+        self.action_slave.setCheckable(True)
+        self.action_slave.triggered.connect(self.toggleSlave)
+        self.slave_timer = QTimer(self)
+        self.slave_timer.timeout.connect(self.showSlave)
+        # TCP网关，转发到打开的串口
+        self.modbus_gateway = None
+        self.action_gateway = menu_modbus.addAction('TCP网关...')
+        self.action_gateway.setCheckable(True)
+        self.action_gateway.triggered.connect(self.toggleGateway)
+        self.gateway_timer = QTimer(self)
+        self.gateway_timer.timeout.connect(self.showGateway)
+        # 总线监听，在接收线程里边解析收到的数据
+        self.modbus_sniffer = None
+        self.sniffer_view = None
+        self.action_sniffer = menu_modbus.addAction('总线监听')
+        self.action_sniffer.setCheckable(True)
+        self.action_sniffer.triggered.connect(self.toggleSniffer)
+
         # 默认关闭按钮是灰色的。
         self.ui.btn_close.setEnabled(False)
 
-        # 定时器
-        # 接收的定时器
-        self.recv_buf = bytearray() 
-        self.recv_timer = QTimer(self)
-        self.recv_timer.timeout.connect(self.serial_recv)
-        self.recv_timer.start(receive_timer_interval) # 直接启动。
-        # 自动发送的定时器
+        # 接收是后台线程，有数据了以后发信号过来。
+        self.data_ready.connect(self.serial_recv)
+        # 发送和接收文件是后台线程，定时刷新进度
+        self.file_transfer = None
+        self.file_progress = None
+        self.file_timer = QTimer(self)
+        self.file_timer.timeout.connect(self.showFileProgress)
+        # 自动发送在后台线程里边按照绝对时间发送，界面上的定时器只刷新统计和显示发送的数据
+        self.periodic_sender = None
+        self.auto_send_shown = 0
         self.auto_send_timer = QTimer(self)
-        self.auto_send_timer.timeout.connect(self.serialSend) # 事件是发送吧。 
-        self.last_recv_time = None     
+        self.auto_send_timer.timeout.connect(self.showAutoSend)
+        self.ui.txt_send.textChanged.connect(self.updateAutoSend)
 
         self.show_state('程序启动完毕')
     
@@ -165,19 +367,90 @@ class MainWindow(QMainWindow):
 
     @QtCore.Slot()
     def autoSend(self):
-        if self.ui.chk_autosend.isChecked():
-            self.auto_send_timer.start(int(self.ui.txt_send_period.text()))
-        else:
-            self.auto_send_timer.stop()
-        pass
+        if not self.ui.chk_autosend.isChecked():
+            self.stopAutoSend()
+            return
+        if self.session is None or not self.session.is_open():
+            self.log_error("串口没有打开，发送失败.")
+            self.ui.chk_autosend.setChecked(False)
+            return
+        try:
+            period = float(self.ui.txt_send_period.text()) / 1000
+            data = encode(self.ui.txt_send.toPlainText(), self.sendMode(), self.text_encoding)
+            policy = POLICY_BURST if self.action_auto_send_burst.isChecked() else POLICY_SKIP
+            self.periodic_sender = PeriodicSender(self.session, data, period, policy).start()
+        except ValueError as err:
+            self.log_error("自动发送错误:{}".format(err))
+            self.ui.chk_autosend.setChecked(False)
+            return
+        self.auto_send_shown = 0
+        self.auto_send_timer.start(max(receive_timer_interval, min(1000, int(period * 1000))))
+        self.log_info('开始自动发送：周期 {:g} ms'.format(period * 1000))
+
+    @QtCore.Slot()
+    def updateAutoSend(self):
+        # 自动发送的过程中修改了发送的内容，下一次就发送新的内容；内容不完整（比如十六进制只输入了一半）的时候还是发送原来的
+        sender = self.periodic_sender
+        if sender is None:
+            return
+        try:
+            sender.data = encode(self.ui.txt_send.toPlainText(), self.sendMode(), self.text_encoding)
+        except ValueError:
+            pass
+
+    @QtCore.Slot()
+    def showAutoSend(self):
+        sender = self.periodic_sender
+        if sender is None:
+            return
+        if sender.error is not None:
+            self.log_error("发送错误:{}".format(sender.error))
+            self.stopAutoSend()
+            return
+        # 周期比较长的时候和原来一样显示每一次发送的数据，太快了只显示统计
+        sent = sender.sent
+        if sender.period >= auto_send_echo_min_period:
+            for _ in range(min(sent - self.auto_send_shown, 10)):
+                self.appendPlainText(self.ui.txt_send.toPlainText(), newline=True, append_time=True, is_receive=False)
+        self.auto_send_shown = sent
+        stats = sender.stats()
+        self.show_state('自动发送：{} 次，跳过 {} 次，补发 {} 次，周期 p50 {:.3f} ms，p99 {:.3f} ms，最大 {:.3f} ms'.format(
+            sent, stats['skipped'], stats['bursts'], stats['period_p50'] * 1000, stats['period_p99'] * 1000,
+            stats['period_max'] * 1000))
+
+    def stopAutoSend(self):
+        sender = self.periodic_sender
+        if sender is None:
+            return
+        self.periodic_sender = None
+        sender.stop()
+        self.auto_send_timer.stop()
+        self.ui.chk_autosend.setChecked(False)
+        self.log_info('自动发送已经停止：{} 次，跳过 {} 次，补发 {} 次'.format(sender.sent, sender.skipped, sender.bursts))
+        if sender.intervals.count:
+            self.log_info('周期：' + sender.intervals.format())
 
     @QtCore.Slot()
     def closeSerial(self):
         # 关闭串口
-        if self.serial is not None:
-            self.serial.close()
+        self.cancelFileTransfer()
+        self.stopAutoSend()
+        self.stopLatency()
+        self.stopMacros()
+        self.stopPoll()
+        self.stopGateway()
+        self.stopSniffer()
+        if self.session is not None:
+            # 先停止接收线程，再关闭串口
+            self.session.close()
+            stats = self.session.stats()
+            logger.info("接收 {bytes_read} 字节，读取 {read_calls} 次，丢弃 {dropped} 字节，缓冲区最多 {high_water} 字节，发送 {bytes_written} 字节".format(**stats))
         self.serial_state = False
-        self.serial = None
+        self.session = None
+        # 收到的数据都显示出来，状态栏上不再显示积压
+        self.render_timer.stop()
+        self.flushReceive()
+        self.render.reset_status()
         self.log_info("关闭串口")
         self.ui.btn_open.setEnabled(True)
         self.ui.btn_close.setEnabled(False)
@@ -188,15 +461,18 @@ class MainWindow(QMainWindow):
         parm = self.getSerialParameter()
         if parm != {}:
             try:
-                self.serial = serial.Serial(
-                    port=parm[key_serial_name],
+                self.session = SerialSession(
+                    parm[key_serial_name],
                     baudrate=parm[key_baudrate],
                     bytesize=parm[key_bytesize],
                     parity=parm[key_parity],
                     stopbits=parm[key_stopbits],
-                    timeout=0 # 读取超时。
+                    on_data=self.data_ready.emit,
+                    recorder=self.recorder
                 )
-                if self.serial.isOpen():
+                if self.session.is_open():
+                    self.recv_path.framer.reset()
+                    self.session.reader.idle_gap = self.recv_path.framer.gap
                     self.log_info('成功打开串口')
                     self.ui.btn_open.setEnabled(False)
                     self.ui.btn_close.setEnabled(True)
@@ -209,54 +485,163 @@ class MainWindow(QMainWindow):
             self.log_error("参数失败")
     
     def serial_recv(self):
-        # 线程接收，用定时器启动的。
+        # 接收线程发信号以后在界面线程里边执行，一次取一批数据。
+        if self.modbus_busy:
+            # modbus 的请求自己取应答
+            return
         try:
-            if self.serial is not None and  self.serial.in_waiting:
-                newline = False # 默认不换行
-                append_time = False # 默认不需要添加时间。
-                if self.last_recv_time is not None:
-                    # 如果存在最后接收的时间，就判断是否超过了阈值
-                    newline = (datetime.datetime.now() - self.last_recv_time).microseconds > 2 * receive_timer_interval
-                    append_time = newline
-                else:
-                    # 换行得看是否有数据，有可能是发送的数据。
-                    newline=len(self.ui.txt_recv.toPlainText()) > 0
-                    # 需要添加时间。
-                    append_time = True
-                self.last_recv_time = datetime.datetime.now()
-                tmp_buf = bytearray() # 接收的临时的缓冲区。
-                tmp_buf.extend(self.serial.read_all()) # 接收信息。
-                self.recv_buf.extend(tmp_buf)          # 保存到上边的缓冲区。
-                # todo 这里可以保存到modbus的缓冲区。
-                # 这里要判断一下怎么显示了。
-                if self.ui.radio_recv_hex_mode.isChecked():
-                    # 这里表示是十六进制显示
-                    self.appendPlainText(self.recv_buf.hex(' ') + ' ', newline=newline, append_time=append_time)
-                    self.recv_buf.clear()
-                elif self.ui.radio_recv_text_mode.isChecked():
-                    # 这里表示是文本显示
-                    # 默认是 utf-8编码
-                    self.appendPlainText(self.recv_buf.decode('utf-8'), newline=newline, append_time=append_time)
-                    self.recv_buf.clear()
-                else:
-                    # 这里表示是双字节。这里暂时
-                    _count  = len(self.recv_buf)
-                    _count_2 = _count // 4 # 每4个
-                    buf2 = self.recv_buf[0:_count_2*4] # 截取
-                    _s_tmp = buf2.decode('ascii') # 这里先按照ascii，其基本都是数字啊，这个是16进制的字符串。
-                    buf3 = bytearray.fromhex(_s_tmp) # 这个转成了byte
-                    self.appendPlainText(buf3.decode('utf-8'), newline=newline, append_time=append_time)
-                    self.recv_buf = self.recv_buf[_count_2*4:]
+            start = time.perf_counter()
+            reader = self.session.reader if self.session is not None else None
+            if reader is not None and reader.error is not None:
+                self.log_error('线程接收错误：{}'.format(reader.error))
+                self.closeSerial()
+                return
+            if reader is not None and reader.available():
+                # 接收线程记下了空闲的位置，分帧以后每一帧一行
+                tmp_buf, breaks = self.session.read_with_breaks(receive_batch_size) # 接收信息。
+                framer = self.recv_path.framer
+                self.showFrames(framer.feed(tmp_buf, breaks))
+                if framer.gap is not None and framer.pending() and not self.frame_timer.isActive():
+                    self.frame_timer.start(int(framer.gap * 1000) + 1)
+                if reader.available():
+                    # 还有没取完的，下一次事件循环再取，中间可以处理界面的事件。
+                    QTimer.singleShot(0, self.serial_recv)
+                self.metric_recv.record(time.perf_counter() - start)
         except Exception as err:
             self.log_error('线程接收错误：{}'.format(err))
 
+    def showFrames(self, frames):
+        # 每一帧另起一行，行首显示时间
+        start = time.perf_counter()
+        path = self.recv_path
+        path.mode = self.recvMode()
+        path.encoding = self.text_encoding
+        path.hex_dump = self.action_hex_dump.isChecked()
+        if path.show(frames) and not self.render_timer.isActive():
+            self.render_timer.start(self.render.delay())
+        self.metric_decode.record(time.perf_counter() - start)
+
+    @QtCore.Slot()
+    def flushFrame(self):
+        # 空闲时间分帧：最后一块数据以后空闲超过了 gap，剩下的数据就是一帧
+        framer = self.recv_path.framer
+        if framer.gap is None or not framer.pending() or self.session is None:
+            return
+        reader = self.session.reader
+        if reader.available():
+            return # 还有没取的数据，serial_recv 会接着处理
+        idle = time.perf_counter() - (reader.last_recv_time or 0.0)
+        if idle < framer.gap:
+            self.frame_timer.start(int((framer.gap - idle) * 1000) + 1)
+            return
+        self.showFrames(framer.flush())
+
+    @QtCore.Slot(QAction)
+    def selectFraming(self, action):
+        name = action.data()
+        label, hint = FRAMINGS[name]
+        spec = name
+        if hint:
+            current = self.recv_framing.partition(':')[2] if self.recv_framing.startswith(name + ':') else ''
+            arg, ok = QInputDialog.getText(self, '分帧', '{}：{}'.format(label, hint), text=current)
+            if not ok:
+                self.restoreFraming()
+                return
+            spec = '{}:{}'.format(name, arg.strip()) if arg.strip() else name
+        try:
+            framer = make_framer(spec)
+        except ValueError as err:
+            self.messageBox.critical(self, "", "分帧参数错误：{}".format(err))
+            self.restoreFraming()
+            return
+        # 旧的分帧里边没有凑齐的数据先显示出来
+        self.showFrames(self.recv_path.framer.flush())
+        self.recv_framing = spec
+        self.recv_path.framer = framer
+        if self.session is not None:
+            self.session.reader.idle_gap = framer.gap
+        self.log_info('分帧：{}'.format(spec))
+
+    @QtCore.Slot(QAction)
+    def selectEncoding(self, action):
+        # 解码器在下次收到数据的时候换
+        self.text_encoding = action.text()
+        self.log_info('编码：{}'.format(self.text_encoding))
+
+    @QtCore.Slot(QAction)
+    def selectProtocol(self, action):
+        self.file_protocol = action.data()
+        self.log_info('文件传输协议：{}'.format(action.text()))
+
+    def restoreFraming(self):
+        name = self.recv_framing.partition(':')[0]
+        for action in self.framing_group.actions():
+            action.setChecked(action.data() == name)
+
     # 如下接收部分的按钮事件处理
     @QtCore.Slot()
     def saveReceiveData(self):
         # 保存读取的文件
         file_path,_ = QFileDialog(self).getSaveFileName(self, '选择文件')
-        with open(file_path, 'w') as f:
-            f.write(self.ui.txt_recv.toPlainText())
+        if not file_path:
+            return
+        with open(file_path, 'w', encoding='utf-8') as f:
+            for line in self.recv_log.iter_text():
+                f.write(line + '\n')
+
+    @QtCore.Slot()
+    def startRecord(self):
+        # 开始录制收发的数据，扩展名是 .gz 或者 .zst 的时候压缩
+        file_path, _ = QFileDialog(self).getSaveFileName(
+            self, '选择录制文件', '', '录制文件 (*.chcap *.chcap.gz *.chcap.zst);;所有文件 (*)')
+        if not file_path:
+            return
+        try:
+            self.recorder = CaptureWriter(
+                file_path,
+                rotate_bytes=record_rotate_bytes,
+                rotate_seconds=record_rotate_seconds,
+                compression=compression_from_path(file_path))
+        except Exception as err:
+            self.log_error("录制错误：{}".format(err))
+            return
+        if self.session is not None:
+            self.session.recorder = self.recorder
+        self.action_record_start.setEnabled(False)
+        self.action_record_stop.setEnabled(True)
+        self.log_info("开始录制：{}".format(file_path))
+
+    @QtCore.Slot()
+    def stopRecord(self):
+        if self.recorder is None:
+            return
+        if self.session is not None:
+            self.session.recorder = None
+        self.recorder.close()
+        stats = self.recorder.stats()
+        if self.recorder.error is not None:
+            self.log_error("录制错误：{}".format(self.recorder.error))
+        else:
+            self.log_info("停止录制，{records} 条记录，{bytes_written} 字节，{files} 个文件，丢弃 {dropped} 字节".format(**stats))
+        self.recorder = None
+        self.action_record_start.setEnabled(True)
+        self.action_record_stop.setEnabled(False)
+
+    @QtCore.Slot()
+    def openCapture(self):
+        # 在单独的窗口里边查看录制文件
+        file_path, _ = QFileDialog(self).getOpenFileName(
+            self, '打开录制文件', '', '录制文件 (*.chcap);;所有文件 (*)')
+        if not file_path:
+            return
+        try:
+            viewer = CaptureViewer(file_path)
+        except Exception as err:
+            self.log_error("打开录制文件错误：{}".format(err))
+            return
+        self.capture_viewers = [v for v in self.capture_viewers if v.isVisible()]
+        self.capture_viewers.append(viewer)
+        viewer.show()
 
     @QtCore.Slot()
     def saveSendData(self):
@@ -267,42 +652,134 @@ class MainWindow(QMainWindow):
 
     @QtCore.Slot()
     def sendFile(self):
-        # 这里是发送一个文件，
+        # 这里是发送文件，后台线程一块一块地发，界面上显示进度，可以取消
+        # 协议在 文件传输 菜单里边选，YMODEM、ZMODEM 可以一次发送多个文件
+        if self.file_transfer is not None:
+            self.log_error("正在传输文件")
+            return
         try:
-            file_path, _ = QFileDialog(self).getOpenFileName(self, '选择文件')
-            if os.path.exists(file_path):
-                if self.serial is not None and  self.serial.isOpen():
-                    # 这里表示实际发送的
-                    with open(file_paht, 'rb') as f:
-                        # 二进制读取
-                        self.serial.write(f.read())
-                    self.log_info("发送文件成功")
+            protocol = self.file_protocol
+            if protocol in ('ymodem', 'ymodem-g', 'zmodem'):
+                file_paths, _ = QFileDialog(self).getOpenFileNames(self, '选择文件')
+            else:
+                file_path, _ = QFileDialog(self).getOpenFileName(self, '选择文件')
+                file_paths = [file_path] if file_path else []
+            if not file_paths:
+                return
+            missing = [path for path in file_paths if not os.path.exists(path)]
+            if missing:
+                self.log_error("文件：'{}' 不存在".format(missing[0]))
+            elif self.session is not None and self.session.is_open():
+                if protocol == PROTOCOL_RAW:
+                    flow, ok = QInputDialog.getItem(self, '发送文件', '流控：', FLOWS, FLOWS.index(send_file_flow), False)
+                    if not ok:
+                        return
+                    transfer = make_sender(protocol, self.session, file_paths, pace=send_file_pace, flow=flow)
                 else:
-                    self.log_error("串口没有打开")
+                    transfer = make_sender(protocol, self.session, file_paths)
+                self.startFileTransfer(transfer, '发送文件')
+                self.log_info("开始发送文件（{}）：{} 个文件，{} 字节".format(protocol, len(file_paths), transfer.total))
             else:
-                self.log_error("文件：'{}' 不存在".format(file_apth))
+                self.log_error("串口没有打开")
+        except Exception as err:
+            self.file_transfer = None
+            self.log_error("错误：{}".format(err))
+
+    @QtCore.Slot()
+    def receiveFile(self):
+        # 按照选择的协议接收文件，XMODEM 没有文件名，要选保存的文件，其他的选保存的目录
+        if self.file_transfer is not None:
+            self.log_error("正在传输文件")
+            return
+        protocol = self.file_protocol
+        if protocol == PROTOCOL_RAW:
+            self.messageBox.critical(self, "", "先在 文件传输 菜单里边选择 XMODEM、YMODEM 或者 ZMODEM")
+            return
+        if self.session is None or not self.session.is_open():
+            self.log_error("串口没有打开")
+            return
+        if protocol.startswith('xmodem'):
+            target, _ = QFileDialog(self).getSaveFileName(self, '保存文件')
+        else:
+            target = QFileDialog(self).getExistingDirectory(self, '保存到目录')
+        if not target:
+            return
+        try:
+            self.startFileTransfer(make_receiver(protocol, self.session, target), '接收文件')
+            self.log_info("等待对方发送文件（{}）".format(protocol))
         except Exception as err:
+            self.file_transfer = None
             self.log_error("错误：{}".format(err))
 
+    def startFileTransfer(self, transfer, title):
+        if not isinstance(transfer, FileSender):
+            if self.modbus_busy:
+                raise RuntimeError('先停止 modbus 的轮询或者网关')
+            # 协议要自己读取对方的应答，这段时间接收的数据不显示
+            self.modbus_busy = True
+        self.file_transfer = transfer
+        self.file_progress = QProgressDialog(title, '取消', 0, 1000, self)
+        self.file_progress.setWindowTitle(title)
+        self.file_progress.setAutoClose(False)
+        self.file_progress.setAutoReset(False)
+        self.file_progress.canceled.connect(self.cancelFileTransfer)
+        self.file_progress.show()
+        transfer.start()
+        self.file_timer.start(send_file_progress_interval)
+
+    @QtCore.Slot()
+    def showFileProgress(self):
+        transfer = self.file_transfer
+        if transfer is None:
+            self.file_timer.stop()
+            return
+        if self.file_progress is not None:
+            self.file_progress.setValue(int(transfer.progress() * 1000))
+            self.file_progress.setLabelText('{}\n{} / {} 字节，{:.0f} 字节/秒，重发 {} 次'.format(
+                transfer.file_name, transfer.transferred, transfer.total, transfer.rate(), transfer.retries))
+        if transfer.is_alive():
+            self.show_state('传输文件：{:.0%}，{:.0f} 字节/秒，线路利用率 {:.0%}'.format(
+                transfer.progress(), transfer.rate(), transfer.wire_usage()))
+            return
+        self.finishFileTransfer()
+
+    @QtCore.Slot()
+    def cancelFileTransfer(self):
+        transfer = self.file_transfer
+        if transfer is None:
+            return
+        transfer.cancel()
+        transfer.join(1)
+        self.finishFileTransfer()
+
+    def finishFileTransfer(self):
+        transfer, self.file_transfer = self.file_transfer, None
+        self.file_timer.stop()
+        if self.file_progress is not None:
+            progress, self.file_progress = self.file_progress, None
+            progress.canceled.disconnect(self.cancelFileTransfer)
+            progress.close()
+        if transfer is None:
+            return
+        if transfer.error is not None:
+            self.log_error("传输文件失败：{}".format(transfer.error))
+        elif transfer.cancelled:
+            self.log_info("取消传输文件：已经传输 {} 字节".format(transfer.transferred))
+        else:
+            self.log_info("传输文件成功：{} 个文件，{} 字节，用时 {:.1f} 秒，{:.0f} 字节/秒".format(
+                len(transfer.files), transfer.transferred, transfer.elapsed(), transfer.rate()))
+        if not isinstance(transfer, FileSender):
+            self.modbus_busy = False
+            self.serial_recv()
+
     @QtCore.Slot()
     def serialSend(self):
         # 发送数据
         # 首先判断串口是否打开
         try:
-            if self.serial is not None and self.serial.isOpen():
-                # 这里先判断是否是16进制
-                if self.ui.radio_send_hex_mode.isChecked():
-                    # 十六进制
-                    self.serial.write(bytearray.fromhex(self.ui.txt_send.toPlainText()))
-                elif self.ui.radio_send_text_mode.isChecked():
-                    # 文本，默认是utf-8编码。
-                    self.serial.write(bytearray(self.ui.txt_send.toPlainText(), 'utf-8'))
-                else:
-                    # 这里表示是双字节
-                    # 这里首先要将文本转成
-                    self.serial.write(
-                        bytearray(self.ui.txt_send.toPlainText(), 'utf-8').hex() # 这样子就转成双字节了
-                    )
+            if self.session is not None and self.session.is_open():
+                # 按照发送的模式转成字节，发送的同时会录制
+                self.session.write(encode(self.ui.txt_send.toPlainText(), self.sendMode(), self.text_encoding))
                 # 这里直接显示发送的信息
                 self.appendPlainText(self.ui.txt_send.toPlainText(), newline=True, append_time=True, is_receive=False)
             else:
@@ -310,40 +787,581 @@ class MainWindow(QMainWindow):
         except Exception as err:
             self.log_error("发送错误:{}".format(err))
 
+    def sendMode(self):
+        # 发送区选中的模式
+        if self.ui.radio_send_hex_mode.isChecked():
+            return MODE_HEX
+        if self.ui.radio_send_text_mode.isChecked():
+            return MODE_TEXT
+        return MODE_DOUBLEBYTE
+
+    def recvMode(self):
+        # 接收区选中的模式
+        if self.ui.radio_recv_hex_mode.isChecked():
+            return MODE_HEX
+        if self.ui.radio_recv_text_mode.isChecked():
+            return MODE_TEXT
+        return MODE_DOUBLEBYTE
+
     def appendPlainText(self, text, newline=False, append_time = False, is_receive=True):
-        # 因为默认的清空下，这个会添加回车，这个解决一下
-        self.ui.txt_recv.moveCursor(QTextCursor.End) # 移动到最后
-        precursor =self.ui.txt_recv.textCursor() # 
-        pos = precursor.position() # 这个位置
-        prefix  = "" # 前缀
-        if newline and len(self.ui.txt_recv.toPlainText()) > 0:
-            # 如果不是空白的，就需要添加一个回车
-            prefix += '\n'
+        # 追加到接收区，newline 表示另起一行，append_time 表示行首显示时间和方向。
+        self.appendLog(text.encode('utf-8'), 0, newline, append_time, is_receive)
+
+    def appendBytes(self, data, newline=False, append_time = False, is_receive=True):
+        # 追加原始的字节，显示成十六进制。
+        flags = FLAG_HEX | FLAG_DUMP if self.action_hex_dump.isChecked() else FLAG_HEX
+        self.appendLog(data, flags, newline, append_time, is_receive)
+
+    def appendLog(self, data, flags, newline, append_time, is_receive):
         if append_time:
-            # 如果需要添加时间
-            # 然后添加日期
-            prefix += time.strftime("%H:%M:%S ") # 添加日期
-            # 然后添加是发送还是接收。
-            if is_receive:
-                prefix += '收<- :'
-            else:
-                prefix += '发-> :'
-        self.ui.txt_recv.appendPlainText(prefix + text) # 追加文本
-        if pos == 0:
-            # 如果是第一行，不需要删除回车
-            return
-        # 定位到前面的回车，并且删除这个回车。
-        precursor.setPosition(pos)
-        self.ui.txt_recv.setTextCursor(precursor)
-        self.ui.txt_recv.textCursor().deleteChar()
+            flags |= FLAG_TIME
+        if not is_receive:
+            flags |= FLAG_SEND
+        self.render.push(data, flags=flags, new_line=newline)
+        if not self.render_timer.isActive():
+            self.render_timer.start(self.render.delay())
+
+    @QtCore.Slot()
+    def flushReceive(self):
+        # 把积压的数据一次性地显示出来
+        start = time.perf_counter()
+        if self.render.flush():
+            self.recv_view.sync()
+            self.show_state()
+            self.metric_render.record(time.perf_counter() - start)
+
+    def setupMetrics(self):
+        # 诊断用的指标：计数和积压读的时候才取，热路径上只有几个计时
+        self.metric_recv = REGISTRY.timer('recv_batch', '界面线程取一批接收数据并且处理完的时间')
+        self.metric_decode = REGISTRY.timer('decode', '分帧以后解码、放到显示队列里边的时间')
+        self.metric_render = REGISTRY.timer('render', '把显示队列刷新到接收区的时间')
+        self.metric_event_loop = REGISTRY.timer('event_loop_lag', '界面事件循环的延迟（定时器比预期晚触发的时间）')
+        self.metric_errors = REGISTRY.counter('log_errors', '界面上报的错误次数')
+        # 串口没有打开的时候取值出错，这些指标就不显示
+        REGISTRY.gauge('bytes_read', '接收的字节数', lambda: self.session.reader.bytes_read, kind='counter')
+        REGISTRY.gauge('read_calls', '读串口的次数', lambda: self.session.reader.read_calls, kind='counter')
+        REGISTRY.gauge('bytes_written', '发送的字节数', lambda: self.session.bytes_written, kind='counter')
+        REGISTRY.gauge('recv_dropped_bytes', '接收缓冲区满了丢弃的字节数', lambda: self.session.reader.ring.dropped,
+                       kind='counter')
+        REGISTRY.gauge('recv_buffered_bytes', '接收缓冲区里边还没有取走的字节数', lambda: len(self.session.reader.ring))
+        REGISTRY.gauge('recv_high_water_bytes', '接收缓冲区最多积压的字节数', lambda: self.session.reader.ring.high_water)
+        REGISTRY.gauge('render_pending_bytes', '等着刷新到接收区的字节数', lambda: self.render.pending_bytes)
+        REGISTRY.gauge('render_summarized_bytes', '来不及显示只显示了汇总的字节数', lambda: self.render.summarized_bytes,
+                       kind='counter')
+        REGISTRY.gauge('render_fps', '接收区每秒刷新的次数', lambda: self.render.fps)
+        REGISTRY.gauge('recv_log_lines', '接收区的行数', lambda: len(self.recv_log))
+        REGISTRY.gauge('record_pending_bytes', '录制还没有写到文件里边的字节数',
+                       lambda: self.session.recorder.stats()['pending'])
+        self.metrics_server = None
+        self.diagnostics_view = None
+        menu_diagnostics = self.ui.menubar.addMenu('诊断')
+        menu_diagnostics.addAction('诊断面板...').triggered.connect(self.showDiagnostics)
+        self.action_metrics_server = menu_diagnostics.addAction('Prometheus 指标端口...')
+        self.action_metrics_server.setCheckable(True)
+        self.action_metrics_server.triggered.connect(self.toggleMetricsServer)
+        # 事件循环的延迟：精确的定时器，实际触发的时间比预期晚了多少
+        self.event_loop_timer = QTimer(self)
+        self.event_loop_timer.setTimerType(QtCore.Qt.TimerType.PreciseTimer)
+        self.event_loop_timer.timeout.connect(self.checkEventLoop)
+        self.event_loop_due = time.perf_counter() + event_loop_probe_interval / 1000
+        self.event_loop_timer.start(event_loop_probe_interval)
+
+    @QtCore.Slot()
+    def checkEventLoop(self):
+        now = time.perf_counter()
+        self.metric_event_loop.record(max(0.0, now - self.event_loop_due))
+        self.event_loop_due = now + event_loop_probe_interval / 1000
+
+    @QtCore.Slot()
+    def showDiagnostics(self):
+        if self.diagnostics_view is None:
+            self.diagnostics_view = DiagnosticsView()
+            self.diagnostics_view.closed.connect(self.closeDiagnostics)
+        self.diagnostics_view.show()
+        self.diagnostics_view.raise_()
+
+    @QtCore.Slot()
+    def closeDiagnostics(self):
+        self.diagnostics_view = None
+
+    @QtCore.Slot(bool)
+    def toggleMetricsServer(self, checked):
+        if not checked:
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+                self.metrics_server = None
+                self.log_info('指标端口已经关闭')
+            return
+        port, ok = QInputDialog.getInt(self, 'Prometheus 指标端口', '本机端口:', metrics_port, 0, 65535)
+        if not ok:
+            self.action_metrics_server.setChecked(False)
+            return
+        try:
+            self.metrics_server = MetricsServer(REGISTRY, port).start()
+        except OSError as err:
+            self.messageBox.critical(self, "", "端口打不开：{}".format(err))
+            self.action_metrics_server.setChecked(False)
+            return
+        self.log_info('指标：http://127.0.0.1:{}/metrics'.format(self.metrics_server.port))
+
+    @QtCore.Slot()
+    def clearReceive(self):
+        self.render.clear()
+        self.recv_view.clear()
     
+    def addModbusRow(self, layout, functions):
+        # 在 modbus 的读写区域最上边加一行：从站地址和功能码
+        row = QHBoxLayout()
+        row.addWidget(QLabel('从站:'))
+        txt_unit = QLineEdit('1')
+        txt_unit.setMaximumWidth(50)
+        row.addWidget(txt_unit)
+        combo_function = QComboBox()
+        for function in functions:
+            combo_function.addItem(function_names[function], function)
+        row.addWidget(combo_function)
+        layout.insertLayout(0, row)
+        return txt_unit, combo_function
+
+    def modbusMaster(self):
+        # 用打开的串口创建主站，帧间隔按照当前的串口参数计算
+        parm = self.getSerialParameter()
+        _char_time = char_time(parm[key_baudrate], parm[key_bytesize], parm[key_parity], parm[key_stopbits])
+        _gap = silent_interval(parm[key_baudrate], parm[key_bytesize], parm[key_parity], parm[key_stopbits])
+        return ModbusMaster(SessionTransport(self.session), _char_time, timeout=modbus_timeout, retries=modbus_retries, gap=_gap)
+
+    def startModbus(self, kind, request):
+        # 在后台线程里边执行请求，界面不会卡住
+        if self.session is None or not self.session.is_open():
+            self.messageBox.critical(self, "", "串口没有打开")
+            return
+        if self.modbus_busy:
+            return
+        master = self.modbusMaster()
+        self.modbus_busy = True
+        self.ui.btn_modbus_read.setEnabled(False)
+        self.ui.btn_modbus_write.setEnabled(False)
+
+        def run():
+            try:
+                result = request(master)
+            except (ModbusError, OSError, ValueError) as err:
+                result = err
+            self.modbus_done.emit((kind, master, result))
+
+        threading.Thread(target=run, name='modbus', daemon=True).start()
+
     @QtCore.Slot()
     def modbusRead(self):
-        self.messageBox.critical(self, "", "暂时没有实现")
-    
+        if self.poll_scheduler is not None:
+            # 正在循环读取，再按一次就停止
+            self.stopPoll()
+            return
+        try:
+            unit = int(self.txt_modbus_read_unit.text())
+            address = int(self.ui.txt_modbus_read_address.text(), 16)
+            count = int(self.ui.txt_modbus_read_data_count.text())
+        except ValueError:
+            self.messageBox.critical(self, "", "从站地址、地址或者个数不对")
+            return
+        function = self.combo_modbus_read_function.currentData()
+        data_style, byte_order = self.modbusReadStyle()
+        if function not in (READ_COILS, READ_DISCRETE_INPUTS):
+            # 寄存器的个数按照数据类型换算，比如10个32位浮点数是20个寄存器
+            count *= registers_per_value(data_style)
+        if self.chk_modbus_poll.isChecked():
+            try:
+                period = int(self.txt_modbus_poll_period.text()) / 1000
+                self.startPoll([PollItem(unit, function, address, count, period)])
+            except ValueError as err:
+                self.messageBox.critical(self, "", "循环读取的参数不对：{}".format(err))
+            return
+        if function in (READ_COILS, READ_DISCRETE_INPUTS):
+            request = lambda master: (address, 1, master.read_bits(unit, function, address, count))
+        else:
+            request = lambda master: (address, registers_per_value(data_style),
+                decode_registers(master.read_registers_raw(unit, function, address, count), data_style, byte_order))
+        self.startModbus('read', request)
+
+    def modbusReadStyle(self):
+        # 读的数据类型和字节顺序
+        return (modbus_data_style[self.ui.combo_modbus_read_data_style.currentText()],
+                self.ui.combo_modbus_read_byte_sort.currentText())
+
     @QtCore.Slot()
     def modbusWrite(self):
-        self.messageBox.critical(self, "", "暂时没有实现")
+        try:
+            unit = int(self.txt_modbus_write_unit.text())
+            address = int(self.ui.txt_modbus_write_address.text(), 16)
+            function = self.combo_modbus_write_function.currentData()
+            data_style = modbus_data_style[self.ui.combo_modbus_write_data_style.currentText()]
+            byte_order = self.ui.combo_modbus_write_byte_sort.currentText()
+            # 要写的值，用空格或者换行分开，0x开头的是十六进制；线圈是 0 或者 1
+            _text = self.ui.txt_modubs_write_send.toPlainText()
+            if function in (WRITE_SINGLE_COIL, WRITE_MULTIPLE_COILS):
+                values = [int(i, 0) for i in _text.split()]
+            else:
+                values = parse_values(_text, data_style)
+                data = encode_registers(values, data_style, byte_order)
+                if function == WRITE_SINGLE_REGISTER:
+                    if len(data) != 2:
+                        raise ValueError('写单个寄存器只能写一个16位的数')
+                    values = [int.from_bytes(data, 'big')]
+        except (ValueError, OverflowError) as err:
+            self.messageBox.critical(self, "", "从站地址、地址或者数据不对：{}".format(err))
+            return
+        if not values:
+            self.messageBox.critical(self, "", "没有要写的数据")
+            return
+        if function == WRITE_SINGLE_COIL:
+            request = lambda master: master.write_single_coil(unit, address, values[0])
+        elif function == WRITE_SINGLE_REGISTER:
+            request = lambda master: master.write_single_register(unit, address, values[0])
+        elif function == WRITE_MULTIPLE_COILS:
+            request = lambda master: master.write_multiple_coils(unit, address, values)
+        else:
+            request = lambda master: master.write_multiple_registers(unit, address, data=data)
+        self.startModbus('write', request)
+
+    @QtCore.Slot(object)
+    def modbusDone(self, done):
+        # 后台线程的请求完成了，在界面线程里边显示结果
+        kind, master, result = done
+        self.modbus_busy = False
+        self.ui.btn_modbus_read.setEnabled(True)
+        self.ui.btn_modbus_write.setEnabled(True)
+        _request = master.last_request.hex(' ')
+        _response = master.last_response.hex(' ')
+        if kind == 'read':
+            self.ui.txt_modbus_read_send.setText(_request)
+            if isinstance(result, Exception):
+                self.ui.txt_modbus_read_receive.setPlainText('{}\n{}'.format(_response, result))
+            else:
+                address, step, values = result
+                lines = ['{:04X}: {}'.format(address + i * step, value) for i, value in enumerate(values)]
+                self.ui.txt_modbus_read_receive.setPlainText('\n'.join([_response] + lines))
+        else:
+            self.ui.txt_modbus_write_return.setText(str(result) if isinstance(result, Exception) else _response)
+        if isinstance(result, Exception):
+            self.log_error('modbus：{}'.format(result))
+        else:
+            self.log_info('modbus：{:.1f} ms'.format(master.last_round_trip * 1000))
+        # 请求期间收到的其他数据接着显示
+        self.serial_recv()
+
+    def startPoll(self, items):
+        # 在后台线程里边按照轮询表循环读取，结果定时刷新到界面上
+        if self.session is None or not self.session.is_open():
+            self.messageBox.critical(self, "", "串口没有打开")
+            return
+        if self.modbus_busy:
+            return
+        self.poll_scheduler = PollScheduler(self.modbusMaster(), items, modbus_poll_max_gap).start()
+        self.modbus_busy = True
+        self.ui.btn_modbus_write.setEnabled(False)
+        self.ui.btn_modbus_read.setText('停止')
+        self.action_poll_stop.setEnabled(True)
+        self.poll_timer.start(modbus_poll_display_interval)
+        self.log_info('开始轮询：{} 项合并成 {} 个请求'.format(len(items), len(self.poll_scheduler.blocks)))
+
+    @QtCore.Slot()
+    def stopPoll(self):
+        if self.poll_scheduler is None:
+            return
+        self.poll_scheduler.stop()
+        self.poll_timer.stop()
+        self.showPoll()
+        self.poll_scheduler = None
+        self.modbus_busy = False
+        self.ui.btn_modbus_write.setEnabled(True)
+        self.ui.btn_modbus_read.setText('读取')
+        self.action_poll_stop.setEnabled(False)
+        # 轮询期间收到的其他数据接着显示
+        self.serial_recv()
+
+    @QtCore.Slot()
+    def loadPollTable(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, '加载轮询表', '', '轮询表 (*.csv);;所有文件 (*)')
+        if not file_path:
+            return
+        try:
+            items = load_poll_table(file_path)
+        except (OSError, ValueError) as err:
+            self.log_error('轮询表错误：{}'.format(err))
+            return
+        self.stopPoll()
+        self.startPoll(items)
+
+    @QtCore.Slot()
+    def showPoll(self):
+        # 显示轮询的结果和每个从站的实际轮询频率
+        scheduler = self.poll_scheduler
+        if scheduler is None:
+            return
+        data_style, byte_order = self.modbusReadStyle()
+        lines = []
+        for item in scheduler.items:
+            if item.error is not None:
+                text = str(item.error)
+            elif item.value is None:
+                text = ''
+            elif isinstance(item.value, list):
+                text = ' '.join(str(i) for i in item.value)
+            else:
+                text = ' '.join(str(i) for i in decode_registers(item.value, data_style, byte_order))
+            lines.append('{} {}'.format(item.name, text))
+        self.ui.txt_modbus_read_receive.setPlainText('\n'.join(lines))
+        stats = scheduler.stats()
+        rates = ', '.join('从站{} {:.1f}/{:.1f}次/秒'.format(unit, i['achieved'], i['configured'])
+                          for unit, i in stats['units'].items())
+        self.show_state('轮询 {} 个请求，总线占用 {:.0%}，{}'.format(stats['requests'], stats['bus_busy'], rates))
+        if not scheduler.is_running():
+            # 串口出错了，轮询线程已经退出
+            QTimer.singleShot(0, self.stopPoll)
+
+    @QtCore.Slot(bool)
+    def toggleSlave(self, checked):
+        if not checked:
+            self.stopSlave()
+            return
+        parm = self.getSerialParameter()
+        if self.session is not None or parm == {}:
+            self.messageBox.critical(self, "", "从站模拟需要先关闭串口，并且选好串口参数")
+            self.action_slave.setChecked(False)
+            return
+        try:
+            self.modbus_slave = open_slave(parm[key_serial_name], parm[key_baudrate], parm[key_bytesize],
+                                           parm[key_parity], parm[key_stopbits], units=[int(self.txt_modbus_read_unit.text())])
+        except (serial.SerialException, OSError, ValueError) as err:
+            self.log_error('从站模拟错误：{}'.format(err))
+            self.action_slave.setChecked(False)
+            return
+        self.modbus_slave.start()
+        self.ui.btn_open.setEnabled(False)
+        self.slave_timer.start(1000)
+        self.log_info('从站模拟已经启动')
+
+    def stopSlave(self):
+        if self.modbus_slave is None:
+            return
+        self.slave_timer.stop()
+        self.modbus_slave.stop()
+        self.modbus_slave.serial.close()
+        self.log_info('从站模拟已经停止：{}'.format(self.modbus_slave.latency.format()))
+        self.modbus_slave = None
+        self.action_slave.setChecked(False)
+        self.ui.btn_open.setEnabled(True)
+
+    @QtCore.Slot()
+    def showSlave(self):
+        slave = self.modbus_slave
+        if slave is None:
+            return
+        if slave.error is not None:
+            self.log_error('从站模拟错误：{}'.format(slave.error))
+            self.stopSlave()
+            return
+        stats = slave.stats()
+        self.show_state('从站模拟：请求 {} 应答 {} 异常 {}，延迟 p99 {:.3f} ms'.format(
+            stats['requests'], stats['responses'], stats['exceptions'], stats['latency']['p99'] * 1000))
+
+    @QtCore.Slot(bool)
+    def toggleGateway(self, checked):
+        if not checked:
+            self.stopGateway()
+            return
+        if self.session is None or not self.session.is_open() or self.modbus_busy:
+            self.messageBox.critical(self, "", "先打开串口，并且停止轮询")
+            self.action_gateway.setChecked(False)
+            return
+        port, ok = QInputDialog.getInt(self, 'TCP网关', 'Modbus TCP 端口：', modbus_gateway_port, 1, 65535)
+        if not ok:
+            self.action_gateway.setChecked(False)
+            return
+        try:
+            self.modbus_gateway = Gateway(self.modbusMaster(), cache_ttl=modbus_gateway_cache_ttl).start_thread('0.0.0.0', port)
+        except OSError as err:
+            self.log_error('网关错误：{}'.format(err))
+            self.action_gateway.setChecked(False)
+            return
+        self.modbus_busy = True
+        self.ui.btn_modbus_read.setEnabled(False)
+        self.ui.btn_modbus_write.setEnabled(False)
+        self.gateway_timer.start(1000)
+        self.log_info('网关已经启动，端口 {}'.format(port))
+
+    def stopGateway(self):
+        if self.modbus_gateway is None:
+            return
+        self.gateway_timer.stop()
+        self.modbus_gateway.stop_thread()
+        self.modbus_gateway = None
+        self.modbus_busy = False
+        self.action_gateway.setChecked(False)
+        self.ui.btn_modbus_read.setEnabled(True)
+        self.ui.btn_modbus_write.setEnabled(True)
+        self.log_info('网关已经停止')
+        self.serial_recv()
+
+    @QtCore.Slot()
+    def showGateway(self):
+        if self.modbus_gateway is not None:
+            self.show_state('网关：客户端 {clients}，请求 {requests}，总线上 {bus_requests}，缓存命中 {cache_hits}，'
+                            '失败 {failures}，总线占用 {bus_busy:.0%}'.format(**self.modbus_gateway.stats()))
+
+    @QtCore.Slot(bool)
+    def toggleSniffer(self, checked):
+        if not checked:
+            self.stopSniffer()
+            return
+        if self.session is None or not self.session.is_open():
+            self.messageBox.critical(self, "", "先打开串口")
+            self.action_sniffer.setChecked(False)
+            return
+        parm = self.getSerialParameter()
+        self.modbus_sniffer = ModbusSniffer(
+            silent_interval(parm[key_baudrate], parm[key_bytesize], parm[key_parity], parm[key_stopbits]),
+            char_time(parm[key_baudrate], parm[key_bytesize], parm[key_parity], parm[key_stopbits]), timeout=modbus_timeout)
+        # 换成新的列表，接收线程正在遍历的旧列表不受影响
+        reader = self.session.reader
+        reader.taps = reader.taps + [self.modbus_sniffer]
+        self.sniffer_view = SnifferView(self.modbus_sniffer)
+        self.sniffer_view.closed.connect(self.stopSniffer)
+        self.sniffer_view.show()
+        self.log_info('总线监听已经启动')
+
+    @QtCore.Slot(bool)
+    def toggleLatency(self, checked):
+        if not checked:
+            self.stopLatency()
+            return
+        if self.session is None or not self.session.is_open():
+            self.messageBox.critical(self, "", "先打开串口")
+            self.action_latency.setChecked(False)
+            return
+        text, ok = QInputDialog.getText(self, '延迟测量', '应答里边要匹配的内容，格式和发送区一样（空的表示发送以后第一次收到的数据）：')
+        if not ok:
+            self.action_latency.setChecked(False)
+            return
+        parm = self.getSerialParameter()
+        try:
+            pattern = encode(text, self.sendMode(), self.text_encoding)
+            self.latency_probe = LatencyProbe(MATCH_PATTERN if pattern else MATCH_FIRST, pattern, latency_timeout,
+                char_time(parm[key_baudrate], parm[key_bytesize], parm[key_parity], parm[key_stopbits]))
+        except ValueError as err:
+            self.messageBox.critical(self, "", "匹配的内容不对：{}".format(err))
+            self.action_latency.setChecked(False)
+            return
+        # 换成新的列表，接收线程正在遍历的旧列表不受影响
+        reader = self.session.reader
+        reader.taps = reader.taps + [self.latency_probe]
+        self.latency_view = LatencyView(self.latency_probe)
+        self.latency_view.closed.connect(self.stopLatency)
+        self.latency_view.show()
+        self.log_info('延迟测量已经启动')
+
+    @QtCore.Slot()
+    def stopLatency(self):
+        probe = self.latency_probe
+        if probe is None:
+            return
+        self.latency_probe = None
+        if self.session is not None:
+            reader = self.session.reader
+            reader.taps = [tap for tap in reader.taps if tap is not probe]
+        if self.latency_view is not None:
+            view, self.latency_view = self.latency_view, None
+            view.close()
+        self.action_latency.setChecked(False)
+        self.log_info('延迟测量已经停止：' + probe.format())
+
+    @QtCore.Slot()
+    def loadMacros(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, '加载宏', '', '宏文件 (*.csv);;所有文件 (*)')
+        if not file_path:
+            return
+        try:
+            macros = load_macros(file_path, self.text_encoding)
+        except (OSError, ValueError) as err:
+            self.log_error('宏文件错误：{}'.format(err))
+            return
+        self.stopMacros()
+        self.macros = macros
+        self.menu_macro_send.clear()
+        for i, macro in enumerate(macros):
+            self.menu_macro_send.addAction(macro.name).setData(i)
+        self.menu_macro_send.setEnabled(bool(macros))
+        self.action_macro_start.setEnabled(bool(macros))
+        self.log_info('加载了 {} 条宏'.format(len(macros)))
+
+    @QtCore.Slot(QAction)
+    def sendMacro(self, action):
+        # 单独发送一条宏，不管周期和次数
+        macro = self.macros[action.data()]
+        if self.session is None or not self.session.is_open():
+            self.log_error("串口没有打开，发送失败.")
+            return
+        try:
+            self.session.write(macro.data)
+        except Exception as err:
+            self.log_error("发送错误:{}".format(err))
+            return
+        self.appendBytes(macro.data, newline=True, append_time=True, is_receive=False)
+
+    @QtCore.Slot()
+    def startMacros(self):
+        if self.session is None or not self.session.is_open():
+            self.messageBox.critical(self, "", "串口没有打开")
+            return
+        self.stopMacros()
+        # 发送的数据不逐条显示，1ms 的周期界面显示不过来，状态栏显示统计
+        self.macro_sequencer = MacroSequencer(self.session, self.macros).start()
+        self.action_macro_stop.setEnabled(True)
+        self.macro_timer.start(macro_display_interval)
+        self.log_info('开始发送宏序列：{} 条'.format(len(self.macros)))
+
+    @QtCore.Slot()
+    def stopMacros(self):
+        sequencer = self.macro_sequencer
+        if sequencer is None:
+            return
+        self.macro_sequencer = None
+        sequencer.stop()
+        self.macro_timer.stop()
+        self.action_macro_stop.setEnabled(False)
+        if sequencer.error is not None:
+            self.log_error('宏序列发送错误：{}'.format(sequencer.error))
+        self.log_info('宏序列已经停止：发送 {sent} 次，跳过 {late} 次'.format(**sequencer.stats()))
+        self.log_info('抖动：' + sequencer.jitter().format())
+
+    @QtCore.Slot()
+    def showMacros(self):
+        sequencer = self.macro_sequencer
+        if sequencer is None:
+            return
+        if not sequencer.is_running():
+            # 所有的宏都发完了或者出错了
+            self.stopMacros()
+            return
+        stats = sequencer.stats()
+        self.show_state('宏序列：发送 {} 次，跳过 {} 次，抖动 p50 {:.3f} ms，p99 {:.3f} ms，最大 {:.3f} ms'.format(
+            stats['sent'], stats['late'], stats['jitter_p50'] * 1000, stats['jitter_p99'] * 1000, stats['jitter_max'] * 1000))
+
+    @QtCore.Slot()
+    def stopSniffer(self):
+        sniffer = self.modbus_sniffer
+        if sniffer is None:
+            return
+        self.modbus_sniffer = None
+        if self.session is not None:
+            reader = self.session.reader
+            reader.taps = [tap for tap in reader.taps if tap is not sniffer]
+        if self.sniffer_view is not None:
+            view, self.sniffer_view = self.sniffer_view, None
+            view.close()
+        self.action_sniffer.setChecked(False)
+        self.log_info('总线监听已经停止：{} 帧，丢弃 {} 字节，配不上请求的应答 {}'.format(
+            sniffer.frames, sniffer.bad_bytes, sniffer.orphans))
 
     @QtCore.Slot()
     def updateSerialNames(self):
@@ -0,0 +1,334 @@
+# 运行时的指标和采样分析
+# 三种指标：
+#   Counter：只增加的计数，比如出错的次数
+#   Gauge：读的时候才调用函数取值，比如接收缓冲区里边积压的字节数；已经有统计的（SerialSession.stats()）
+#          用 kind='counter' 的 Gauge 导出，热路径上不用再加计数
+#   Timer：记录每次花的时间，次数、总时间和 stats.Histogram（相对误差不超过 1/16）
+# 所有的指标放在 Registry 里边，默认用全局的 REGISTRY；prometheus() 输出 Prometheus 的文本格式，
+# MetricsServer 在本机的端口上提供 /metrics。
+# SamplingProfiler 在自己的线程里边定时取所有线程的调用栈（sys._current_frames()），按照调用栈计数，
+# 不用 sys.setprofile，所以不采样的时候没有开销，采样的时候开销也只和采样的频率有关。
+# 采的是墙上时间，阻塞在 read() 或者 wait() 上的线程也会采到，看界面线程卡在哪里就看 MainThread 的栈。
+
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from stats import Histogram
+
+PREFIX = 'comhelper_'
+# Prometheus 导出的分位数
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Counter:
+    '''只增加的计数'''
+    kind = 'counter'
+
+    def __init__(self, name, help='') -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+    '''读的时候调用 func 取值，func 返回 None 表示现在没有这个值（比如串口没有打开）'''
+    def __init__(self, name, help='', func=None, kind='gauge') -> None:
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+
+    @property
+    def value(self):
+        try:
+            return self.func()
+        except Exception:
+            return None
+
+
+class Timer:
+    '''记录每次花的时间（秒）'''
+    kind = 'summary'
+
+    def __init__(self, name, help='', max_value=10.0) -> None:
+        self.name = name
+        self.help = help
+        self.histogram = Histogram(max_value=max_value)
+
+    def record(self, seconds):
+        self.histogram.record(seconds)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram.record(time.perf_counter() - start)
+
+    @property
+    def count(self):
+        return self.histogram.count
+
+    @property
+    def total(self):
+        return self.histogram.total
+
+    @property
+    def value(self):
+        return self.histogram.total
+
+
+class Registry:
+    '''一组指标，按照名字取，已经有了就返回原来的'''
+    def __init__(self) -> None:
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('指标 {} 已经是别的类型了'.format(name))
+            return metric
+
+    def counter(self, name, help='') -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help='', func=None, kind='gauge') -> Gauge:
+        gauge = self._get(Gauge, name, help, func, kind)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def timer(self, name, help='', max_value=10.0) -> Timer:
+        return self._get(Timer, name, help, max_value)
+
+    def collect(self) -> list:
+        '''所有的指标，按照名字排序'''
+        with self._lock:
+            return sorted(self.metrics.values(), key=lambda metric: metric.name)
+
+    def prometheus(self) -> str:
+        '''Prometheus 的文本格式'''
+        lines = []
+        for metric in self.collect():
+            name = PREFIX + metric.name
+            if isinstance(metric, Timer):
+                h = metric.histogram
+                lines.append('# HELP {}_seconds {}'.format(name, metric.help or metric.name))
+                lines.append('# TYPE {}_seconds summary'.format(name))
+                for q in QUANTILES:
+                    lines.append('{}_seconds{{quantile="{}"}} {:.9g}'.format(name, q, h.percentile(q * 100)))
+                lines.append('{}_seconds_sum {:.9g}'.format(name, h.total))
+                lines.append('{}_seconds_count {}'.format(name, h.count))
+                continue
+            value = metric.value
+            if value is None:
+                continue
+            if metric.kind == 'counter' and not name.endswith('_total'):
+                name += '_total'
+            lines.append('# HELP {} {}'.format(name, metric.help or metric.name))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            lines.append('{} {:.9g}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不往 stderr 打印每一个请求
+        pass
+
+
+class MetricsServer:
+    '''在本机的端口上提供 /metrics，port 是 0 的时候自动分配'''
+    def __init__(self, registry=REGISTRY, port=9100, host='127.0.0.1') -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = self.registry
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='MetricsServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def is_running(self):
+        return self._server is not None
+
+
+class SamplingProfiler:
+    '''定时取所有线程的调用栈，统计每个调用栈出现的次数'''
+    def __init__(self, interval=0.005, max_depth=64) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = {} # (线程名, 栈) -> 次数，栈是从外到里的函数名
+        self.samples = 0
+        self.start_time = None
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.stacks = {}
+        self.samples = 0
+        self._stop.clear()
+        self.start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self.run, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join(1.0)
+        if self.start_time is not None:
+            self.elapsed = time.perf_counter() - self.start_time
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self):
+        me = threading.get_ident()
+        cache = {} # code 对象 -> 显示的名字
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    name = cache.get(code)
+                    if name is None:
+                        name = cache[code] = '{} ({}:{})'.format(
+                            code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                    stack.append(name)
+                    frame = frame.f_back
+                key = (names.get(ident, str(ident)), tuple(reversed(stack)))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def top(self, n=20) -> list:
+        '''最耗时的函数，[(只算自己的次数, 算上调用的次数, 函数)]'''
+        own = {}
+        total = {}
+        for (_, stack), count in list(self.stacks.items()):
+            if not stack:
+                continue
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for name in set(stack):
+                total[name] = total.get(name, 0) + count
+        rows = [(own.get(name, 0), count, name) for name, count in total.items()]
+        rows.sort(reverse=True)
+        return rows[:n]
+
+    def report(self, n=20) -> str:
+        lines = ['采样 {} 次，{:.1f} 秒，间隔 {:g} ms'.format(self.samples, self.elapsed, self.interval * 1000),
+                 '{:>8} {:>8}  函数'.format('自己', '总共')]
+        for own, count, name in self.top(n):
+            lines.append('{:>8} {:>8}  {}'.format(own, count, name))
+        return '\n'.join(lines)
+
+    def collapsed(self) -> str:
+        '''折叠的调用栈，每行 "线程;外层;...;里层 次数"，flamegraph.pl 和 speedscope 都能读'''
+        return '\n'.join('{};{} {}'.format(thread, ';'.join(stack), count)
+                         for (thread, stack), count in sorted(self.stacks.items())) + '\n'
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+
+
+def _test():
+    import urllib.request
+    registry = Registry()
+    errors = registry.counter('errors', '出错的次数')
+    errors.inc()
+    errors.inc(2)
+    assert registry.counter('errors') is errors and errors.value == 3
+    backlog = [5]
+    registry.gauge('backlog_bytes', '积压的字节数', lambda: backlog[0])
+    registry.gauge('bytes_read', '收到的字节数', lambda: None, kind='counter')
+    decode = registry.timer('decode', '解码的时间')
+    for i in range(1, 101):
+        decode.record(i / 1e6)
+    text = registry.prometheus()
+    assert 'comhelper_errors_total 3\n' in text and 'comhelper_backlog_bytes 5\n' in text, text
+    assert 'comhelper_bytes_read' not in text
+    assert 'comhelper_decode_seconds_count 100\n' in text and '# TYPE comhelper_decode_seconds summary' in text
+    server = MetricsServer(registry, port=0).start()
+    try:
+        backlog[0] = 7
+        with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.port), timeout=2) as response:
+            body = response.read().decode('utf-8')
+        assert 'comhelper_backlog_bytes 7\n' in body
+    finally:
+        server.stop()
+
+
+def _benchmark(count=200000):
+    # 热路径上加的开销：Timer.time() 和 record()
+    registry = Registry()
+    timer = registry.timer('decode')
+    counter = registry.counter('calls')
+    t = time.perf_counter()
+    for _ in range(count):
+        with timer.time():
+            pass
+    with_context = (time.perf_counter() - t) / count
+    t = time.perf_counter()
+    for _ in range(count):
+        counter.inc()
+    inc = (time.perf_counter() - t) / count
+    print('Timer.time() 一次 {:.2f} 微秒，Counter.inc() 一次 {:.3f} 微秒'.format(with_context * 1e6, inc * 1e6))
+    # 采样分析：忙的线程应该排在最前边
+    def busy(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            sum(range(1000))
+    profiler = SamplingProfiler(interval=0.002).start()
+    busy(1.0)
+    profiler.stop()
+    print(profiler.report(5))
+    assert any('busy' in name for _, _, name in profiler.top(5))
+    assert profiler.collapsed().count('\n') == len(profiler.stacks)
+
+
+if __name__ == '__main__':
+    _test()
+    _benchmark()
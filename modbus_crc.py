@@ -1,6 +1,90 @@
 # 计算modbus的crc的
+# modbus的crc是反射的crc16，多项式0xA001，初始值0xFFFF，没有结果异或。
+# 这里用查表法代替逐位的循环：
+#   - _CRC_TABLE 是标准的256项表，一次处理一个字节。
+#   - _crc_table16 是slice-by-2的65536项表，一次处理两个字节，第一次用到的时候才生成。
+# 接收的时候可以用 ModbusCrc 的 update() 一段一段地算，多个帧一起校验用 check_frames()。
+
+import sys
+
+CRC_INIT = 0xffff # 初始值
+CRC_POLY = 0xA001 # 反射后的多项式
+
+# 数据长度超过这个值才用两字节一组的表，短的帧直接一个字节一个字节的查表更快。
+WIDE_THRESHOLD = 64
+
+
+def _make_table(poly=CRC_POLY):
+    # 生成256项的表，每一项就是原来逐位循环8次的结果。
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ poly
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+_CRC_TABLE = _make_table()
+_crc_table16 = None # slice-by-2的表，延迟生成。
+
+
+def _get_table16():
+    # 两个字节一组的表，下标是 crc ^ 小端的16位字。
+    # crc ^= b0 | b1 << 8 之后，新的crc = T1[低字节] ^ T0[高字节]，
+    # 其中 T1[i] = (T0[i] >> 8) ^ T0[T0[i] & 0xff]，这里直接展开成65536项。
+    global _crc_table16
+    if _crc_table16 is None:
+        t0 = _CRC_TABLE
+        t1 = [(t0[i] >> 8) ^ t0[t0[i] & 0xff] for i in range(256)]
+        _crc_table16 = [t1[lo] ^ t0[hi] for hi in range(256) for lo in range(256)]
+    return _crc_table16
+
+
+def _update_bytewise(crc, data):
+    table = _CRC_TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+    return crc
+
+
+def _update_wide(crc, data):
+    # 按照小端的16位字来遍历，只有小端的机器才能直接cast。
+    mv = memoryview(data).cast('B')
+    n = len(mv)
+    even = n & ~1
+    table16 = _get_table16()
+    for w in mv[:even].cast('H'):
+        crc = table16[crc ^ w]
+    if n & 1:
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ mv[even]) & 0xff]
+    return crc
+
+
+def crc16_update(crc, data):
+    '''在原有的crc寄存器上继续计算data，返回新的寄存器值（没有交换字节）；
+    data 可以是 bytes 这样的对象，也可以是 int 的列表'''
+    if len(data) >= WIDE_THRESHOLD and sys.byteorder == 'little':
+        try:
+            view = memoryview(data)
+        except TypeError:
+            # 不支持缓冲区协议（比如 int 的列表），只能一个一个地算
+            return _update_bytewise(crc, data)
+        return _update_wide(crc, view)
+    return _update_bytewise(crc, data)
+
 
 def modbus_crc(data):
+    # 返回值是高字节在前的，也就是 hex 之后和帧里边的两个字节顺序一样。
+    crc = crc16_update(CRC_INIT, data)
+    return ((crc & 0xff) << 8 ) + (crc >> 8)
+
+
+def modbus_crc_bitwise(data):
+    # 原来的逐位计算的方法，留着做对比和校验用。
     crc = 0xffff
     for pos in data:
         crc ^= pos
@@ -12,10 +96,123 @@ def modbus_crc(data):
                 crc >>= 1
     return ((crc & 0xff) << 8 ) + (crc >> 8)
 
+
+class ModbusCrc:
+    '''可以增量计算的crc，串口分几次读到的数据可以一段一段地 update'''
+    def __init__(self, data=None) -> None:
+        self.crc = CRC_INIT
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        self.crc = crc16_update(self.crc, data)
+        return self
+
+    def reset(self):
+        self.crc = CRC_INIT
+        return self
+
+    def copy(self):
+        other = ModbusCrc()
+        other.crc = self.crc
+        return other
+
+    def value(self):
+        # 和 modbus_crc() 的返回值一样。
+        return ((self.crc & 0xff) << 8) + (self.crc >> 8)
+
+    def digest(self):
+        # 帧里边的两个字节，低字节在前。
+        return bytes((self.crc & 0xff, self.crc >> 8))
+
+    def is_valid(self):
+        # 如果update的数据已经包含了结尾的crc，那么寄存器就是0。
+        return self.crc == 0
+
+
+def append_crc(data):
+    '''在数据后边加上两个字节的crc，返回bytes'''
+    crc = crc16_update(CRC_INIT, data)
+    return bytes(data) + bytes((crc & 0xff, crc >> 8))
+
+
+def check_frame(frame):
+    '''校验一个包含crc的完整帧'''
+    if len(frame) < 3:
+        return False
+    return crc16_update(CRC_INIT, frame) == 0
+
+
+def check_frames(frames):
+    '''一次校验多个帧，返回每个帧是否正确的列表'''
+    # 这里把查表的循环展开到一个函数里边，省掉每个帧的函数调用。
+    table = _CRC_TABLE
+    wide = sys.byteorder == 'little'
+    result = []
+    append = result.append
+    for frame in frames:
+        if len(frame) < 3:
+            append(False)
+            continue
+        if wide and len(frame) >= WIDE_THRESHOLD:
+            append(crc16_update(CRC_INIT, frame) == 0)
+            continue
+        crc = CRC_INIT
+        for b in frame:
+            crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+        append(crc == 0)
+    return result
+
+
+def _benchmark():
+    # 和原来的逐位算法比较一下速度，并且用随机数据交叉验证。
+    import random
+    import time
+
+    rnd = random.Random(0)
+    for n in list(range(0, 70)) + [127, 128, 255, 256, 1000, 4097]:
+        for _ in range(20):
+            data = bytes(rnd.getrandbits(8) for _ in range(n))
+            assert modbus_crc(data) == modbus_crc_bitwise(data), data
+            # 分段计算的结果也要一样
+            cut = rnd.randint(0, n)
+            assert ModbusCrc(data[:cut]).update(data[cut:]).value() == modbus_crc(data)
+            assert check_frame(append_crc(data)) == (n + 2 >= 3)
+            # int 的列表也可以
+            assert modbus_crc(list(data)) == modbus_crc(data)
+
+    def timeit(func, *args, repeat=3):
+        best = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            func(*args)
+            t = time.perf_counter() - t
+            best = t if best is None else min(best, t)
+        return best
+
+    big = bytes(rnd.getrandbits(8) for _ in range(1 << 20))
+    t_old = timeit(modbus_crc_bitwise, big, repeat=1)
+    t_byte = timeit(lambda d: _update_bytewise(CRC_INIT, d), big)
+    t_new = timeit(modbus_crc, big)
+    print('1 MiB 逐位: {:.1f} ms, 查表: {:.1f} ms, slice-by-2: {:.1f} ms, 提升 {:.1f} 倍'.format(
+        t_old * 1e3, t_byte * 1e3, t_new * 1e3, t_old / t_new))
+
+    frames = [append_crc(bytes(rnd.getrandbits(8) for _ in range(6))) for _ in range(100000)]
+    t_old = timeit(lambda fs: [modbus_crc_bitwise(f) == 0 for f in fs], frames, repeat=1)
+    t_new = timeit(check_frames, frames)
+    assert all(check_frames(frames))
+    print('10万个8字节帧 逐位: {:.1f} ms, check_frames: {:.1f} ms, 提升 {:.1f} 倍'.format(
+        t_old * 1e3, t_new * 1e3, t_old / t_new))
+
+
 if __name__ == '__main__':
     s = b'\x01\x03\x01\x89\x00\x02'
     s2 = modbus_crc(s)
     assert s2&0xff == 0x1d
     assert s2>>8&0xff == 0x14
     assert s2 == 0x141d
-    print(hex(modbus_crc(s)))
\ No newline at end of file
+    assert modbus_crc_bitwise(s) == 0x141d
+    assert ModbusCrc(s[:3]).update(s[3:]).value() == 0x141d
+    assert check_frames([s + b'\x14\x1d', s + b'\x1d\x14']) == [True, False]
+    print(hex(modbus_crc(s)))
+    _benchmark()
@@ -0,0 +1,152 @@
+# modbus 寄存器数据的解码和编码
+# 寄存器的原始字节（高字节在前）按照数据类型和字节顺序批量转换成数值，没有逐个数值的Python循环：
+#   1. BADC、CDAB 先把每个寄存器里边的两个字节交换（array('H').byteswap()，在C里边完成）；
+#   2. 然后按照大端（ABCD、BADC）或者小端（CDAB、DCBA）整块转成 array，需要的话 byteswap()。
+# 以32位为例，ABCD 是大端，DCBA 是小端，BADC 是每个寄存器字节交换，CDAB 是两个寄存器交换；
+# 64位的时候 CDAB 表示寄存器的顺序反过来（GH EF CD AB）。16位的数据只看寄存器里边的字节顺序。
+# 安装了 numpy 的时候 decode_numpy() 直接返回 numpy 的数组（对原始数据的视图）。
+
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BYTE_ORDERS = ('ABCD', 'BADC', 'CDAB', 'DCBA')
+
+# 数据类型 -> array 的类型码
+DATA_STYLES = {
+    'uint16': 'H',
+    'int16': 'h',
+    'uint32': 'I',
+    'int32': 'i',
+    'int64': 'q',
+    'float32': 'f',
+    'float64': 'd',
+}
+
+
+def _typecode(data_style):
+    try:
+        return DATA_STYLES[data_style]
+    except KeyError:
+        raise ValueError('不支持的数据类型：{}'.format(data_style)) from None
+
+
+def registers_per_value(data_style) -> int:
+    '''一个数值占几个寄存器'''
+    return array(_typecode(data_style)).itemsize // 2
+
+
+def swap_register_bytes(data) -> bytes:
+    '''每个寄存器里边的两个字节交换'''
+    words = array('H')
+    words.frombytes(memoryview(data)[:len(data) & ~1])
+    words.byteswap()
+    return words.tobytes()
+
+
+def _prepare(data, data_style, byte_order):
+    # 返回 (整理好的数据, 是否大端, 类型码)
+    if byte_order not in BYTE_ORDERS:
+        raise ValueError('不支持的字节顺序：{}'.format(byte_order))
+    typecode = _typecode(data_style)
+    size = array(typecode).itemsize
+    data = memoryview(data)[:len(data) // size * size]
+    if byte_order in ('BADC', 'CDAB'):
+        data = swap_register_bytes(data)
+    return data, byte_order in ('ABCD', 'BADC'), typecode
+
+
+def decode(data, data_style='uint16', byte_order='ABCD') -> array:
+    '''把寄存器的原始字节转成数值，返回 array，最后不够一个数值的字节丢掉'''
+    data, big, typecode = _prepare(data, data_style, byte_order)
+    values = array(typecode)
+    values.frombytes(data)
+    if big != (sys.byteorder == 'big'):
+        values.byteswap()
+    return values
+
+
+def decode_numpy(data, data_style='uint16', byte_order='ABCD'):
+    '''和 decode() 一样，返回 numpy 的数组，需要安装 numpy'''
+    if numpy is None:
+        raise RuntimeError('decode_numpy 需要安装 numpy')
+    data, big, typecode = _prepare(data, data_style, byte_order)
+    return numpy.frombuffer(data, dtype=numpy.dtype(typecode).newbyteorder('>' if big else '<'))
+
+
+def encode(values, data_style='uint16', byte_order='ABCD') -> bytes:
+    '''把数值转成寄存器的原始字节，写寄存器的时候用'''
+    if byte_order not in BYTE_ORDERS:
+        raise ValueError('不支持的字节顺序：{}'.format(byte_order))
+    typecode = _typecode(data_style)
+    if typecode not in 'fd':
+        values = [int(v) for v in values]
+    data = array(typecode, values)
+    if (byte_order in ('ABCD', 'BADC')) != (sys.byteorder == 'big'):
+        data.byteswap()
+    data = data.tobytes()
+    if byte_order in ('BADC', 'CDAB'):
+        data = swap_register_bytes(data)
+    return data
+
+
+def parse_values(text, data_style='uint16') -> list:
+    '''把界面上输入的文本（空格或者换行分开）转成数值，整数可以用0x开头的十六进制'''
+    if _typecode(data_style) in 'fd':
+        return [float(i) for i in text.split()]
+    return [int(i, 0) for i in text.split()]
+
+
+def _benchmark(count=1000000):
+    # 用 struct 逐个解码交叉验证，然后解码100万个寄存器
+    import random
+    import struct
+    import time
+
+    rnd = random.Random(0)
+    raw = bytes(rnd.getrandbits(8) for _ in range(64))
+
+    def to_big(chunk, byte_order):
+        # 按照定义把线路上的字节还原成大端（A是最高字节）
+        if byte_order == 'DCBA':
+            return chunk[::-1]
+        if byte_order == 'BADC':
+            return swap_register_bytes(chunk)
+        if byte_order == 'CDAB':
+            return b''.join(chunk[i:i + 2] for i in range(len(chunk) - 2, -2, -2))
+        return chunk
+
+    for data_style, typecode in DATA_STYLES.items():
+        size = struct.calcsize(typecode)
+        for byte_order in BYTE_ORDERS:
+            expect = [struct.unpack('>' + typecode, to_big(raw[i:i + size], byte_order))[0]
+                      for i in range(0, len(raw), size)]
+            got = decode(raw, data_style, byte_order)
+            assert [repr(v) for v in got] == [repr(v) for v in expect], (data_style, byte_order)
+            assert encode(got, data_style, byte_order) == raw, (data_style, byte_order)
+            if numpy is not None:
+                assert decode_numpy(raw, data_style, byte_order).astype(typecode).tobytes() == got.tobytes()
+    raw = bytes(rnd.getrandbits(8) for _ in range(4096)) * (count * 2 // 4096)
+    print('{} 个寄存器（{} 字节）：'.format(len(raw) // 2, len(raw)))
+    for data_style in DATA_STYLES:
+        times = []
+        for byte_order in BYTE_ORDERS:
+            t = time.perf_counter()
+            decode(raw, data_style, byte_order)
+            times.append((time.perf_counter() - t) * 1000)
+        print('  {:8} {}'.format(data_style, '  '.join('{} {:.1f} ms'.format(o, t) for o, t in zip(BYTE_ORDERS, times))))
+    t = time.perf_counter()
+    [v[0] for v in struct.iter_unpack('>f', raw)]
+    print('  对比 struct.iter_unpack 逐个取值 float32 ABCD: {:.1f} ms'.format((time.perf_counter() - t) * 1000))
+    if numpy is not None:
+        t = time.perf_counter()
+        decode_numpy(raw, 'float32', 'CDAB')
+        print('  numpy float32 CDAB: {:.1f} ms'.format((time.perf_counter() - t) * 1000))
+
+
+if __name__ == '__main__':
+    _benchmark()
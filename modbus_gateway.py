@@ -0,0 +1,423 @@
+# modbus 网关：监听TCP端口，把 Modbus TCP（MBAP报文头）和 RTU over TCP 的请求转发到串口
+# 串口是半双工的，同一时间只能有一个请求：
+#   - 每个TCP客户端一个队列，总线按照客户端轮流取请求（公平，一个客户端发很多请求也不会饿死别人）；
+#   - 客户端可以连续发很多请求不等应答（流水线），应答按照请求的顺序发回去；
+#   - 同样的读请求正在排队或者正在执行的，合并成一个；打开缓存以后，短时间内同样的读请求直接用缓存的应答。
+# 串口的收发在一个单独的线程里边做（ModbusMaster.forward 会阻塞），asyncio 只管网络。
+
+import asyncio
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from modbus_crc import append_crc, check_frame
+from modbus_rtu import ModbusError, read_functions
+from modbus_slave import request_length
+
+MODE_TCP = 'tcp'
+MODE_RTU = 'rtu'
+# 网关目标设备响应失败
+GATEWAY_TARGET_FAILED = 0x0B
+# 每个客户端最多排队的请求数，超过了就不再读这个客户端的数据
+DEFAULT_MAX_PENDING = 32
+# 缓存的条数超过这个数就清理过期的
+CACHE_PURGE_SIZE = 4096
+
+
+class _Client:
+    # 一个TCP连接
+    def __init__(self, name, mode) -> None:
+        self.name = name
+        self.mode = mode
+        self.queue = deque() # (请求, future, 排队的时候从站的写入代数)
+        self.requests = 0
+        self.cache_hits = 0
+
+
+class Gateway:
+    '''modbus 网关，master 是 modbus_rtu.ModbusMaster'''
+    def __init__(self, master, cache_ttl=0.0, max_pending=DEFAULT_MAX_PENDING) -> None:
+        self.master = master
+        self.cache_ttl = cache_ttl # 秒，0表示不缓存
+        self.max_pending = max_pending
+        self.ports = {} # 模式 -> 实际监听的端口
+        self._cache = {} # 请求 -> (过期时间, 应答)
+        self._inflight = {} # 正在排队或者执行的读请求 -> future
+        # 每个从站写一次加一，广播写一次 _broadcasts 加一；读请求排队以后从站被写过了，应答就不能合并也不能缓存
+        self._generations = {}
+        self._broadcasts = 0
+        # 按照这个顺序轮流；断开了的客户端没有发完的请求放到 _orphans 里边接着发
+        self._orphans = _Client(None, None)
+        self._clients = deque([self._orphans])
+        self._servers = []
+        self._connections = set() # 每个连接的任务，关闭的时候取消
+        self._ready = None
+        self._bus_task = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='ModbusGatewayBus')
+        self._loop = None
+        self._thread = None
+        # 统计信息
+        self.requests = 0
+        self.bus_requests = 0
+        self.cache_hits = 0
+        self.merged = 0
+        self.failures = 0
+        self.max_queue = 0
+        self.bus_busy = 0.0
+        self.start_time = time.perf_counter()
+
+    # 启动和停止
+    async def start(self, host='127.0.0.1', port=502, rtu_port=None):
+        '''port 是 Modbus TCP 的端口，rtu_port 是 RTU over TCP 的端口，None 表示不监听，0 表示随便选一个'''
+        self._ready = asyncio.Event()
+        self._bus_task = asyncio.get_running_loop().create_task(self._bus())
+        for mode, number, handler in ((MODE_TCP, port, self._handle_tcp), (MODE_RTU, rtu_port, self._handle_rtu)):
+            if number is None:
+                continue
+            server = await asyncio.start_server(handler, host, number)
+            self._servers.append(server)
+            self.ports[mode] = server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers.clear()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        if self._bus_task is not None:
+            self._bus_task.cancel()
+        self._executor.shutdown(wait=False)
+
+    def start_thread(self, host='127.0.0.1', port=502, rtu_port=None):
+        '''在一个单独的线程里边运行事件循环（界面用），监听失败的时候抛出 OSError'''
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.start(host, port, rtu_port))
+            except OSError as err:
+                errors.append(err)
+                ready.set()
+                loop.close()
+                return
+            ready.set()
+            loop.run_forever()
+            loop.run_until_complete(self.close())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name='ModbusGateway', daemon=True)
+        self._thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+        self._loop = loop
+        return self
+
+    def stop_thread(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(2.0)
+            self._loop = None
+
+    # 调度
+    async def submit(self, client, request) -> bytes:
+        '''把一个RTU请求排到总线上，返回RTU应答（广播返回 b''），失败抛出 ModbusError'''
+        self.requests += 1
+        client.requests += 1
+        is_read = request[1] in read_functions
+        if is_read:
+            if self.cache_ttl > 0:
+                hit = self._cache.get(request)
+                if hit is not None and hit[0] > time.perf_counter():
+                    self.cache_hits += 1
+                    client.cache_hits += 1
+                    return hit[1]
+            future = self._inflight.get(request)
+            if future is not None:
+                self.merged += 1
+                return await asyncio.shield(future)
+        else:
+            # 写了以后这个从站的缓存和写之前排队的读请求都不能用了，广播的时候全部作废
+            unit = request[0]
+            if unit == 0:
+                self._broadcasts += 1
+            else:
+                self._generations[unit] = self._generations.get(unit, 0) + 1
+            for table in (self._cache, self._inflight):
+                for key in [k for k in table if unit == 0 or k[0] == unit]:
+                    del table[key]
+        future = asyncio.get_running_loop().create_future()
+        if is_read:
+            self._inflight[request] = future
+        client.queue.append((request, future, self._generation(request[0])))
+        self.max_queue = max(self.max_queue, sum(len(c.queue) for c in self._clients))
+        self._ready.set()
+        return await asyncio.shield(future)
+
+    def _generation(self, unit):
+        return self._broadcasts, self._generations.get(unit, 0)
+
+    def _next(self):
+        # 轮流从每个客户端取一个请求
+        for _ in range(len(self._clients)):
+            client = self._clients[0]
+            self._clients.rotate(-1)
+            if client.queue:
+                return client.queue.popleft()
+        return None
+
+    async def _bus(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = self._next()
+            if item is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            request, future, generation = item
+            start = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(self._executor, self.master.forward, request)
+                error = None
+            except (ModbusError, OSError) as err:
+                response = None
+                error = err
+                self.failures += 1
+            end = time.perf_counter()
+            self.bus_busy += end - start
+            self.bus_requests += 1
+            if self._inflight.get(request) is future:
+                del self._inflight[request]
+            if response and self.cache_ttl > 0 and request[1] in read_functions and \
+                    generation == self._generation(request[0]):
+                if len(self._cache) > CACHE_PURGE_SIZE:
+                    self._cache = {k: v for k, v in self._cache.items() if v[0] > end}
+                self._cache[request] = (end + self.cache_ttl, response)
+            if not future.done():
+                if error is None:
+                    future.set_result(response)
+                else:
+                    future.set_exception(error)
+
+    # 网络
+    def _add_client(self, writer, mode):
+        client = _Client(writer.get_extra_info('peername'), mode)
+        self._clients.append(client)
+        return client
+
+    def _remove_client(self, client):
+        try:
+            self._clients.remove(client)
+        except ValueError:
+            pass
+        # 已经收到的请求还是要发（写请求不能丢，读请求可能别的客户端也在等）
+        self._orphans.queue.extend(client.queue)
+        client.queue.clear()
+
+    async def _serve(self, client, reader, writer, read_requests, make_reply):
+        # 一个连接：读请求的协程把请求排到总线上，发应答的协程按照顺序等结果
+        replies = asyncio.Queue(self.max_pending)
+
+        async def send_replies():
+            while True:
+                item = await replies.get()
+                if item is None:
+                    return
+                context, task = item
+                try:
+                    response = await task
+                except (ModbusError, OSError):
+                    response = None
+                except asyncio.CancelledError:
+                    continue
+                reply = make_reply(context, response)
+                if reply:
+                    writer.write(reply)
+                    await writer.drain()
+
+        sender = asyncio.get_running_loop().create_task(send_replies())
+        this = asyncio.current_task()
+        self._connections.add(this)
+        try:
+            async for context, request in read_requests(reader):
+                task = asyncio.ensure_future(self.submit(client, request))
+                await replies.put((context, task))
+            # 对方不再发请求了，把已经收到的请求的应答发完
+            await replies.put(None)
+            await sender
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(this)
+            self._remove_client(client)
+            sender.cancel()
+            writer.close()
+
+    async def _handle_tcp(self, reader, writer):
+        client = self._add_client(writer, MODE_TCP)
+
+        async def read_requests(reader):
+            while True:
+                header = await reader.readexactly(7)
+                tid, pid, length, unit = struct.unpack('>HHHB', header)
+                if pid != 0 or not 2 <= length <= 254:
+                    return # 不是modbus的报文，断开
+                pdu = await reader.readexactly(length - 1)
+                yield (tid, unit, pdu[0]), append_crc(bytes([unit]) + pdu)
+
+        def make_reply(context, response):
+            tid, unit, function = context
+            if response is None:
+                pdu = bytes([function | 0x80, GATEWAY_TARGET_FAILED])
+            elif not response:
+                return None # 广播没有应答
+            else:
+                pdu = response[1:-2]
+            return struct.pack('>HHHB', tid, 0, len(pdu) + 1, unit) + pdu
+
+        await self._serve(client, reader, writer, read_requests, make_reply)
+
+    async def _handle_rtu(self, reader, writer):
+        client = self._add_client(writer, MODE_RTU)
+
+        async def read_requests(reader):
+            buf = bytearray()
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    return
+                buf += data
+                while buf:
+                    size = request_length(buf)
+                    if size is None:
+                        break
+                    if size < 0:
+                        size = len(buf) # 不认识的功能码，收到的当成一帧
+                    if len(buf) < size:
+                        break
+                    frame = bytes(buf[:size])
+                    del buf[:size]
+                    if check_frame(frame):
+                        yield None, frame
+
+        def make_reply(context, response):
+            # RTU over TCP 失败的时候不应答，和串口上一样让主站超时
+            return response or None
+
+        await self._serve(client, reader, writer, read_requests, make_reply)
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'clients': len(self._clients) - 1,
+            'requests': self.requests,
+            'bus_requests': self.bus_requests,
+            'cache_hits': self.cache_hits,
+            'merged': self.merged,
+            'failures': self.failures,
+            'max_queue': self.max_queue,
+            'bus_busy': self.bus_busy / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+async def _test_clients(gateway, same=False, clients=8, count=50):
+    # 很多个TCP客户端同时连续发请求，检查应答和公平；same 表示所有客户端都读一样的寄存器
+    port = gateway.ports[MODE_TCP]
+    done_times = {}
+
+    async def tcp_client(n):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        # 流水线：先把所有的请求发出去，再按顺序收应答
+        size = 4 if same else n + 1
+        for tid in range(count):
+            writer.write(struct.pack('>HHHBBHH', tid, 0, 6, 1, 3, 0 if same else tid, size))
+        await writer.drain()
+        for tid in range(count):
+            header = await reader.readexactly(7)
+            rtid, _, length, unit = struct.unpack('>HHHB', header)
+            pdu = await reader.readexactly(length - 1)
+            address = 0 if same else tid
+            assert rtid == tid and pdu[0] == 3
+            assert struct.unpack('>{}H'.format(size), pdu[2:]) == tuple(range(address, address + size))
+        done_times[n] = time.perf_counter()
+        # 从站不存在：网关返回 0x0B
+        writer.write(struct.pack('>HHHBBHH', 99, 0, 6, 9, 3, 0, 1))
+        await writer.drain()
+        header = await reader.readexactly(7)
+        pdu = await reader.readexactly(struct.unpack('>HHHB', header)[2] - 1)
+        assert pdu == bytes([0x83, GATEWAY_TARGET_FAILED])
+        writer.close()
+
+    async def rtu_client():
+        reader, writer = await asyncio.open_connection('127.0.0.1', gateway.ports[MODE_RTU])
+        writer.write(append_crc(bytes([1, 6, 0, 200, 0x12, 0x34])))
+        reply = await reader.readexactly(8)
+        assert reply[:6] == bytes([1, 6, 0, 200, 0x12, 0x34])
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(rtu_client(), *[tcp_client(n) for n in range(clients)])
+    finish = sorted(t - start for t in done_times.values())
+    return finish
+
+
+async def _test_write_order(gateway):
+    # 一个连接上连着发：读、写、读，第二个读不能合并到写之前的读上，也不能用写之前的缓存
+    reader, writer = await asyncio.open_connection('127.0.0.1', gateway.ports[MODE_TCP])
+    writer.write(struct.pack('>HHHBBHH', 1, 0, 6, 1, 3, 0, 1) + struct.pack('>HHHBBHH', 2, 0, 6, 1, 6, 0, 222) +
+                 struct.pack('>HHHBBHH', 3, 0, 6, 1, 3, 0, 1))
+    await writer.drain()
+    replies = []
+    for _ in range(3):
+        header = await reader.readexactly(7)
+        replies.append(await reader.readexactly(struct.unpack('>HHHB', header)[2] - 1))
+    writer.write(struct.pack('>HHHBBHH', 4, 0, 6, 1, 3, 0, 1))
+    await writer.drain()
+    header = await reader.readexactly(7)
+    replies.append(await reader.readexactly(struct.unpack('>HHHB', header)[2] - 1))
+    writer.close()
+    return replies
+
+
+def _self_test(baudrate=115200):
+    import os
+    from modbus_rtu import ModbusMaster, SerialTransport
+    from modbus_slave import open_slave, PtyPort
+    from serial_session import char_time
+    master_fd, slave_fd = os.openpty()
+    slave = open_slave(os.ttyname(slave_fd), baudrate)
+    slave.store(1).set_registers(0, range(200))
+    slave.start()
+    master = ModbusMaster(SerialTransport(PtyPort(master_fd)), char_time(baudrate), timeout=0.1, retries=0, gap=slave.gap)
+    for name, same, ttl in (('各不相同', False, 0.0), ('同样的读请求', True, 0.0), ('同样的读请求，缓存50ms', True, 0.05)):
+        gateway = Gateway(master, cache_ttl=ttl).start_thread(port=0, rtu_port=0)
+        finish = asyncio.run(_test_clients(gateway, same))
+        stats = gateway.stats()
+        gateway.stop_thread()
+        print('{}：{} 个请求，总线上 {} 个（合并 {}，缓存命中 {}），最多排队 {}；各个客户端完成时间 {:.3f} - {:.3f} 秒'.format(
+            name, stats['requests'], stats['bus_requests'], stats['merged'], stats['cache_hits'], stats['max_queue'],
+            finish[0], finish[-1]))
+    assert slave.store(1).holding_registers[200] == 0x1234
+    for ttl in (0.0, 10.0):
+        slave.store(1).set_registers(0, [111])
+        gateway = Gateway(master, cache_ttl=ttl).start_thread(port=0, rtu_port=0)
+        replies = asyncio.run(_test_write_order(gateway))
+        gateway.stop_thread()
+        assert replies == [bytes([3, 2, 0, 111]), bytes([6, 0, 0, 0, 222]), bytes([3, 2, 0, 222]), bytes([3, 2, 0, 222])], \
+            (ttl, replies)
+    slave.stop()
+    slave.serial.close()
+    master.transport.serial.close()
+    os.close(slave_fd)
+
+
+if __name__ == '__main__':
+    _self_test()
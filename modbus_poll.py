@@ -0,0 +1,314 @@
+# modbus 循环轮询
+# 轮询表里边每一项是一个从站的一段地址和轮询周期，
+# 同一个从站、同一个功能码、同一个周期的地址段，相邻或者重叠的合并成一个请求，
+# 一个请求最多 125 个寄存器（线圈是2000个），这样总线上的请求数量少很多。
+# max_gap 大于 0 的时候中间空几个的也合并，会读到没有要的地址，从站不支持这些地址的时候会异常应答，
+# 这时候这个请求以后分开读每一项，只有真的出错的那一项算错。
+# 调度按照截止时间，最早到期的先发；到期时间按照周期累加，不会越来越慢。
+# 轮询表的文件格式（csv，#开头的行是注释）：
+#   从站,功能码,地址,个数,周期(ms),名称
+#   1,3,0x0000,10,100,温度
+
+import csv
+import heapq
+import threading
+import time
+
+from modbus_rtu import (ModbusError, ModbusExceptionResponse, build_read, response_length, read_functions,
+                        READ_COILS, READ_DISCRETE_INPUTS, MAX_READ_BITS, MAX_READ_REGISTERS)
+
+# 两段地址中间空着的寄存器不超过这个数就合并；默认只合并相邻和重叠的，不读没有要的地址
+DEFAULT_MAX_GAP = 0
+
+
+class PollItem:
+    '''轮询表里边的一项'''
+    def __init__(self, unit, function, address, count, period, name=None) -> None:
+        if function not in read_functions:
+            raise ValueError('轮询只能用读的功能码：{}'.format(function))
+        self.unit = unit
+        self.function = function
+        self.address = address
+        self.count = count
+        self.period = period # 秒
+        self.name = name if name else '{}:{:02d}:{:04X}'.format(unit, function, address)
+        # 最新的结果，寄存器是原始字节（高字节在前），线圈是 0/1 的列表
+        self.value = None
+        self.timestamp = None # time.perf_counter()
+        self.error = None
+
+    def __repr__(self):
+        return 'PollItem({}, {}, 0x{:04X}, {}, {})'.format(self.unit, self.function, self.address, self.count, self.period)
+
+
+class PollBlock:
+    '''合并以后的一个请求'''
+    def __init__(self, unit, function, address, count, period, items) -> None:
+        self.unit = unit
+        self.function = function
+        self.address = address
+        self.count = count
+        self.period = period
+        self.items = items
+        self.request = build_read(unit, function, address, count)
+        self.parts = None # 合并的请求异常应答以后，分开读的每一项
+        self.due = 0.0
+        # 统计信息
+        self.scans = 0
+        self.errors = 0
+        self.late = 0 # 开始的时候已经晚了一个周期以上的次数
+        self.first_time = None
+        self.last_time = None
+
+    def is_bits(self):
+        return self.function in (READ_COILS, READ_DISCRETE_INPUTS)
+
+    def rate(self):
+        '''实际的轮询频率，次/秒'''
+        if self.scans < 2:
+            return 0.0
+        return (self.scans - 1) / (self.last_time - self.first_time)
+
+    def read(self, master):
+        data = master.execute(self.request)
+        if self.is_bits():
+            data = [(data[i >> 3] >> (i & 7)) & 1 for i in range(self.count)]
+        self.dispatch(data, time.perf_counter())
+
+    def split(self):
+        # 分成每一项一个请求
+        self.parts = [PollBlock(i.unit, i.function, i.address, i.count, i.period, [i]) for i in self.items]
+
+    def dispatch(self, data, timestamp):
+        # 把一个请求的结果分给合并进来的每一项
+        for item in self.items:
+            start = item.address - self.address
+            if self.is_bits():
+                item.value = data[start:start + item.count]
+            else:
+                item.value = data[start * 2:(start + item.count) * 2]
+            item.timestamp = timestamp
+            item.error = None
+
+
+def coalesce(items, max_gap=DEFAULT_MAX_GAP) -> list:
+    '''把轮询表合并成尽量少的请求'''
+    groups = {}
+    for item in items:
+        groups.setdefault((item.unit, item.function, item.period), []).append(item)
+    blocks = []
+    for (unit, function, period), group in groups.items():
+        limit = MAX_READ_BITS if function in (READ_COILS, READ_DISCRETE_INPUTS) else MAX_READ_REGISTERS
+        gap = max_gap * 16 if limit == MAX_READ_BITS else max_gap # 线圈一个字节8个，按比例放宽
+        group.sort(key=lambda i: i.address)
+        start = end = None
+        members = []
+        for item in group:
+            item_end = item.address + item.count
+            if members and item.address <= end + gap and max(end, item_end) - start <= limit:
+                end = max(end, item_end)
+                members.append(item)
+                continue
+            if members:
+                blocks.append(PollBlock(unit, function, start, end - start, period, members))
+            start, end, members = item.address, item_end, [item]
+        if members:
+            blocks.append(PollBlock(unit, function, start, end - start, period, members))
+    return blocks
+
+
+def wire_load(blocks, char_time, gap) -> float:
+    '''按照理论传输时间算的总线占用率，1.0 表示总线满了'''
+    load = 0.0
+    for block in blocks:
+        request = block.request
+        load += ((len(request) + response_length(request)) * char_time + 2 * gap) / block.period
+    return load
+
+
+def load_poll_table(path) -> list:
+    '''读取轮询表文件'''
+    items = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            row = [i.strip() for i in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if len(row) < 5:
+                raise ValueError('轮询表格式不对：{}'.format(','.join(row)))
+            items.append(PollItem(int(row[0], 0), int(row[1], 0), int(row[2], 0), int(row[3], 0),
+                                  int(row[4], 0) / 1000, row[5] if len(row) > 5 else None))
+    return items
+
+
+class PollScheduler:
+    '''循环轮询，在自己的线程里边执行，master 只在这个线程里边用'''
+    def __init__(self, master, items, max_gap=DEFAULT_MAX_GAP, on_result=None) -> None:
+        self.master = master
+        self.items = list(items)
+        self.blocks = coalesce(self.items, max_gap)
+        self.on_result = on_result # 每个请求完成以后在轮询线程里边调用，参数是 (block, 错误或者None)
+        self.busy_time = 0.0 # 总线上收发用的时间
+        self.start_time = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='PollScheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join(self.master.timeout * (self.master.retries + 1) + 1.0)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self):
+        now = time.perf_counter()
+        self.start_time = now
+        # (到期时间, 序号, 请求)，序号保证到期时间一样的时候按照顺序
+        heap = []
+        for i, block in enumerate(self.blocks):
+            block.due = now
+            heap.append((block.due, i, block))
+        heapq.heapify(heap)
+        while heap and not self._stop.is_set():
+            due, i, block = heap[0]
+            wait = due - time.perf_counter()
+            if wait > 0:
+                if self._stop.wait(wait):
+                    break
+            heapq.heappop(heap)
+            self.poll(block)
+            # 下一次的到期时间按照周期累加；已经晚了一整个周期的就跳过错过的那几次
+            block.due += block.period
+            now = time.perf_counter()
+            if block.due < now - block.period:
+                block.late += 1
+                block.due = now
+            heapq.heappush(heap, (block.due, i, block))
+
+    def poll(self, block):
+        start = time.perf_counter()
+        error = None
+        try:
+            if block.parts is None:
+                try:
+                    block.read(self.master)
+                except ModbusExceptionResponse:
+                    if len(block.items) == 1:
+                        raise
+                    # 可能是合并进来的地址从站不支持，以后分开读
+                    block.split()
+            if block.parts is not None:
+                for part in block.parts:
+                    try:
+                        part.read(self.master)
+                    except ModbusError as err:
+                        error = err
+                        for item in part.items:
+                            item.error = err
+                if error is not None:
+                    block.errors += 1
+        except ModbusError as err:
+            error = err
+            block.errors += 1
+            for item in block.items:
+                item.error = err
+        except OSError as err:
+            # 串口出错了就不再轮询
+            error = err
+            self._stop.set()
+        end = time.perf_counter()
+        self.busy_time += end - start
+        block.scans += 1
+        if block.first_time is None:
+            block.first_time = end
+        block.last_time = end
+        if self.on_result is not None:
+            self.on_result(block, error)
+
+    def stats(self) -> dict:
+        '''每个从站配置的和实际的轮询频率（次/秒），以及总线占用率'''
+        units = {}
+        for block in self.blocks:
+            unit = units.setdefault(block.unit, {'configured': 0.0, 'achieved': 0.0, 'errors': 0, 'late': 0})
+            unit['configured'] += 1 / block.period
+            unit['achieved'] += block.rate()
+            unit['errors'] += block.errors
+            unit['late'] += block.late
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+        return {
+            'items': len(self.items),
+            'requests': len(self.blocks),
+            'bus_busy': self.busy_time / elapsed if elapsed > 0 else 0.0,
+            'units': units,
+        }
+
+
+def _benchmark(seconds=4.0, baudrate=115200):
+    # 30个从站，每个20个寄存器分成几段，对比逐项轮询和合并以后的总线占用
+    import struct
+    from modbus_crc import append_crc
+    from modbus_rtu import ModbusMaster, READ_HOLDING_REGISTERS
+    from serial_session import char_time, silent_interval
+    items = []
+    for unit in range(1, 31):
+        for address in (0, 2, 4, 6, 10, 12, 20, 21, 40, 50):
+            items.append(PollItem(unit, READ_HOLDING_REGISTERS, address, 2, 1.0))
+    _char_time = char_time(baudrate)
+    _gap = silent_interval(baudrate)
+    naive = [PollBlock(i.unit, i.function, i.address, i.count, i.period, [i]) for i in items]
+    blocks = coalesce(items, max_gap=8)
+    print('{} 项，逐项轮询 {} 个请求，总线占用 {:.0%}；合并以后 {} 个请求，总线占用 {:.0%}'.format(
+        len(items), len(naive), wire_load(naive, _char_time, _gap), len(blocks), wire_load(blocks, _char_time, _gap)))
+
+    class WireTransport:
+        # 模拟从站，按照波特率等待传输的时间
+        def transact(self, request, expected, timeout, gap):
+            unit, function, address, count = struct.unpack_from('>BBHH', request)
+            time.sleep((len(request) + expected) * _char_time + 2 * gap)
+            return append_crc(bytes([unit, function, count * 2]) + struct.pack('>{}H'.format(count), *range(address, address + count)))
+
+    # 逐项轮询的时候总线已经忙不过来了，合并以后可以按照配置的频率轮询
+    for name in ('逐项', '合并'):
+        master = ModbusMaster(WireTransport(), _char_time, gap=_gap)
+        scheduler = PollScheduler(master, items, max_gap=8)
+        if name == '逐项':
+            scheduler.blocks = [PollBlock(i.unit, i.function, i.address, i.count, i.period, [i]) for i in items]
+        scheduler.start()
+        time.sleep(seconds)
+        scheduler.stop()
+        stats = scheduler.stats()
+        configured = sum(u['configured'] for u in stats['units'].values())
+        achieved = sum(u['achieved'] for u in stats['units'].values())
+        print('{}：{} 个请求，配置 {:.0f} 次/秒，实际 {:.0f} 次/秒，总线占用 {:.0%}'.format(
+            name, stats['requests'], configured, achieved, stats['bus_busy']))
+    assert items[5].value == struct.pack('>2H', 12, 13)
+
+    class GapTransport(WireTransport):
+        # 地址 3 不存在
+        def transact(self, request, expected, timeout, gap):
+            unit, function, address, count = struct.unpack_from('>BBHH', request)
+            if address <= 3 < address + count:
+                return append_crc(bytes([unit, function | 0x80, 2]))
+            return super().transact(request, expected, timeout, gap)
+
+    # 默认不跨过空着的地址；跨过了又异常应答的时候分开读，两项都能读到
+    gap_items = [PollItem(1, READ_HOLDING_REGISTERS, 0, 2, 1.0), PollItem(1, READ_HOLDING_REGISTERS, 4, 2, 1.0)]
+    assert len(coalesce(gap_items)) == 2
+    scheduler = PollScheduler(ModbusMaster(GapTransport(), _char_time, gap=_gap), gap_items, max_gap=2)
+    block, = scheduler.blocks
+    scheduler.poll(block)
+    scheduler.poll(block)
+    assert block.parts is not None and block.errors == 0 and block.scans == 2
+    assert [i.value for i in gap_items] == [struct.pack('>2H', 0, 1), struct.pack('>2H', 4, 5)]
+    assert all(i.error is None for i in gap_items)
+
+
+if __name__ == '__main__':
+    _benchmark()
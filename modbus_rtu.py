@@ -0,0 +1,484 @@
+# modbus RTU 主站
+# 组帧用 modbus_crc，帧的结束按照两个条件判断：
+#   1. 根据请求可以算出正常应答的长度，收够了就马上返回，不用多等；
+#   2. 收到数据以后空闲超过 t3.5（serial_session.silent_interval）就认为一帧结束。
+# 超时和CRC错误会重试，异常应答不重试。
+# 收发通过 transport 完成：SerialTransport 直接用 serial.Serial（命令行），
+# SessionTransport 用界面的 SerialSession（数据从接收线程的缓冲区里边取）。
+
+import struct
+import time
+
+import serial
+
+from modbus_crc import append_crc, check_frame
+from serial_session import resolve_parameters, char_time, silent_interval
+
+READ_COILS = 0x01
+READ_DISCRETE_INPUTS = 0x02
+READ_HOLDING_REGISTERS = 0x03
+READ_INPUT_REGISTERS = 0x04
+WRITE_SINGLE_COIL = 0x05
+WRITE_SINGLE_REGISTER = 0x06
+WRITE_MULTIPLE_COILS = 0x0F
+WRITE_MULTIPLE_REGISTERS = 0x10
+
+# 功能码的名字，界面的下拉框用
+function_names = {
+    READ_COILS: '读线圈(01)',
+    READ_DISCRETE_INPUTS: '读离散输入(02)',
+    READ_HOLDING_REGISTERS: '读保持寄存器(03)',
+    READ_INPUT_REGISTERS: '读输入寄存器(04)',
+    WRITE_SINGLE_COIL: '写单个线圈(05)',
+    WRITE_SINGLE_REGISTER: '写单个寄存器(06)',
+    WRITE_MULTIPLE_COILS: '写多个线圈(15)',
+    WRITE_MULTIPLE_REGISTERS: '写多个寄存器(16)',
+}
+read_functions = (READ_COILS, READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS)
+write_functions = (WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS)
+
+# 一次最多读写的个数
+MAX_READ_BITS = 2000
+MAX_READ_REGISTERS = 125
+MAX_WRITE_COILS = 1968
+MAX_WRITE_REGISTERS = 123
+# RTU 一帧最长的字节数
+MAX_FRAME = 256
+
+# 异常码
+exception_names = {
+    0x01: '非法功能码',
+    0x02: '非法数据地址',
+    0x03: '非法数据值',
+    0x04: '从站设备故障',
+    0x05: '确认',
+    0x06: '从站设备忙',
+    0x08: '存储奇偶性差错',
+    0x0A: '不可用网关路径',
+    0x0B: '网关目标设备响应失败',
+}
+
+
+class ModbusError(Exception):
+    '''modbus的错误'''
+
+
+class ModbusTimeout(ModbusError):
+    '''从站没有应答'''
+
+
+class ModbusFrameError(ModbusError):
+    '''应答的CRC、长度或者内容不对'''
+
+
+class ModbusExceptionResponse(ModbusError):
+    '''从站返回了异常应答'''
+    def __init__(self, function, code) -> None:
+        self.function = function
+        self.code = code
+        super().__init__('功能码 {:02X} 异常 {:02X}：{}'.format(function, code, exception_names.get(code, '未知异常')))
+
+
+# 组帧
+def build_read(unit, function, address, count) -> bytes:
+    '''读线圈、离散输入、保持寄存器、输入寄存器'''
+    if function not in read_functions:
+        raise ValueError('不是读的功能码：{}'.format(function))
+    limit = MAX_READ_BITS if function in (READ_COILS, READ_DISCRETE_INPUTS) else MAX_READ_REGISTERS
+    if not 1 <= count <= limit:
+        raise ValueError('个数必须在 1 到 {} 之间'.format(limit))
+    return append_crc(struct.pack('>BBHH', unit, function, address, count))
+
+
+def build_write_single_coil(unit, address, value) -> bytes:
+    return append_crc(struct.pack('>BBHH', unit, WRITE_SINGLE_COIL, address, 0xFF00 if value else 0x0000))
+
+
+def build_write_single_register(unit, address, value) -> bytes:
+    return append_crc(struct.pack('>BBHH', unit, WRITE_SINGLE_REGISTER, address, value & 0xFFFF))
+
+
+def pack_bits(values) -> bytes:
+    # 线圈按照低位在前打包
+    data = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value:
+            data[i >> 3] |= 1 << (i & 7)
+    return bytes(data)
+
+
+def unpack_bits(data, count) -> list:
+    return [(data[i >> 3] >> (i & 7)) & 1 for i in range(count)]
+
+
+def build_write_multiple_coils(unit, address, values) -> bytes:
+    if not 1 <= len(values) <= MAX_WRITE_COILS:
+        raise ValueError('个数必须在 1 到 {} 之间'.format(MAX_WRITE_COILS))
+    data = pack_bits(values)
+    return append_crc(struct.pack('>BBHHB', unit, WRITE_MULTIPLE_COILS, address, len(values), len(data)) + data)
+
+
+def build_write_multiple_registers(unit, address, values=None, data=None) -> bytes:
+    '''values 是16位的整数，也可以直接给 data（已经排好字节顺序的寄存器数据）'''
+    if data is None:
+        data = struct.pack('>{}H'.format(len(values)), *[v & 0xFFFF for v in values])
+    count = len(data) // 2
+    if len(data) % 2 or not 1 <= count <= MAX_WRITE_REGISTERS:
+        raise ValueError('个数必须在 1 到 {} 之间'.format(MAX_WRITE_REGISTERS))
+    return append_crc(struct.pack('>BBHHB', unit, WRITE_MULTIPLE_REGISTERS, address, count, len(data)) + bytes(data))
+
+
+def response_length(request) -> int:
+    '''根据请求算出正常应答的长度（包括CRC）'''
+    function = request[1]
+    if function in read_functions:
+        count = struct.unpack_from('>H', request, 4)[0]
+        if function in (READ_COILS, READ_DISCRETE_INPUTS):
+            return 5 + (count + 7) // 8
+        return 5 + count * 2
+    return 8 # 写的应答都是8个字节
+
+
+def frame_complete(buf, expected) -> bool:
+    # 收到的数据够不够一帧，expected 是 None 的时候不知道应答多长，只能等帧间隔
+    if len(buf) >= 2 and buf[1] & 0x80:
+        return len(buf) >= 5 # 异常应答
+    return expected is not None and len(buf) >= expected
+
+
+def parse_response(request, response):
+    '''检查应答，读的功能码返回数据部分，写的返回 (地址, 值或者个数)'''
+    if len(response) < 5 or not check_frame(response):
+        raise ModbusFrameError('应答的CRC错误：{}'.format(bytes(response).hex(' ')))
+    if response[0] != request[0]:
+        raise ModbusFrameError('应答的从站地址不对：{}'.format(response[0]))
+    function = request[1]
+    if response[1] == function | 0x80:
+        raise ModbusExceptionResponse(function, response[2])
+    if response[1] != function:
+        raise ModbusFrameError('应答的功能码不对：{:02X}'.format(response[1]))
+    if function in read_functions:
+        size = response[2]
+        if size != response_length(request) - 5 or len(response) != size + 5:
+            raise ModbusFrameError('应答的长度不对')
+        return bytes(response[3:3 + size])
+    if len(response) != 8 or response[2:4] != request[2:4]:
+        raise ModbusFrameError('写的应答不对')
+    return struct.unpack_from('>HH', response, 2)
+
+
+# 收发
+class SerialTransport:
+    '''直接使用 serial.Serial 收发，调用的线程会阻塞'''
+    def __init__(self, serial_port) -> None:
+        self.serial = serial_port
+
+    def send(self, request):
+        # 只发送，不等应答（广播）
+        self.serial.write(request)
+        self.serial.flush()
+
+    def transact(self, request, expected, timeout, gap) -> bytes:
+        ser = self.serial
+        ser.reset_input_buffer()
+        ser.write(request)
+        ser.flush()
+        deadline = time.perf_counter() + timeout
+        ser.timeout = timeout
+        buf = bytearray(ser.read(1))
+        if not buf:
+            raise ModbusTimeout('从站没有应答')
+        # 知道应答多长的时候收到够了或者超时才结束，主机上的调度和 USB 转串口都会让字节之间的间隔超过 t3.5；
+        # 不知道多长的时候只能超过 t3.5 没有数据就结束
+        while not frame_complete(buf, expected):
+            if expected is None:
+                ser.timeout = gap
+                need = MAX_FRAME - len(buf)
+            else:
+                ser.timeout = max(deadline - time.perf_counter(), 0)
+                need = (5 if buf[1:2] and buf[1] & 0x80 else expected) - len(buf)
+            chunk = ser.read(max(need, 1))
+            if not chunk:
+                break
+            buf += chunk
+        return bytes(buf)
+
+
+class SessionTransport:
+    '''使用 SerialSession 收发，应答从接收线程的缓冲区里边取，接收线程的时间戳用来判断帧间隔'''
+    def __init__(self, session) -> None:
+        self.session = session
+
+    def send(self, request):
+        self.session.write(request)
+
+    def transact(self, request, expected, timeout, gap) -> bytes:
+        session = self.session
+        session.read() # 丢掉以前的数据
+        session.write(request)
+        reader = session.reader
+        deadline = time.perf_counter() + timeout
+        buf = bytearray()
+        while not frame_complete(buf, expected):
+            now = time.perf_counter()
+            if not buf:
+                wait = deadline - now
+                if wait <= 0:
+                    raise ModbusTimeout('从站没有应答')
+            else:
+                # 和 SerialTransport 一样，只有不知道应答多长的时候才用帧间隔判断结束
+                wait = deadline - now if expected is not None else gap - (now - reader.last_recv_time)
+                if wait <= 0:
+                    break
+            if reader.error is not None:
+                raise ModbusError('接收错误：{}'.format(reader.error))
+            if session.wait(wait):
+                buf += session.read()
+        return bytes(buf)
+
+
+class ModbusMaster:
+    '''modbus RTU 主站'''
+    def __init__(self, transport, char_time, timeout=1.0, retries=2, gap=None) -> None:
+        self.transport = transport
+        self.char_time = char_time # 一个字符的传输时间，秒
+        self.timeout = timeout     # 发送完以后等待应答的时间，秒
+        self.retries = retries
+        # 帧间隔，默认 t3.5，波特率大于19200的时候是1.75ms
+        self.gap = gap if gap is not None else max(3.5 * char_time, 0.00175)
+        # 统计信息
+        self.requests = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.frame_errors = 0
+        self.exceptions = 0
+        self.last_round_trip = 0.0 # 最后一次请求到应答的时间，秒
+        self.last_request = b''
+        self.last_response = b''
+
+    def wire_time(self, request):
+        # 请求和应答在线路上传输的理论时间
+        return (len(request) + response_length(request)) * self.char_time
+
+    def execute(self, request):
+        '''发送请求，返回 parse_response() 的结果，失败的时候重试'''
+        expected = response_length(request)
+        # 等待的时间还要加上发送请求和应答需要的时间
+        timeout = self.timeout + (len(request) + expected) * self.char_time
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+            self.requests += 1
+            start = time.perf_counter()
+            self.last_request = request
+            try:
+                response = self.transport.transact(request, expected, timeout, self.gap)
+                self.last_response = response
+                self.last_round_trip = time.perf_counter() - start
+                return parse_response(request, response)
+            except ModbusExceptionResponse:
+                self.exceptions += 1
+                raise
+            except ModbusTimeout as err:
+                self.timeouts += 1
+                error = err
+            except ModbusFrameError as err:
+                self.frame_errors += 1
+                error = err
+            # 重试之前等一个帧间隔，让线路安静下来
+            time.sleep(self.gap)
+        raise error
+
+    def forward(self, request) -> bytes:
+        '''转发任意的请求（网关用），返回CRC正确的应答，异常应答也原样返回。
+        超时和CRC错误重试，广播（从站地址0）只发送，返回 b'''''
+        if request[0] == 0:
+            self.transport.send(request)
+            time.sleep(self.gap)
+            return b''
+        known = request[1] in read_functions or request[1] in write_functions
+        # 不认识的功能码不知道应答多长，只能等帧间隔
+        expected = response_length(request) if known else None
+        timeout = self.timeout + (len(request) + (expected or MAX_FRAME)) * self.char_time
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                time.sleep(self.gap)
+            self.requests += 1
+            start = time.perf_counter()
+            self.last_request = request
+            try:
+                response = self.transport.transact(request, expected, timeout, self.gap)
+            except ModbusTimeout as err:
+                self.timeouts += 1
+                error = err
+                continue
+            self.last_response = response
+            self.last_round_trip = time.perf_counter() - start
+            if len(response) >= 5 and check_frame(response) and response[0] == request[0]:
+                if response[1] & 0x80:
+                    self.exceptions += 1
+                return response
+            self.frame_errors += 1
+            error = ModbusFrameError('应答的CRC错误：{}'.format(response.hex(' ')))
+        raise error
+
+    def read_bits(self, unit, function, address, count):
+        return unpack_bits(self.execute(build_read(unit, function, address, count)), count)
+
+    def read_registers_raw(self, unit, function, address, count) -> bytes:
+        # 返回寄存器的原始字节，高字节在前
+        return self.execute(build_read(unit, function, address, count))
+
+    def read_registers(self, unit, function, address, count):
+        data = self.read_registers_raw(unit, function, address, count)
+        return list(struct.unpack('>{}H'.format(count), data))
+
+    def read_coils(self, unit, address, count):
+        return self.read_bits(unit, READ_COILS, address, count)
+
+    def read_discrete_inputs(self, unit, address, count):
+        return self.read_bits(unit, READ_DISCRETE_INPUTS, address, count)
+
+    def read_holding_registers(self, unit, address, count):
+        return self.read_registers(unit, READ_HOLDING_REGISTERS, address, count)
+
+    def read_input_registers(self, unit, address, count):
+        return self.read_registers(unit, READ_INPUT_REGISTERS, address, count)
+
+    def write_single_coil(self, unit, address, value):
+        return self.execute(build_write_single_coil(unit, address, value))
+
+    def write_single_register(self, unit, address, value):
+        return self.execute(build_write_single_register(unit, address, value))
+
+    def write_multiple_coils(self, unit, address, values):
+        return self.execute(build_write_multiple_coils(unit, address, values))
+
+    def write_multiple_registers(self, unit, address, values=None, data=None):
+        return self.execute(build_write_multiple_registers(unit, address, values, data))
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retried': self.retried,
+            'timeouts': self.timeouts,
+            'frame_errors': self.frame_errors,
+            'exceptions': self.exceptions,
+            'last_round_trip': self.last_round_trip,
+        }
+
+
+def open_master(port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+                stopbits=serial.STOPBITS_ONE, timeout=1.0, retries=2, **kwargs) -> ModbusMaster:
+    '''直接打开串口，返回 ModbusMaster（命令行和测试用，界面用 SessionTransport）'''
+    bytesize, parity, stopbits = resolve_parameters(bytesize, parity, stopbits)
+    serial_port = serial.serial_for_url(port, baudrate=baudrate, bytesize=bytesize, parity=parity,
+                                        stopbits=stopbits, **kwargs)
+    return ModbusMaster(SerialTransport(serial_port), char_time(baudrate, bytesize, parity, stopbits),
+                        timeout=timeout, retries=retries,
+                        gap=silent_interval(baudrate, bytesize, parity, stopbits))
+
+
+def _self_test(rounds=200):
+    # 用pty模拟一个从站，检查各个功能码，以及读125个寄存器的额外开销
+    import os
+    import threading
+    master_fd, slave_fd = os.openpty()
+    registers = list(range(1000))
+    coils = [i % 3 == 0 for i in range(2000)]
+    stop = False
+
+    def slave():
+        buf = bytearray()
+        while not stop:
+            try:
+                buf += os.read(master_fd, 4096)
+            except OSError:
+                return
+            if len(buf) < 8:
+                continue
+            function = buf[1]
+            size = 9 + buf[6] if function in (WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS) else 8
+            if len(buf) < size:
+                continue
+            request = bytes(buf[:size])
+            del buf[:size]
+            assert check_frame(request)
+            if request[0] != 1:
+                continue
+            address, count = struct.unpack_from('>HH', request, 2)
+            if function == 0x2B:
+                reply = bytes([request[0], function | 0x80, 0x01])
+            elif function in (READ_COILS, READ_DISCRETE_INPUTS):
+                data = pack_bits(coils[address:address + count])
+                reply = bytes([request[0], function, len(data)]) + data
+            elif function in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+                data = struct.pack('>{}H'.format(count), *registers[address:address + count])
+                reply = bytes([request[0], function, len(data)]) + data
+            else:
+                if function == WRITE_SINGLE_REGISTER:
+                    registers[address] = count
+                elif function == WRITE_MULTIPLE_REGISTERS:
+                    registers[address:address + count] = struct.unpack_from('>{}H'.format(count), request, 7)
+                elif function == WRITE_SINGLE_COIL:
+                    coils[address] = count == 0xFF00
+                elif function == WRITE_MULTIPLE_COILS:
+                    coils[address:address + count] = [bool(v) for v in unpack_bits(request[7:], count)]
+                reply = request[:6]
+            reply = append_crc(reply)
+            if function == READ_HOLDING_REGISTERS and address == 999:
+                # 应答中间停一下，比 t3.5 长，模拟主机上的调度或者 USB 转串口的延迟
+                os.write(master_fd, reply[:3])
+                time.sleep(0.02)
+                reply = reply[3:]
+            os.write(master_fd, reply)
+
+    thread = threading.Thread(target=slave, daemon=True)
+    thread.start()
+    master = open_master(os.ttyname(slave_fd), 115200, timeout=0.5, retries=1)
+    assert master.read_holding_registers(1, 10, 3) == [10, 11, 12]
+    assert master.read_input_registers(1, 0, 125) == registers[:125]
+    assert master.read_coils(1, 0, 10) == [int(c) for c in coils[:10]]
+    assert master.read_discrete_inputs(1, 3, 5) == [int(c) for c in coils[3:8]]
+    assert master.write_single_register(1, 5, 0x1234) == (5, 0x1234) and registers[5] == 0x1234
+    assert master.write_multiple_registers(1, 20, [1, 2, 3]) == (20, 3) and registers[20:23] == [1, 2, 3]
+    assert master.write_single_coil(1, 1, True) == (1, 0xFF00) and coils[1]
+    assert master.write_multiple_coils(1, 100, [1, 0, 1]) == (100, 3) and coils[100:103] == [True, False, True]
+    # 应答中间的间隔超过 t3.5 也要收完整
+    assert master.read_holding_registers(1, 999, 1) == [999] and master.frame_errors == 0
+    # 异常应答
+    try:
+        master.execute(append_crc(bytes([1, 0x2B, 0, 0, 0, 1])))
+    except ModbusExceptionResponse as err:
+        assert err.code == 1
+    else:
+        assert False
+    # 从站地址不对，应答超时
+    start = time.perf_counter()
+    try:
+        master.read_holding_registers(2, 0, 1)
+    except ModbusTimeout:
+        pass
+    else:
+        assert False
+    print('错误的从站地址：重试 {} 次，{:.3f} 秒'.format(master.retried, time.perf_counter() - start))
+    # 读125个寄存器，pty没有波特率，这里测的是软件的额外开销
+    start = time.perf_counter()
+    for _ in range(rounds):
+        master.read_holding_registers(1, 0, 125)
+    elapsed = (time.perf_counter() - start) / rounds
+    request = build_read(1, READ_HOLDING_REGISTERS, 0, 125)
+    print('读125个寄存器：每次 {:.2f} ms，115200波特率下线路上的理论时间 {:.2f} ms'.format(
+        elapsed * 1000, master.wire_time(request) * 1000))
+    print(master.stats())
+    stop = True
+    master.transport.serial.close()
+    os.close(slave_fd)
+    os.close(master_fd)
+
+
+if __name__ == '__main__':
+    _self_test()
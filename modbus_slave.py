@@ -0,0 +1,307 @@
+# modbus RTU 从站（模拟器），用来测试主站
+# 每个从站地址一个 SlaveStore：线圈和离散输入是 bytearray（一个字节一个点），
+# 保持寄存器和输入寄存器是 array('H')，都是65536个，内存是连续的，读写直接切片。
+# 请求的长度可以从功能码算出来，收够了马上应答；不认识的功能码等 t3.5 空闲以后应答异常。
+# 从收到请求的最后一个字节到应答写完的时间记录到直方图里边。
+# 脚本：on_request 在应答之前调用，可以修改数据、返回异常码；也可以在别的线程里边直接改 SlaveStore。
+
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from array import array
+
+import serial
+
+from modbus_crc import append_crc, check_frame
+from modbus_rtu import (READ_COILS, READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS,
+                        WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS,
+                        MAX_READ_BITS, MAX_READ_REGISTERS, MAX_WRITE_COILS, MAX_WRITE_REGISTERS, pack_bits, unpack_bits)
+from serial_session import resolve_parameters, silent_interval
+from stats import Histogram
+
+# 异常码
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+
+ADDRESS_SPACE = 65536
+
+
+class SlaveStore:
+    '''一个从站的数据'''
+    def __init__(self, size=ADDRESS_SPACE) -> None:
+        self.coils = bytearray(size)
+        self.discrete_inputs = bytearray(size)
+        self.holding_registers = array('H', bytes(2 * size))
+        self.input_registers = array('H', bytes(2 * size))
+
+    def area(self, function):
+        # 功能码对应的数据区
+        if function in (READ_COILS, WRITE_SINGLE_COIL, WRITE_MULTIPLE_COILS):
+            return self.coils
+        if function == READ_DISCRETE_INPUTS:
+            return self.discrete_inputs
+        if function == READ_INPUT_REGISTERS:
+            return self.input_registers
+        return self.holding_registers
+
+    def set_registers(self, address, values, input_registers=False):
+        area = self.input_registers if input_registers else self.holding_registers
+        area[address:address + len(values)] = array('H', [v & 0xFFFF for v in values])
+
+    def set_bits(self, address, values, discrete_inputs=False):
+        area = self.discrete_inputs if discrete_inputs else self.coils
+        area[address:address + len(values)] = bytes(1 if v else 0 for v in values)
+
+
+def request_length(buf):
+    '''从请求的开头算出整个请求的长度，还算不出来返回 None'''
+    if len(buf) < 2:
+        return None
+    if buf[1] in (WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS):
+        return 9 + buf[6] if len(buf) >= 7 else None
+    if buf[1] <= WRITE_SINGLE_REGISTER:
+        return 8
+    return -1 # 不认识的功能码，只能等帧间隔
+
+
+def _exception(unit, function, code):
+    return append_crc(bytes([unit, function | 0x80, code]))
+
+
+def handle_request(store, request) -> bytes:
+    '''处理一个请求（已经检查过CRC），返回应答'''
+    unit, function = request[0], request[1]
+    if function not in (READ_COILS, READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS,
+                        WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS):
+        return _exception(unit, function, ILLEGAL_FUNCTION)
+    address, value = struct.unpack_from('>HH', request, 2)
+    area = store.area(function)
+    if function in (READ_COILS, READ_DISCRETE_INPUTS):
+        if not 1 <= value <= MAX_READ_BITS:
+            return _exception(unit, function, ILLEGAL_DATA_VALUE)
+        if address + value > len(area):
+            return _exception(unit, function, ILLEGAL_DATA_ADDRESS)
+        data = pack_bits(area[address:address + value])
+        return append_crc(bytes([unit, function, len(data)]) + data)
+    if function in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+        if not 1 <= value <= MAX_READ_REGISTERS:
+            return _exception(unit, function, ILLEGAL_DATA_VALUE)
+        if address + value > len(area):
+            return _exception(unit, function, ILLEGAL_DATA_ADDRESS)
+        data = area[address:address + value]
+        if sys.byteorder == 'little':
+            data.byteswap() # 高字节在前
+        return append_crc(bytes([unit, function, value * 2]) + data.tobytes())
+    if function == WRITE_SINGLE_COIL:
+        if value not in (0x0000, 0xFF00):
+            return _exception(unit, function, ILLEGAL_DATA_VALUE)
+        area[address] = 1 if value else 0
+        return request
+    if function == WRITE_SINGLE_REGISTER:
+        area[address] = value
+        return request
+    size = request[6]
+    if function == WRITE_MULTIPLE_COILS:
+        if not 1 <= value <= MAX_WRITE_COILS or size != (value + 7) // 8:
+            return _exception(unit, function, ILLEGAL_DATA_VALUE)
+        if address + value > len(area):
+            return _exception(unit, function, ILLEGAL_DATA_ADDRESS)
+        area[address:address + value] = bytes(unpack_bits(request[7:7 + size], value))
+    else:
+        if not 1 <= value <= MAX_WRITE_REGISTERS or size != value * 2:
+            return _exception(unit, function, ILLEGAL_DATA_VALUE)
+        if address + value > len(area):
+            return _exception(unit, function, ILLEGAL_DATA_ADDRESS)
+        data = array('H')
+        data.frombytes(request[7:7 + size])
+        if sys.byteorder == 'little':
+            data.byteswap()
+        area[address:address + value] = data
+    return append_crc(request[:6])
+
+
+class ModbusSlave(threading.Thread):
+    '''在后台线程里边应答主站的请求'''
+    def __init__(self, serial_port, units=None, gap=0.00175, on_request=None) -> None:
+        super().__init__(name='ModbusSlave', daemon=True)
+        self.serial = serial_port
+        self.units = units if units is not None else {1: SlaveStore()} # 从站地址 -> SlaveStore
+        self.gap = gap # t3.5
+        # on_request(slave, store, request) 在应答之前调用，返回异常码就应答异常，返回 None 正常处理
+        self.on_request = on_request
+        self.latency = Histogram()
+        self.budget = gap # 应答超过这个时间的次数记到 late 里边
+        self.error = None
+        # 统计信息
+        self.requests = 0
+        self.responses = 0
+        self.exceptions = 0
+        self.crc_errors = 0
+        self.ignored = 0 # 不是发给这里的请求
+        self.late = 0
+        self._stopping = False
+
+    def store(self, unit=1) -> SlaveStore:
+        return self.units[unit]
+
+    def stop(self):
+        self._stopping = True
+        if threading.current_thread() is not self:
+            self.join(1.0)
+
+    def run(self):
+        ser = self.serial
+        ser.timeout = self.gap
+        buf = bytearray()
+        try:
+            while not self._stopping:
+                chunk = ser.read(max(ser.in_waiting, 1))
+                if chunk:
+                    buf += chunk
+                elif buf:
+                    # 空闲超过 t3.5，剩下的当成一帧
+                    self._handle(bytes(buf), time.perf_counter() - self.gap)
+                    buf.clear()
+                    continue
+                while buf:
+                    size = request_length(buf)
+                    if size is None or size < 0 or len(buf) < size:
+                        break
+                    frame = bytes(buf[:size])
+                    del buf[:size]
+                    self._handle(frame, time.perf_counter())
+        except (serial.SerialException, OSError) as err:
+            if not self._stopping:
+                self.error = err
+
+    def _handle(self, frame, received):
+        self.requests += 1
+        if len(frame) < 4 or not check_frame(frame):
+            self.crc_errors += 1
+            return
+        unit = frame[0]
+        store = self.units.get(unit)
+        if store is None and unit != 0:
+            self.ignored += 1
+            return
+        stores = [store] if unit else list(self.units.values()) # 0是广播，只写不应答
+        response = None
+        for store in stores:
+            code = self.on_request(self, store, frame) if self.on_request is not None else None
+            if code:
+                response = _exception(unit, frame[1], code)
+            else:
+                response = handle_request(store, frame)
+        if unit == 0:
+            return
+        if response[1] & 0x80:
+            self.exceptions += 1
+        self.serial.write(response)
+        elapsed = time.perf_counter() - received
+        self.responses += 1
+        self.latency.record(elapsed)
+        if elapsed > self.budget:
+            self.late += 1
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'responses': self.responses,
+            'exceptions': self.exceptions,
+            'crc_errors': self.crc_errors,
+            'ignored': self.ignored,
+            'late': self.late,
+            'latency': self.latency.summary(),
+        }
+
+
+class PtyPort:
+    '''pty 主设备这一头，只有 SerialTransport 用到的几个方法（测试用，另一头用 os.ttyname() 打开）'''
+    def __init__(self, fd) -> None:
+        self.fd = fd
+        self.timeout = None
+
+    @property
+    def in_waiting(self):
+        import fcntl
+        import termios
+        return struct.unpack('I', fcntl.ioctl(self.fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def reset_input_buffer(self):
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 4096)
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def flush(self):
+        pass
+
+    def read(self, size):
+        data = bytearray()
+        deadline = time.perf_counter() + self.timeout
+        while len(data) < size:
+            wait = deadline - time.perf_counter()
+            if wait <= 0 or not select.select([self.fd], [], [], wait)[0]:
+                break
+            data += os.read(self.fd, size - len(data))
+        return bytes(data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_slave(port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+               stopbits=serial.STOPBITS_ONE, units=(1,), on_request=None, **kwargs) -> ModbusSlave:
+    '''打开串口，返回还没有启动的 ModbusSlave'''
+    bytesize, parity, stopbits = resolve_parameters(bytesize, parity, stopbits)
+    serial_port = serial.serial_for_url(port, baudrate=baudrate, bytesize=bytesize, parity=parity,
+                                        stopbits=stopbits, **kwargs)
+    gap = silent_interval(baudrate, bytesize, parity, stopbits)
+    return ModbusSlave(serial_port, {unit: SlaveStore() for unit in units}, gap=gap, on_request=on_request)
+
+
+def _benchmark(baudrate=115200, seconds=3.0):
+    # 用pty连接主站和从站，主站一直读125个寄存器，看应答延迟
+    import os
+    from modbus_rtu import ModbusMaster, SerialTransport, ModbusExceptionResponse
+    from serial_session import char_time
+
+    master_fd, slave_fd = os.openpty()
+    slave = open_slave(os.ttyname(slave_fd), baudrate, units=(1, 2))
+    slave.store(1).set_registers(0, range(200))
+    slave.store(2).set_bits(10, [1, 0, 1])
+    slave.start()
+    master = ModbusMaster(SerialTransport(PtyPort(master_fd)), char_time(baudrate), timeout=0.5, gap=slave.gap)
+    assert master.read_holding_registers(1, 0, 3) == [0, 1, 2]
+    assert master.read_coils(2, 10, 3) == [1, 0, 1]
+    master.write_multiple_registers(1, 100, [7, 8, 9])
+    assert list(slave.store(1).holding_registers[100:103]) == [7, 8, 9]
+    try:
+        master.read_holding_registers(1, 65530, 10)
+        assert False
+    except ModbusExceptionResponse as err:
+        assert err.code == ILLEGAL_DATA_ADDRESS
+    slave.latency.reset()
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        master.read_holding_registers(1, 0, 125)
+        count += 1
+    elapsed = time.perf_counter() - start
+    wire = master.wire_time(master.last_request) + 2 * master.gap
+    print('读125个寄存器 {} 次，{:.0f} 次/秒（{} 波特率满速是 {:.0f} 次/秒）'.format(count, count / elapsed, baudrate, 1 / wire))
+    print('从站应答延迟：{}'.format(slave.latency.format()))
+    print(slave.stats())
+    slave.stop()
+    slave.serial.close()
+    master.transport.serial.close()
+    os.close(slave_fd)
+
+
+if __name__ == '__main__':
+    _benchmark()
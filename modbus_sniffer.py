@@ -0,0 +1,318 @@
+# modbus RTU 总线监听，只听不发
+# 接收线程把收到的每一块数据和时间戳交给 ModbusSniffer.write()（和录制一样的接口），
+# 解析是增量的，每个字节只看一次：
+#   1. 两块数据之间空闲超过 t3.5，前边没有解析完的字节就是一帧（或者是坏帧）；
+#   2. 一块数据里边可能有好几帧连在一起，按照功能码算出可能的长度（请求或者应答），CRC 对的就是一帧；
+#      都不对就丢掉一个字节重新同步。
+# 请求和后边同一个从站的应答配成一对，算出应答延迟（请求结束到应答开始），按照从站统计交易速率、错误率和延迟。
+# 请求结束以后超过 timeout 还没有应答算超时；只可能是应答的帧（请求的 CRC 错了，或者从中间开始听的）
+# 配不上请求的时候不算请求，记到 orphans 里边。
+
+import struct
+import threading
+import time
+from collections import deque
+
+from capture import DIR_SEND
+from modbus_crc import check_frame
+from modbus_rtu import (function_names, exception_names, response_length, unpack_bits, read_functions, write_functions,
+                        READ_COILS, READ_DISCRETE_INPUTS, WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER,
+                        WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS, MAX_READ_BITS, MAX_READ_REGISTERS)
+from stats import Histogram
+
+# 保留最近的多少条交易的文本
+DEFAULT_HISTORY = 1000
+
+
+def candidate_lengths(buf, pos) -> list:
+    '''buf[pos:] 开头的帧可能的长度，不认识的功能码返回空列表（只能等帧间隔）'''
+    function = buf[pos + 1]
+    if function & 0x80:
+        return [5]
+    if function in read_functions:
+        # 请求是8个字节，应答是 5 + 字节数
+        return sorted({8, 5 + buf[pos + 2]})
+    if function in (WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER):
+        return [8]
+    if function in (WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS):
+        # 应答是8个字节，请求是 9 + 字节数
+        return [8, 9 + buf[pos + 6]] if len(buf) - pos >= 7 else [8]
+    return []
+
+
+def maybe_request(frame) -> bool:
+    '''frame 能不能是一个请求，异常应答、长度对不上请求格式的读写应答都不能'''
+    function = frame[1]
+    if function & 0x80:
+        return False
+    if function in read_functions:
+        if len(frame) != 8:
+            return False
+        count = struct.unpack_from('>H', frame, 4)[0]
+        return 1 <= count <= (MAX_READ_BITS if function in (READ_COILS, READ_DISCRETE_INPUTS) else MAX_READ_REGISTERS)
+    if function in (WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS):
+        return len(frame) >= 9 and len(frame) == 9 + frame[6]
+    if function in (WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER):
+        return len(frame) == 8
+    return True # 不认识的功能码
+
+
+def describe(request, response) -> str:
+    '''把一对请求和应答转成文本，response 是 None 表示没有应答'''
+    unit, function = request[0], request[1]
+    name = function_names.get(function, '功能码{:02X}'.format(function))
+    text = '从站{} {}'.format(unit, name)
+    if function in read_functions or function in write_functions:
+        address, value = struct.unpack_from('>HH', request, 2)
+        text += ' 0x{:04X}'.format(address)
+        if function in (WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER):
+            text += ' = {}'.format(value)
+        else:
+            text += ' x{}'.format(value)
+    if response is None:
+        return text + ' -> 超时'
+    if response[1] & 0x80:
+        return text + ' -> 异常 {:02X} {}'.format(response[2], exception_names.get(response[2], ''))
+    if function in (READ_COILS, READ_DISCRETE_INPUTS):
+        count = struct.unpack_from('>H', request, 4)[0]
+        return text + ' -> ' + ''.join(str(i) for i in unpack_bits(response[3:-2], count))
+    if function in read_functions:
+        data = response[3:-2]
+        return text + ' -> ' + ' '.join(str(i) for i in struct.unpack('>{}H'.format(len(data) // 2), data))
+    return text + ' -> 成功'
+
+
+class UnitStats:
+    '''一个从站的统计'''
+    def __init__(self, unit) -> None:
+        self.unit = unit
+        self.requests = 0
+        self.responses = 0
+        self.exceptions = 0
+        self.timeouts = 0
+        self.latency = Histogram()
+        self.first_time = None
+        self.last_time = None
+
+    def rate(self):
+        '''交易速率，次/秒'''
+        if self.first_time is None or self.last_time <= self.first_time:
+            return 0.0
+        return (self.requests - 1) / (self.last_time - self.first_time)
+
+    def error_rate(self):
+        return (self.exceptions + self.timeouts) / self.requests if self.requests else 0.0
+
+
+class ModbusSniffer:
+    '''增量解析 modbus RTU 的数据流，write() 在接收线程里边调用'''
+    def __init__(self, gap=0.00175, char_time=11 / 9600, history=DEFAULT_HISTORY, on_transaction=None,
+                 timeout=1.0) -> None:
+        self.gap = gap
+        self.char_time = char_time
+        self.timeout = timeout # 请求结束以后等应答的秒数，和主站的超时差不多
+        # on_transaction(request, response, latency) 每配成一对（或者超时）调用一次，response 可能是 None
+        self.on_transaction = on_transaction
+        self.units = {} # 从站地址 -> UnitStats
+        self.history = deque(maxlen=history) # 最近的交易，(时间, 文本)
+        self.lock = threading.Lock() # 界面读取 units 和 history 的时候用
+        self._buf = bytearray()
+        self._last_time = None # 最后一块数据的时间
+        self._pending = None # (请求, 请求结束的时间)
+        # 统计信息
+        self.bytes = 0
+        self.frames = 0
+        self.bad_bytes = 0 # 解析不了丢掉的字节
+        self.orphans = 0 # 配不上请求的应答
+
+    def write(self, data, direction=None, timestamp_ns=None):
+        # 和录制一样的接口，可以挂到 SerialReader.taps 上；自己发送的数据不解析，只听总线上的
+        if direction == DIR_SEND:
+            return
+        self.feed(data, time.perf_counter() if timestamp_ns is None else timestamp_ns / 1e9)
+
+    def feed(self, data, timestamp):
+        '''timestamp 是收到这块数据的时间（秒），也就是最后一个字节到的时间'''
+        self.bytes += len(data)
+        start = timestamp - len(data) * self.char_time # 第一个字节大概的时间
+        if self._buf and self._last_time is not None and start - self._last_time > self.gap:
+            # 空闲超过 t3.5，前边剩下的是一帧
+            self._parse(self._last_time, final=True)
+        self._buf += data
+        self._last_time = timestamp
+        self._parse(timestamp)
+
+    def flush(self):
+        '''数据结束了，剩下的字节当成一帧'''
+        if self._buf:
+            self._parse(self._last_time, final=True)
+
+    def _parse(self, end_time, final=False):
+        buf = self._buf
+        pos = 0
+        size = len(buf)
+        while size - pos >= 4:
+            lengths = candidate_lengths(buf, pos)
+            length = 0
+            waiting = False
+            for n in lengths:
+                if size - pos < n:
+                    waiting = True
+                    break
+                if check_frame(buf[pos:pos + n]):
+                    length = n
+                    break
+            if not length and not lengths and final:
+                # 不认识的功能码，整个剩下的当成一帧
+                if check_frame(buf[pos:]):
+                    length = size - pos
+            if length:
+                # 帧结束的时间：后边还有多少字节，就往前推多少个字符的时间
+                self._frame(bytes(buf[pos:pos + length]), end_time - (size - pos - length) * self.char_time)
+                pos += length
+                continue
+            if (waiting or not lengths) and not final:
+                break # 等更多的数据
+            pos += 1
+            self.bad_bytes += 1
+        if final:
+            self.bad_bytes += size - pos
+            pos = size
+        del buf[:pos]
+
+    def _frame(self, frame, timestamp):
+        self.frames += 1
+        pending = self._pending
+        start = timestamp - len(frame) * self.char_time
+        if pending is not None and start - pending[1] > self.timeout:
+            # 等应答超时了，后边来的帧不能再配给这个请求
+            self._transaction(pending[0], None, None, pending[1])
+            pending = self._pending = None
+        if pending is not None and self._is_response(pending[0], frame):
+            self._pending = None
+            self._transaction(pending[0], frame, max(start - pending[1], 0.0), timestamp)
+            return
+        if not maybe_request(frame):
+            # 只能是应答，请求没有收到（CRC 错了或者从中间开始听的），不算请求
+            self.orphans += 1
+            return
+        if pending is not None:
+            # 新的请求来了，上一个请求没有应答
+            self._transaction(pending[0], None, None, pending[1])
+        self._pending = (frame, timestamp)
+        with self.lock:
+            unit = self.units.get(frame[0])
+            if unit is None:
+                unit = self.units[frame[0]] = UnitStats(frame[0])
+            unit.requests += 1
+            if unit.first_time is None:
+                unit.first_time = timestamp
+            unit.last_time = timestamp
+        if frame[0] == 0:
+            self._pending = None # 广播没有应答
+
+    @staticmethod
+    def _is_response(request, frame):
+        if frame[0] != request[0]:
+            return False
+        if frame[1] == request[1] | 0x80:
+            return len(frame) == 5
+        if frame[1] != request[1]:
+            return False
+        if request[1] in read_functions or request[1] in write_functions:
+            return len(frame) == response_length(request)
+        return True
+
+    def _transaction(self, request, response, latency, timestamp):
+        unit = self.units[request[0]]
+        with self.lock:
+            if response is None:
+                unit.timeouts += 1
+            else:
+                unit.responses += 1
+                if response[1] & 0x80:
+                    unit.exceptions += 1
+                unit.latency.record(latency)
+            self.history.append((timestamp, describe(request, response)))
+        if self.on_transaction is not None:
+            self.on_transaction(request, response, latency)
+
+    def table(self) -> list:
+        '''每个从站一行：(从站, 交易速率, 错误率, 平均延迟, p99延迟, 请求, 应答, 异常, 超时)，延迟是秒'''
+        with self.lock:
+            return [(u.unit, u.rate(), u.error_rate(), u.latency.mean(), u.latency.percentile(99),
+                     u.requests, u.responses, u.exceptions, u.timeouts)
+                    for _, u in sorted(self.units.items())]
+
+    def recent(self, n=None) -> list:
+        with self.lock:
+            items = list(self.history)
+        return items if n is None else items[-n:]
+
+
+def _benchmark(baudrate=115200, transactions=20000):
+    # 按照115200波特率连续的数据量测试解析速度，数据随机切成小块模拟接收线程
+    import random
+    from modbus_slave import SlaveStore, handle_request
+    from modbus_rtu import build_read, build_write_multiple_registers, build_write_single_coil, READ_HOLDING_REGISTERS
+    from serial_session import char_time, silent_interval
+    rnd = random.Random(0)
+    store = SlaveStore()
+    store.set_registers(0, range(200))
+    stream = []
+    for i in range(transactions):
+        unit = 1 + i % 5
+        kind = i % 4
+        if kind == 0:
+            request = build_read(unit, READ_HOLDING_REGISTERS, rnd.randrange(50), rnd.randint(1, 125))
+        elif kind == 1:
+            request = build_read(unit, READ_COILS, 0, rnd.randint(1, 100))
+        elif kind == 2:
+            request = build_write_multiple_registers(unit, 10, [1, 2, 3])
+        else:
+            request = build_write_single_coil(unit, 3, True)
+        stream.append(request)
+        if unit == 5 and kind == 3:
+            continue # 从站5偶尔不应答
+        response = handle_request(store, request)
+        if i % 997 == 0:
+            response = response[:-1] + bytes([response[-1] ^ 1]) # 偶尔有坏帧
+        stream.append(response)
+    data = b''.join(stream)
+    _char_time = char_time(baudrate)
+    sniffer = ModbusSniffer(silent_interval(baudrate), _char_time)
+    # 切成随机大小的块，每块的时间按照波特率累加，不同的帧之间留 t3.5 的空闲
+    chunks = []
+    t = 0.0
+    for frame in stream:
+        pos = 0
+        t += 0.002
+        while pos < len(frame):
+            n = rnd.randint(1, 64)
+            t += min(n, len(frame) - pos) * _char_time
+            chunks.append((frame[pos:pos + n], t))
+            pos += n
+    start = time.perf_counter()
+    for chunk, t in chunks:
+        sniffer.feed(chunk, t)
+    sniffer.flush()
+    elapsed = time.perf_counter() - start
+    print('{} 字节，{} 块，解析 {:.0f} 字节/秒，{} 波特率连续数据是 {:.0f} 字节/秒（{:.1f}% CPU）'.format(
+        len(data), len(chunks), len(data) / elapsed, baudrate, 1 / _char_time, elapsed / t * 100))
+    print('帧 {}，丢弃字节 {}，配不上请求的应答 {}'.format(sniffer.frames, sniffer.bad_bytes, sniffer.orphans))
+    for row in sniffer.table():
+        print('从站{}：{:.0f} 次/秒，错误率 {:.1%}，平均延迟 {:.2f} ms，p99 {:.2f} ms，请求 {} 应答 {} 异常 {} 超时 {}'.format(
+            row[0], row[1], row[2], row[3] * 1000, row[4] * 1000, *row[5:]))
+    print(sniffer.recent(1)[0][1][:100])
+    assert sum(row[5] for row in sniffer.table()) == transactions
+    # 从应答中间开始听：第一个应答不算请求；应答晚于 timeout 算超时，这个应答也不算请求
+    request = build_read(1, READ_HOLDING_REGISTERS, 0, 10)
+    response = handle_request(store, request)
+    sniffer = ModbusSniffer(silent_interval(baudrate), _char_time, timeout=0.5)
+    for frame, t in ((response[4:], 0.5), (response, 1.0), (request, 2.0), (response, 3.0), (request, 4.0), (response, 4.1)):
+        sniffer.feed(frame, t)
+    assert sniffer.orphans == 2 and sniffer.table()[0][5:] == (2, 1, 0, 1), (sniffer.orphans, sniffer.table())
+
+
+if __name__ == '__main__':
+    _benchmark()
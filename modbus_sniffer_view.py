@@ -0,0 +1,61 @@
+# 总线监听的窗口
+# 上边是每个从站的统计表，下边是最近的交易，定时从 ModbusSniffer 里边取，解析在接收线程里边做。
+
+from PySide6.QtCore import QTimer, Signal
+from PySide6.QtGui import QFontDatabase
+from PySide6.QtWidgets import QWidget, QTableWidget, QTableWidgetItem, QPlainTextEdit, QVBoxLayout, QLabel
+
+# 刷新的间隔，ms
+REFRESH_INTERVAL = 500
+# 下边最多显示的交易条数
+MAX_RECENT = 200
+
+COLUMNS = ('从站', '次/秒', '错误率', '平均延迟(ms)', 'p99延迟(ms)', '请求', '应答', '异常', '超时')
+
+
+class SnifferView(QWidget):
+    '''显示总线监听的结果，关闭窗口的时候发 closed 信号'''
+    closed = Signal()
+
+    def __init__(self, sniffer, parent=None) -> None:
+        super().__init__(parent)
+        self.setWindowTitle('总线监听')
+        self.resize(800, 600)
+        self.sniffer = sniffer
+        self.lbl_info = QLabel(self)
+        self.table = QTableWidget(0, len(COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.txt_recent = QPlainTextEdit(self)
+        self.txt_recent.setReadOnly(True)
+        self.txt_recent.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.lbl_info)
+        layout.addWidget(self.table, 1)
+        layout.addWidget(self.txt_recent, 2)
+        self.last_recent = None
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(REFRESH_INTERVAL)
+
+    def refresh(self):
+        sniffer = self.sniffer
+        self.lbl_info.setText('{} 字节，{} 帧，丢弃 {} 字节'.format(sniffer.bytes, sniffer.frames, sniffer.bad_bytes))
+        rows = sniffer.table()
+        self.table.setRowCount(len(rows))
+        for row, (unit, rate, error_rate, mean, p99, *counts) in enumerate(rows):
+            texts = [str(unit), '{:.1f}'.format(rate), '{:.1%}'.format(error_rate),
+                     '{:.2f}'.format(mean * 1000), '{:.2f}'.format(p99 * 1000)] + [str(i) for i in counts]
+            for column, text in enumerate(texts):
+                self.table.setItem(row, column, QTableWidgetItem(text))
+        recent = sniffer.recent(MAX_RECENT)
+        if recent and recent[-1] is not self.last_recent:
+            # 有新的交易才刷新下边的文本
+            self.last_recent = recent[-1]
+            self.txt_recent.setPlainText('\n'.join(text for _, text in recent))
+            self.txt_recent.verticalScrollBar().setValue(self.txt_recent.verticalScrollBar().maximum())
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.closed.emit()
+        super().closeEvent(event)
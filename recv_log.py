@@ -0,0 +1,208 @@
+# 接收区的数据模型
+# 原来是直接往 QPlainTextEdit 里边追加文本，时间长了以后文档越来越大，越来越慢。
+# 这里把每一行保存成紧凑的字节，按块（每块固定的行数）存放，
+# 超过了保留的字节数或者行数以后从最前面整块丢弃，所以追加的开销是固定的。
+# 显示的时候只需要格式化看得见的那几行。
+
+import time
+from array import array
+
+from hexdump import HexDumpFormatter
+
+FLAG_SEND = 1 # 发送的数据，没有这个标志的是接收的数据
+FLAG_TIME = 2 # 行首显示时间和方向
+FLAG_HEX = 4  # 原始的字节，显示成十六进制；没有这个标志的是utf-8编码的文本
+FLAG_DUMP = 8 # 和 FLAG_HEX 一起用，显示成十六进制转储（偏移、十六进制、可见字符），一行最多 dump_width 个字节
+KIND_MASK = FLAG_SEND | FLAG_HEX | FLAG_DUMP # 这几个标志不一样的数据不能放在一行里边
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024 # 默认最多保留的字节数
+DEFAULT_MAX_LINES = 1000000          # 默认最多保留的行数
+DEFAULT_MAX_LINE_BYTES = 1024        # 一行最多的字节数，超过了就换行
+LINES_PER_CHUNK = 1024               # 每块的行数
+DEFAULT_DUMP_WIDTH = 16              # 十六进制转储每行的字节数
+# 十六进制转储没有时间的行，前边空出时间和方向的宽度（"12:00:00 收<- :"，汉字占两个字符），这样每一列能对齐
+DUMP_PREFIX = ' ' * 17
+
+
+class _Chunk:
+    # 一块里边的所有行，数据连续存放，starts 是每一行的开始位置。
+    __slots__ = ('data', 'starts', 'times', 'flags', 'offsets')
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.starts = array('L')
+        self.times = array('d')
+        self.flags = bytearray()
+        self.offsets = array('Q') # 每一行第一个字节在收（发）的十六进制数据里边的位置
+
+
+class RecvLog:
+    '''接收区的数据，有保留上限，按行随机访问'''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_lines=DEFAULT_MAX_LINES,
+                 max_line_bytes=DEFAULT_MAX_LINE_BYTES, lines_per_chunk=LINES_PER_CHUNK,
+                 dump_width=DEFAULT_DUMP_WIDTH) -> None:
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.max_line_bytes = max_line_bytes
+        self.lines_per_chunk = lines_per_chunk
+        self.dump = HexDumpFormatter(dump_width)
+        self.dropped_lines = 0 # 因为超过上限丢弃的总行数，一直增加
+        self.generation = 0    # 每次清空加一，视图根据这个判断是否需要重置
+        self._reset()
+
+    def _reset(self):
+        self._chunks = []
+        self._skip = 0  # 第一块里边已经丢弃的行数
+        self._lines = 0 # 所有块里边的行数（包括 _skip）
+        self.total_bytes = 0
+        self._offsets = [0, 0] # 接收和发送的十六进制数据的总字节数
+
+    def __len__(self):
+        return self._lines - self._skip
+
+    def clear(self):
+        self._reset()
+        self.generation += 1
+
+    def _new_line(self, flags, timestamp):
+        k = self.lines_per_chunk
+        if self._lines % k == 0:
+            self._chunks.append(_Chunk())
+        chunk = self._chunks[-1]
+        chunk.starts.append(len(chunk.data))
+        chunk.times.append(timestamp)
+        chunk.flags.append(flags)
+        chunk.offsets.append(self._offsets[flags & FLAG_SEND])
+        self._lines += 1
+        return chunk
+
+    def _last_line_size(self, chunk):
+        return len(chunk.data) - chunk.starts[-1]
+
+    def append(self, data, new_line=False, flags=0, timestamp=None):
+        '''追加数据，new_line 表示另起一行，flags 只在新的一行上起作用'''
+        if not data and not new_line:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        kind = flags & KIND_MASK
+        if len(self) == 0 or new_line:
+            chunk = self._new_line(flags, timestamp)
+        else:
+            chunk = self._chunks[-1]
+            if chunk.flags[-1] & KIND_MASK != kind:
+                # 发送和接收，文本和十六进制不能混在一行里边
+                chunk = self._new_line(flags, timestamp)
+        if flags & FLAG_HEX:
+            self._append_bytes(chunk, data, kind, timestamp)
+        else:
+            # 文本按照换行符分成多行
+            parts = bytes(data).replace(b'\r', b'').split(b'\n')
+            self._append_bytes(chunk, parts[0], kind, timestamp)
+            for part in parts[1:]:
+                self._append_bytes(self._new_line(kind, timestamp), part, kind, timestamp)
+        self._trim()
+
+    def append_text(self, text, new_line=False, flags=0, timestamp=None):
+        self.append(text.encode('utf-8'), new_line, flags & ~FLAG_HEX, timestamp)
+
+    def skip(self, size, flags=0):
+        '''没有显示的十六进制数据（比如只显示了汇总）也要算到偏移里边'''
+        self._offsets[flags & FLAG_SEND] += size
+
+    def _append_bytes(self, chunk, data, kind, timestamp):
+        limit = self.dump.width if kind & FLAG_DUMP else self.max_line_bytes
+        pos = 0
+        size = len(data)
+        while pos < size:
+            room = limit - self._last_line_size(chunk)
+            if room <= 0:
+                # 一行满了，接着的一行不显示时间
+                chunk = self._new_line(kind, timestamp)
+                room = limit
+            end = min(size, pos + room)
+            if end < size and not kind & FLAG_HEX:
+                # 文本不能从一个utf-8字符的中间断开
+                while end > pos and (data[end] & 0xc0) == 0x80:
+                    end -= 1
+                if end == pos:
+                    end = min(size, pos + room)
+            chunk.data += data[pos:end]
+            self.total_bytes += end - pos
+            if kind & FLAG_HEX:
+                self._offsets[kind & FLAG_SEND] += end - pos
+            pos = end
+
+    def _trim(self):
+        # 超过上限的时候从最前面丢弃
+        k = self.lines_per_chunk
+        excess = len(self) - self.max_lines
+        if excess > 0:
+            self._skip += excess
+            self.dropped_lines += excess
+        while len(self._chunks) > 1 and (self._skip >= k or self.total_bytes > self.max_bytes):
+            chunk = self._chunks.pop(0)
+            self.total_bytes -= len(chunk.data)
+            self.dropped_lines += k - min(self._skip, k)
+            self._skip = max(self._skip - k, 0)
+            self._lines -= k
+
+    def _locate(self, row):
+        k = self.lines_per_chunk
+        idx = self._skip + row
+        return self._chunks[idx // k], idx % k
+
+    def line_offset(self, row):
+        '''这一行第一个字节在收（发）的十六进制数据里边的位置'''
+        chunk, i = self._locate(row)
+        return chunk.offsets[i]
+
+    def line(self, row):
+        '''返回 (时间, 标志, 字节)'''
+        chunk, i = self._locate(row)
+        start = chunk.starts[i]
+        end = chunk.starts[i + 1] if i + 1 < len(chunk.starts) else len(chunk.data)
+        return chunk.times[i], chunk.flags[i], bytes(chunk.data[start:end])
+
+    def line_text(self, row):
+        '''格式化一行，用于显示'''
+        if row < 0 or row >= len(self):
+            return ''
+        timestamp, flags, data = self.line(row)
+        prefix = ''
+        if flags & FLAG_TIME:
+            prefix = time.strftime("%H:%M:%S", time.localtime(timestamp)) + '.{:03d} '.format(int(timestamp * 1000) % 1000)
+            prefix += '发-> :' if flags & FLAG_SEND else '收<- :'
+        if flags & FLAG_DUMP:
+            return (prefix or DUMP_PREFIX) + self.dump.format_row(data, self.line_offset(row))
+        if flags & FLAG_HEX:
+            return prefix + data.hex(' ')
+        return prefix + data.decode('utf-8', errors='replace')
+
+    def iter_text(self, start=0, stop=None):
+        n = len(self)
+        stop = n if stop is None else min(stop, n)
+        for row in range(start, stop):
+            yield self.line_text(row)
+
+
+if __name__ == '__main__':
+    # 追加的时间不随着历史的增加而增加
+    log = RecvLog(max_bytes=1 << 20, max_lines=10000)
+    payload = bytes(range(32))
+    for rounds in range(4):
+        t = time.perf_counter()
+        for i in range(100000):
+            log.append(payload, new_line=(i % 4 == 0), flags=FLAG_HEX | FLAG_TIME)
+        t = time.perf_counter() - t
+        print('第{}轮 10万次追加: {:.1f} ms, 行数 {}, 字节 {}, 丢弃 {} 行'.format(
+            rounds + 1, t * 1e3, len(log), log.total_bytes, log.dropped_lines))
+    assert len(log) <= 10000 and log.total_bytes <= (1 << 20) + LINES_PER_CHUNK * 128
+    log.clear()
+    log.append_text('abc\r\ndef', new_line=True, flags=FLAG_TIME | FLAG_SEND)
+    log.append(b'\x01\x02', flags=FLAG_HEX | FLAG_TIME)
+    assert [log.line(i)[2] for i in range(len(log))] == [b'abc', b'def', b'\x01\x02']
+    assert log.line_text(2).endswith('收<- :01 02')
+    log.append(bytes(range(20)), new_line=True, flags=FLAG_HEX | FLAG_DUMP | FLAG_TIME)
+    assert log.line_text(3).endswith('收<- :00000002  00 01 02 03 04 05 06 07  08 09 0a 0b 0c 0d 0e 0f  |................|')
+    assert log.line_text(4) == DUMP_PREFIX + '00000012  10 11 12 13' + ' ' * 39 + '|....|'
@@ -0,0 +1,44 @@
+# 接收数据显示之前的处理：分帧以后每一帧另起一行，行首显示时间，按照显示模式转成接收区的内容，放到 RenderPipeline 里边。
+# 界面（main.py）和基准测试（benchmark.py）都用这个，基准测试测的就是界面走的路径。
+
+from codec import MODE_HEX, Decoder
+from framing import make_framer
+from recv_log import FLAG_TIME, FLAG_HEX, FLAG_DUMP
+
+
+class ReceivePath:
+    '''分帧、解码、放到显示队列里边；mode、encoding、hex_dump 可以随时改，下一帧开始生效'''
+    def __init__(self, render, framing, mode=MODE_HEX, encoding='utf-8', hex_dump=False) -> None:
+        self.render = render
+        self.framer = make_framer(framing)
+        self.mode = mode
+        self.encoding = encoding
+        self.hex_dump = hex_dump # 十六进制显示的时候是不是显示成转储的格式
+        self.decoder = Decoder(MODE_HEX)
+        self.frames = 0
+
+    def feed(self, data, breaks=()) -> int:
+        '''接收线程取出来的一批数据，breaks 是空闲的位置，返回显示了几帧'''
+        return self.show(self.framer.feed(data, breaks))
+
+    def flush(self) -> int:
+        '''分帧里边剩下的数据当作一帧显示'''
+        return self.show(self.framer.flush())
+
+    def show(self, frames) -> int:
+        render = self.render
+        count = 0
+        for frame in frames:
+            # 换行得看是否有数据，接收区是空的就不用换行
+            newline = len(render.log) > 0 or render.pending_bytes > 0
+            if self.mode == MODE_HEX:
+                # 直接保存字节，显示的时候才转成十六进制
+                render.push(frame, FLAG_HEX | FLAG_DUMP | FLAG_TIME if self.hex_dump else FLAG_HEX | FLAG_TIME, newline)
+            else:
+                # 文本或者双字节，切换了模式或者编码就换一个解码器
+                if self.decoder.mode != self.mode or self.decoder.encoding != self.encoding:
+                    self.decoder = Decoder(self.mode, self.encoding)
+                render.push(self.decoder.decode(frame).rstrip('\r\n').encode('utf-8'), FLAG_TIME, newline)
+            count += 1
+        self.frames += count
+        return count
@@ -0,0 +1,127 @@
+# 接收区的刷新
+# 接收到的数据先放到这里，界面按照固定的帧率一次性地刷新到接收区，
+# 这样刷新的次数和接收的次数没有关系。
+# 如果来的数据比界面能显示的多，就不显示具体的数据了，只显示一行 "+12 345 字节" 的汇总。
+
+import time
+
+from recv_log import FLAG_SEND, FLAG_TIME, FLAG_HEX, KIND_MASK
+
+DEFAULT_MAX_FPS = 20                 # 每秒最多刷新的次数
+DEFAULT_MAX_DISPLAY_RATE = 200000    # 每秒最多显示的字节数，超过了就只显示汇总
+BACKLOG_WINDOW = 1.0                 # 状态栏显示最近这么多秒里边积压最多的字节数
+
+
+def format_count(n):
+    # 12345 -> '12 345'
+    return '{:,}'.format(n).replace(',', ' ')
+
+
+class RenderPipeline:
+    '''收集要显示的数据，flush() 的时候批量写到 RecvLog 里边'''
+    def __init__(self, log, max_fps=DEFAULT_MAX_FPS, max_display_rate=DEFAULT_MAX_DISPLAY_RATE) -> None:
+        self.log = log
+        self.max_fps = max_fps
+        self.max_display_rate = max_display_rate
+        self._pending = [] # [标志, 是否换行, 时间, 数据]
+        self.pending_bytes = 0
+        self.last_flush = time.perf_counter()
+        self.backlog = 0 # 最近 BACKLOG_WINDOW 秒里边刷新的时候积压最多的字节数
+        self._backlog_time = self.last_flush
+        self.summary_mode = False # 是否处于只显示汇总的状态
+        self._force_newline = False
+        # 统计信息
+        self.flushes = 0
+        self.summarized_bytes = 0 # 没有显示具体内容的字节数
+        self.last_render_time = 0.0 # 最后一次刷新用的时间，秒
+        self._fps_count = 0
+        self._fps_start = self.last_flush
+        self.fps = 0.0
+
+    def delay(self):
+        # 距离下一次可以刷新还要等多少毫秒
+        wait = self.last_flush + 1.0 / self.max_fps - time.perf_counter()
+        return max(0, int(wait * 1000))
+
+    def push(self, data, flags=0, new_line=False, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        kind = flags & KIND_MASK
+        pending = self._pending
+        if pending and not new_line and pending[-1][0] & KIND_MASK == kind:
+            # 和上一段是连续的，直接合并
+            pending[-1][3] += data
+        else:
+            pending.append([flags, new_line, timestamp, bytearray(data)])
+        self.pending_bytes += len(data)
+
+    def flush(self) -> bool:
+        '''把积压的数据写到接收区，返回是否有变化'''
+        now = time.perf_counter()
+        elapsed = now - self.last_flush
+        self.last_flush = now
+        if not self._pending:
+            return False
+        start = now
+        if self.pending_bytes >= self.backlog or now - self._backlog_time >= BACKLOG_WINDOW:
+            self.backlog = self.pending_bytes
+            self._backlog_time = now
+        pending = self._pending
+        self._pending = []
+        log = self.log
+        # 这段时间内界面最多能显示的数据量
+        budget = self.max_display_rate * max(elapsed, 1.0 / self.max_fps)
+        received = sum(len(item[3]) for item in pending if not item[0] & FLAG_SEND)
+        if received > budget:
+            # 显示不过来，只显示发送的数据和接收数据的汇总
+            self.summary_mode = True
+            self.summarized_bytes += received
+            log.append_text('+{} 字节'.format(format_count(received)), new_line=True,
+                            flags=FLAG_TIME, timestamp=pending[0][2])
+            self._force_newline = True
+            for flags, new_line, timestamp, data in pending:
+                if flags & FLAG_SEND:
+                    log.append(data, new_line=True, flags=flags, timestamp=timestamp)
+                elif flags & FLAG_HEX:
+                    # 只有十六进制的数据算到转储的偏移里边
+                    log.skip(len(data), flags)
+        else:
+            self.summary_mode = False
+            for flags, new_line, timestamp, data in pending:
+                if self._force_newline:
+                    new_line = True
+                    flags |= FLAG_TIME
+                    self._force_newline = False
+                log.append(data, new_line=new_line, flags=flags, timestamp=timestamp)
+        self.pending_bytes = 0
+        self.flushes += 1
+        self._fps_count += 1
+        if now - self._fps_start >= 1.0:
+            self.fps = self._fps_count / (now - self._fps_start)
+            self._fps_count = 0
+            self._fps_start = now
+        self.last_render_time = time.perf_counter() - start
+        return True
+
+    def clear(self):
+        self._pending = []
+        self.pending_bytes = 0
+        self._force_newline = False
+        self.reset_status()
+
+    def reset_status(self):
+        # 清掉状态栏上的积压和汇总状态，关闭串口的时候调用
+        self.backlog = 0
+        self.summary_mode = False
+        self.fps = 0.0
+
+    def status(self):
+        # 显示在状态栏上的统计信息
+        now = time.perf_counter()
+        fps = self.fps if now - self.last_flush < 1.0 else 0.0
+        # 最近有刷新的时候显示积压的峰值，没有了就只显示现在还没有刷新的
+        backlog = self.backlog if now - self._backlog_time < BACKLOG_WINDOW else 0
+        text = '刷新 {:.0f} 次/秒，积压 {} 字节'.format(fps, format_count(max(backlog, self.pending_bytes)))
+        if self.summary_mode:
+            text += '，数据太快，只显示汇总'
+        return text
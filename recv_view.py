@@ -0,0 +1,85 @@
+# 接收区的视图
+# 用 QListView 显示 RecvLog，列表视图只会请求看得见的那几行，
+# 所以不管保存了多少历史数据，刷新的开销都差不多。
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex
+from PySide6.QtGui import QFontDatabase
+from PySide6.QtWidgets import QListView, QAbstractItemView, QApplication
+
+
+class RecvLogModel(QAbstractListModel):
+    '''把 RecvLog 包装成Qt的列表模型，追加数据以后调用 sync() 通知视图'''
+    def __init__(self, log, parent=None) -> None:
+        super().__init__(parent)
+        self.log = log
+        self._rows = 0 # 视图知道的行数
+        self._dropped = log.dropped_lines
+        self._generation = log.generation
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._rows
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.log.line_text(index.row())
+        return None
+
+    def sync(self):
+        # 根据 RecvLog 的变化来通知视图：清空、前面丢弃的行、后边新加的行。
+        log = self.log
+        if log.generation != self._generation:
+            self.beginResetModel()
+            self._generation = log.generation
+            self._dropped = log.dropped_lines
+            self._rows = len(log)
+            self.endResetModel()
+            return
+        removed = min(log.dropped_lines - self._dropped, self._rows)
+        self._dropped = log.dropped_lines
+        if removed > 0:
+            self.beginRemoveRows(QModelIndex(), 0, removed - 1)
+            self._rows -= removed
+            self.endRemoveRows()
+        if self._rows > 0:
+            # 最后一行可能变长了
+            last = self.index(self._rows - 1)
+            self.dataChanged.emit(last, last)
+        n = len(log)
+        if n > self._rows:
+            self.beginInsertRows(QModelIndex(), self._rows, n - 1)
+            self._rows = n
+            self.endInsertRows()
+
+
+class RecvLogView(QListView):
+    '''接收区，所有的行高度一样，在最底部的时候自动滚动'''
+    def __init__(self, log, parent=None) -> None:
+        super().__init__(parent)
+        self.log_model = RecvLogModel(log, self)
+        self.setModel(self.log_model)
+        self.setUniformItemSizes(True)
+        self.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.setTextElideMode(Qt.ElideRight)
+
+    def sync(self):
+        bar = self.verticalScrollBar()
+        at_bottom = bar.value() >= bar.maximum()
+        self.log_model.sync()
+        if at_bottom:
+            self.scrollToBottom()
+
+    def clear(self):
+        self.log_model.log.clear()
+        self.log_model.sync()
+
+    def copy(self):
+        # 复制选中的行，没有选中就复制全部
+        log = self.log_model.log
+        rows = sorted(index.row() for index in self.selectionModel().selectedIndexes())
+        if rows:
+            text = '\n'.join(log.line_text(row) for row in rows)
+        else:
+            text = '\n'.join(log.iter_text())
+        QApplication.clipboard().setText(text)
@@ -0,0 +1,253 @@
+# 串口的后台接收线程
+# 接收线程阻塞在串口上读取，读到的数据放到预先分配好的环形缓冲区里边，
+# 然后通知界面（回调函数），界面再一批一批地把数据取走。
+# 环形缓冲区只有一个写入者（接收线程）和一个读取者（界面），
+# 写入者只修改 _head，读取者只修改 _tail，所以不需要加锁。
+
+import threading
+import time
+from collections import deque
+
+from capture import DIR_RECV
+
+# 默认的环形缓冲区大小，921600波特率下大概可以缓存10秒的数据。
+DEFAULT_RING_SIZE = 1 << 20
+# 接收线程每次最多读取的字节数
+DEFAULT_READ_SIZE = 64 * 1024
+# 接收线程阻塞读取的超时时间，秒，用来检查是否需要退出。
+READ_TIMEOUT = 0.05
+# 最多保留的空闲位置，界面一直不取的时候丢掉最早的
+MAX_BREAKS = 65536
+
+
+class RingBuffer:
+    '''单生产者单消费者的环形缓冲区，满了以后新的数据会被丢弃并计数'''
+    def __init__(self, capacity=DEFAULT_RING_SIZE) -> None:
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self.capacity = capacity
+        # 下边两个是单调递增的总字节数，相减就是缓冲区里边的数据量。
+        self._head = 0 # 写入的总数，只有写入者修改
+        self._tail = 0 # 读取的总数，只有读取者修改
+        self.dropped = 0 # 缓冲区满了丢弃的字节数
+        self.high_water = 0 # 缓冲区里边最多的时候有多少数据
+
+    def __len__(self):
+        return self._head - self._tail
+
+    @property
+    def write_offset(self):
+        # 写入的总字节数，也就是下一个写入的字节在整个数据流里边的位置
+        return self._head
+
+    @property
+    def read_offset(self):
+        # 读取的总字节数，也就是下一个读取的字节在整个数据流里边的位置
+        return self._tail
+
+    def free(self):
+        return self.capacity - (self._head - self._tail)
+
+    def write(self, data) -> int:
+        # 写入数据，返回实际写入的字节数，写不下的部分丢弃。
+        size = len(data)
+        n = min(size, self.capacity - (self._head - self._tail))
+        if n < size:
+            self.dropped += size - n
+        if n <= 0:
+            return 0
+        pos = self._head % self.capacity
+        first = min(n, self.capacity - pos)
+        self._view[pos:pos + first] = data[:first]
+        if first < n:
+            self._view[0:n - first] = data[first:n]
+        # 数据拷贝完了以后才更新 _head，读取者才能看到这些数据。
+        self._head += n
+        used = self._head - self._tail
+        if used > self.high_water:
+            self.high_water = used
+        return n
+
+    def read(self, size=None) -> bytes:
+        # 读取最多size个字节，None表示全部读取。
+        n = self._head - self._tail
+        if size is not None and size < n:
+            n = size
+        if n <= 0:
+            return b''
+        pos = self._tail % self.capacity
+        first = min(n, self.capacity - pos)
+        if first < n:
+            data = bytes(self._view[pos:pos + first]) + bytes(self._view[0:n - first])
+        else:
+            data = bytes(self._view[pos:pos + n])
+        self._tail += n
+        return data
+
+    def clear(self):
+        # 只能在读取的一方调用
+        self._tail = self._head
+
+
+class SerialReader(threading.Thread):
+    '''串口接收线程，on_data 在有新数据并且上次的通知已经被处理了的时候调用（在接收线程里边）'''
+    def __init__(self, serial, ring=None, on_data=None, read_size=DEFAULT_READ_SIZE) -> None:
+        super().__init__(name='SerialReader', daemon=True)
+        self.serial = serial
+        self.ring = ring if ring is not None else RingBuffer()
+        self.on_data = on_data
+        self.read_size = read_size
+        self.error = None # 接收线程退出的时候的异常
+        self.recorder = None # 录制，有 write(data, direction, timestamp_ns) 方法，在接收线程里边调用
+        self.taps = [] # 其他需要原始数据和时间戳的（比如总线监听），和录制一样的 write() 方法，SerialSession 发送的数据也会给它们
+        # 分帧用：空闲超过 idle_gap 秒以后收到的数据，把它在数据流里边的位置记到 breaks 里边，None 表示不记
+        self.idle_gap = None
+        self.char_time = 0.0 # 一个字符的传输时间，算空闲时间的时候减掉这一块数据本身的传输时间
+        self.breaks = deque(maxlen=MAX_BREAKS)
+        # 统计信息
+        self.bytes_read = 0
+        self.read_calls = 0
+        self.start_time = None
+        self.last_recv_time = None # 最后收到数据的时间，time.perf_counter()
+        self._stop_event = threading.Event()
+        self._notified = False
+
+    def run(self):
+        ser = self.serial
+        # 串口要设置成阻塞读取，超时是为了能够及时退出。
+        if not ser.timeout:
+            ser.timeout = READ_TIMEOUT
+        self.start_time = time.perf_counter()
+        while not self._stop_event.is_set():
+            try:
+                waiting = ser.in_waiting
+                data = ser.read(min(max(waiting, 1), self.read_size))
+            except Exception as err:
+                self.error = err
+                break
+            self.read_calls += 1
+            if not data:
+                continue
+            now = time.perf_counter()
+            idle_gap = self.idle_gap
+            if idle_gap is not None and self.last_recv_time is not None and \
+                    now - self.last_recv_time - len(data) * self.char_time > idle_gap:
+                # 先记位置再写数据，界面读到数据的时候一定能看到这个位置
+                self.breaks.append(self.ring.write_offset)
+            self.last_recv_time = now
+            self.bytes_read += len(data)
+            recorder = self.recorder
+            if recorder is not None or self.taps:
+                # 录制在这里做，时间戳准确，并且界面来不及显示的数据也能录下来
+                timestamp = time.perf_counter_ns()
+                if recorder is not None:
+                    recorder.write(data, DIR_RECV, timestamp)
+                for tap in self.taps:
+                    tap.write(data, DIR_RECV, timestamp)
+            self.ring.write(data)
+            if not self._notified and self.on_data is not None:
+                self._notified = True
+                self.on_data()
+        # 退出的时候也通知一下，让界面知道出错了。
+        if self.error is not None and self.on_data is not None:
+            self.on_data()
+
+    def read(self, size=None) -> bytes:
+        # 界面调用，取走缓冲区里边的数据。先清除通知标志，再读取，这样不会漏掉通知。
+        self._notified = False
+        return self.ring.read(size)
+
+    def read_with_breaks(self, size=None):
+        '''和 read() 一样，同时返回这些数据里边空闲超过 idle_gap 的位置（相对于返回的数据的开头）'''
+        start = self.ring.read_offset
+        data = self.read(size)
+        end = start + len(data)
+        breaks = []
+        marks = self.breaks
+        while marks and marks[0] < end:
+            offset = marks.popleft()
+            if offset >= start: # 比 start 小的是已经被别人取走了的数据
+                breaks.append(offset - start)
+        return data, breaks
+
+    def available(self):
+        return len(self.ring)
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    @property
+    def dropped(self):
+        return self.ring.dropped
+
+    def throughput(self):
+        # 开始以来的平均接收速度，字节/秒
+        if self.start_time is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.start_time
+        return self.bytes_read / elapsed if elapsed > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'bytes_read': self.bytes_read,
+            'read_calls': self.read_calls,
+            'dropped': self.ring.dropped,
+            'buffered': len(self.ring),
+            'high_water': self.ring.high_water,
+            'throughput': self.throughput(),
+        }
+
+
+def _loss_test(url=None, baudrate=921600, seconds=3.0):
+    # 用pty（或者 loop:// 之类的url）模拟满速率的数据，检查是否丢数据。
+    import os
+    import serial
+
+    if url is None:
+        master, slave = os.openpty()
+        ser = serial.Serial(os.ttyname(slave), baudrate=baudrate, timeout=READ_TIMEOUT)
+        writer_write = lambda b: os.write(master, b)
+    else:
+        master = None
+        ser = serial.serial_for_url(url, baudrate=baudrate, timeout=READ_TIMEOUT)
+        writer_write = ser.write
+
+    received = bytearray()
+    ready = threading.Event()
+    reader = SerialReader(ser, on_data=ready.set)
+    reader.start()
+
+    # 按照波特率发送，10位一个字节。
+    rate = baudrate / 10
+    chunk = 4096
+    pattern = bytes(range(256)) * (chunk // 256)
+    sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        target = (time.perf_counter() - start) * rate
+        while sent < target:
+            sent += writer_write(pattern)
+        if ready.wait(0.01):
+            ready.clear()
+            received.extend(reader.read())
+    deadline = time.perf_counter() + 2
+    while len(received) + len(reader.ring) < sent and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    received.extend(reader.read())
+    reader.stop()
+    ser.close()
+    if master is not None:
+        os.close(master)
+    ok = received == (pattern * (sent // len(pattern)))[:len(received)]
+    stats = reader.stats()
+    print('发送 {} 字节，接收 {} 字节，丢弃 {} 字节，数据{}，平均 {:.0f} 字节/秒，读取 {} 次'.format(
+        sent, len(received), stats['dropped'], '一致' if ok else '不一致',
+        stats['throughput'], stats['read_calls']))
+    return sent == len(received) and ok and stats['dropped'] == 0
+
+
+if __name__ == '__main__':
+    import sys
+    assert _loss_test(sys.argv[1] if len(sys.argv) > 1 else None)
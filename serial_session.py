@@ -0,0 +1,149 @@
+# 串口会话
+# 打开串口、后台接收、发送和录制都在这里，不依赖界面，
+# 界面（main.py）和命令行（comhelper.py）都用这个。
+
+import threading
+import time
+
+import serial
+
+from serial_reader import SerialReader, READ_TIMEOUT
+from capture import DIR_SEND
+
+# 波特率纯数字
+lst_baudrate = [str(i) for i in [600, 1200, 2400, 4800, 9600, 19200, 38400, 56000, 57600, 115200]] # 常用的波特率
+# 数据位，一个字典
+dict_bytesize = {
+    '5':serial.FIVEBITS,
+    '6':serial.SIXBITS,
+    '7':serial.SEVENBITS,
+    '8':serial.EIGHTBITS
+    }
+# 校验，也是一个字典。
+dict_parity = {
+    '无校验':serial.PARITY_NONE,
+    '奇校验':serial.PARITY_ODD,
+    '偶校验':serial.PARITY_EVEN,
+    'PARITY_MARK':serial.PARITY_MARK,
+    'PARITY_SPACE':serial.PARITY_SPACE
+}
+# 停止位，也是一个字典。
+dict_stopbits = {
+    '1':serial.STOPBITS_ONE,
+    '1.5':serial.STOPBITS_ONE_POINT_FIVE,
+    '2':serial.STOPBITS_TWO
+}
+
+
+def resolve_parameters(bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE):
+    '''参数可以是界面上用的名字（dict_bytesize 等字典的键），也可以直接是pyserial的值'''
+    bytesize = dict_bytesize.get(str(bytesize), bytesize)
+    parity = dict_parity.get(parity, parity)
+    stopbits = dict_stopbits.get(str(stopbits), stopbits)
+    return bytesize, parity, stopbits
+
+
+def char_time(baudrate, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE):
+    '''传输一个字符需要的秒数：起始位 + 数据位 + 校验位 + 停止位'''
+    bits = 1 + bytesize + (0 if parity == serial.PARITY_NONE else 1) + stopbits
+    return bits / baudrate
+
+
+def silent_interval(baudrate, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, chars=3.5):
+    '''modbus RTU 的帧间隔 t3.5（chars=1.5 就是字符间隔 t1.5），波特率大于19200的时候是固定值'''
+    if baudrate > 19200:
+        return 0.00175 if chars >= 3.5 else 0.00075
+    return chars * char_time(baudrate, bytesize, parity, stopbits)
+
+
+def list_ports():
+    '''返回 [(设备, 名称, 描述)]'''
+    import serial.tools.list_ports
+    return [(p.device, p.name, p.description) for p in serial.tools.list_ports.comports()]
+
+
+class SerialSession:
+    '''一个打开的串口：后台线程接收，write() 发送，收发的数据都可以录制'''
+    def __init__(self, port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+                 stopbits=serial.STOPBITS_ONE, on_data=None, recorder=None, **kwargs) -> None:
+        self.port = port
+        # serial_for_url 也支持 loop:// 之类的测试用的url
+        self.serial = serial.serial_for_url(
+            port,
+            baudrate=baudrate,
+            bytesize=bytesize,
+            parity=parity,
+            stopbits=stopbits,
+            timeout=READ_TIMEOUT, # 读取超时，接收线程阻塞读取。
+            **kwargs
+        )
+        self.on_data = on_data
+        self.bytes_written = 0
+        self._data_event = threading.Event()
+        self.reader = SerialReader(self.serial, on_data=self._on_data)
+        self.reader.char_time = char_time(baudrate, bytesize, parity, stopbits)
+        self.reader.recorder = recorder
+        self.reader.start()
+
+    def _on_data(self):
+        # 在接收线程里边调用
+        self._data_event.set()
+        if self.on_data is not None:
+            self.on_data()
+
+    @property
+    def recorder(self):
+        return self.reader.recorder
+
+    @recorder.setter
+    def recorder(self, recorder):
+        self.reader.recorder = recorder
+
+    def is_open(self):
+        return self.serial is not None and self.serial.is_open
+
+    def write(self, data) -> int:
+        taps = self.reader.taps
+        if taps:
+            # 延迟测量之类的需要发送的时间，记开始写串口之前的时间
+            timestamp = time.perf_counter_ns()
+            for tap in taps:
+                tap.write(data, DIR_SEND, timestamp)
+        n = self.serial.write(data)
+        self.bytes_written += len(data)
+        recorder = self.reader.recorder
+        if recorder is not None:
+            recorder.write(data, DIR_SEND)
+        return n
+
+    def read(self, size=None) -> bytes:
+        '''取走已经收到的数据，不会阻塞'''
+        self._data_event.clear()
+        return self.reader.read(size)
+
+    def read_with_breaks(self, size=None):
+        '''取走已经收到的数据，同时返回空闲的位置，见 SerialReader.read_with_breaks()'''
+        self._data_event.clear()
+        return self.reader.read_with_breaks(size)
+
+    def wait(self, timeout=None) -> bool:
+        '''等待新的数据，返回是否有数据'''
+        if self.reader.available():
+            return True
+        self._data_event.wait(timeout)
+        return self.reader.available() > 0
+
+    def close(self):
+        self.reader.stop()
+        self.serial.close()
+
+    def stats(self) -> dict:
+        stats = self.reader.stats()
+        stats['bytes_written'] = self.bytes_written
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,282 @@
+# 多个串口的会话管理
+# 一个线程用 selectors 同时监听所有串口的文件描述符（POSIX），
+# 哪个串口有数据就读哪个，每个串口有自己的环形缓冲区、统计信息和录制。
+# 没有文件描述符的串口（比如 loop://、Windows）就在同一个循环里边定时轮询。
+
+import os
+import selectors
+import threading
+import time
+
+import serial
+
+from serial_reader import RingBuffer, DEFAULT_READ_SIZE
+from capture import DIR_RECV, DIR_SEND
+
+# 轮询没有文件描述符的串口的间隔，秒
+POLL_INTERVAL = 0.01
+# 每个串口默认的环形缓冲区大小
+DEFAULT_PORT_RING_SIZE = 256 * 1024
+
+
+class PortSession:
+    '''会话管理器里边的一个串口'''
+    def __init__(self, manager, port, serial_port, ring_size=DEFAULT_PORT_RING_SIZE, on_data=None, recorder=None) -> None:
+        self.manager = manager
+        self.port = port
+        self.serial = serial_port
+        self.ring = RingBuffer(ring_size)
+        self.on_data = on_data # 有新数据的时候在IO线程里边调用，参数是这个对象
+        self.recorder = recorder
+        self.error = None
+        self.fd = None
+        # 统计信息
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.read_calls = 0
+        self.last_recv_time = None
+        self.start_time = time.perf_counter()
+        self._notified = False
+
+    def _received(self, data):
+        # 在IO线程里边调用
+        self.last_recv_time = time.perf_counter()
+        self.read_calls += 1
+        self.bytes_read += len(data)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.write(data, DIR_RECV, time.perf_counter_ns())
+        self.ring.write(data)
+        if not self._notified and self.on_data is not None:
+            self._notified = True
+            self.on_data(self)
+
+    def read(self, size=None) -> bytes:
+        self._notified = False
+        return self.ring.read(size)
+
+    def available(self):
+        return len(self.ring)
+
+    def write(self, data) -> int:
+        n = self.serial.write(data)
+        self.bytes_written += len(data)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.write(data, DIR_SEND)
+        return n
+
+    def close(self):
+        self.manager.close(self.port)
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'read_calls': self.read_calls,
+            'dropped': self.ring.dropped,
+            'buffered': len(self.ring),
+            'high_water': self.ring.high_water,
+            'throughput': self.bytes_read / elapsed if elapsed > 0 else 0.0,
+            'error': str(self.error) if self.error is not None else None,
+        }
+
+
+class SessionManager:
+    '''一个IO线程服务多个串口'''
+    def __init__(self, read_size=DEFAULT_READ_SIZE) -> None:
+        self.read_size = read_size
+        self.sessions = {} # 串口名 -> PortSession
+        self._selector = selectors.DefaultSelector()
+        self._polled = [] # 没有文件描述符，需要轮询的串口
+        self._lock = threading.Lock()
+        # 用一个管道唤醒 select，添加删除串口和退出的时候用
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._stop = False
+        self._thread = None
+        self.loop_count = 0
+
+    def open(self, port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE,
+             stopbits=serial.STOPBITS_ONE, on_data=None, recorder=None, ring_size=DEFAULT_PORT_RING_SIZE, **kwargs):
+        '''打开一个串口，加到IO循环里边'''
+        if port in self.sessions:
+            raise serial.SerialException('串口已经打开：{}'.format(port))
+        serial_port = serial.serial_for_url(port, baudrate=baudrate, bytesize=bytesize, parity=parity,
+                                            stopbits=stopbits, timeout=0, **kwargs)
+        session = PortSession(self, port, serial_port, ring_size=ring_size, on_data=on_data, recorder=recorder)
+        try:
+            session.fd = serial_port.fileno()
+        except (AttributeError, OSError, ValueError):
+            session.fd = None
+        with self._lock:
+            self.sessions[port] = session
+            if session.fd is not None:
+                self._selector.register(session.fd, selectors.EVENT_READ, session)
+            else:
+                self._polled.append(session)
+        self._wake()
+        return session
+
+    def open_all(self, baudrate=9600, match=None, **kwargs):
+        '''打开 comports() 列出来的所有串口，match 是过滤的函数，参数是 ListPortInfo'''
+        import serial.tools.list_ports
+        result = []
+        for info in serial.tools.list_ports.comports():
+            if match is not None and not match(info):
+                continue
+            try:
+                result.append(self.open(info.device, baudrate=baudrate, **kwargs))
+            except serial.SerialException:
+                continue
+        return result
+
+    def close(self, port):
+        with self._lock:
+            session = self.sessions.pop(port, None)
+            if session is None:
+                return
+            if session.fd is not None:
+                try:
+                    self._selector.unregister(session.fd)
+                except (KeyError, ValueError):
+                    pass
+            elif session in self._polled:
+                self._polled.remove(session)
+        session.serial.close()
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\x00')
+        except OSError:
+            pass
+
+    def start(self):
+        self._stop = False
+        self._thread = threading.Thread(target=self.run, name='SessionManager', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, close_ports=True):
+        self._stop = True
+        self._wake()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join(1.0)
+        if close_ports:
+            for port in list(self.sessions):
+                self.close(port)
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def run(self):
+        # IO循环
+        read = os.read
+        size = self.read_size
+        while not self._stop:
+            timeout = POLL_INTERVAL if self._polled else None
+            events = self._selector.select(timeout)
+            self.loop_count += 1
+            for key, _ in events:
+                session = key.data
+                if session is None:
+                    try:
+                        read(self._wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    data = read(session.fd, size)
+                except BlockingIOError:
+                    continue
+                except OSError as err:
+                    self._fail(session, err)
+                    continue
+                if data:
+                    session._received(data)
+                else:
+                    # 读到0个字节表示设备已经没有了
+                    self._fail(session, serial.SerialException('设备已经断开'))
+            for session in list(self._polled):
+                try:
+                    waiting = session.serial.in_waiting
+                    if waiting:
+                        session._received(session.serial.read(min(waiting, size)))
+                except Exception as err:
+                    self._fail(session, err)
+
+    def _fail(self, session, err):
+        # 出错的串口从循环里边去掉，通知使用者
+        session.error = err
+        with self._lock:
+            if session.fd is not None:
+                try:
+                    self._selector.unregister(session.fd)
+                except (KeyError, ValueError):
+                    pass
+            elif session in self._polled:
+                self._polled.remove(session)
+        if session.on_data is not None:
+            session.on_data(session)
+
+    def stats(self) -> dict:
+        return {port: session.stats() for port, session in list(self.sessions.items())}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _benchmark(ports=32, baudrate=115200, seconds=3.0):
+    # 用pty模拟很多个串口，每个都按照波特率满速发送，看一个线程能不能全部收下来
+    masters = []
+    manager = SessionManager()
+    received = {}
+    for i in range(ports):
+        master, slave = os.openpty()
+        masters.append(master)
+        name = os.ttyname(slave)
+        session = manager.open(name, baudrate=baudrate)
+        os.close(slave) # pyserial 自己又打开了一次
+        received[name] = 0
+    manager.start()
+    rate = baudrate / 10
+    chunk = bytes(range(256)) * 4
+    sent = [0] * ports
+    cpu = time.process_time()
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        target = (time.perf_counter() - start) * rate
+        for i, master in enumerate(masters):
+            while sent[i] < target:
+                sent[i] += os.write(master, chunk)
+        for session in list(manager.sessions.values()):
+            received[session.port] += len(session.read())
+        time.sleep(0.005)
+    time.sleep(0.2)
+    for session in list(manager.sessions.values()):
+        received[session.port] += len(session.read())
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    stats = manager.stats()
+    dropped = sum(s['dropped'] for s in stats.values())
+    total_sent = sum(sent)
+    total_received = sum(received.values())
+    print('{} 个串口 @ {}：发送 {} 字节，接收 {} 字节，丢弃 {}，总速率 {:.0f} 字节/秒，CPU {:.0f}%，IO循环 {} 次'.format(
+        ports, baudrate, total_sent, total_received, dropped, total_received / elapsed,
+        cpu / elapsed * 100, manager.loop_count))
+    manager.stop()
+    for master in masters:
+        os.close(master)
+    return total_sent == total_received and dropped == 0
+
+
+if __name__ == '__main__':
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    assert _benchmark(n)
@@ -0,0 +1,130 @@
+# 统计用的直方图
+# 记录时间（秒），按照微秒分桶：小于32微秒每个微秒一个桶，再往上每翻一倍分成16个桶，
+# 相对误差不超过 1/16，桶的数量很少（100秒也只有400多个），记录一次就是算下标加一。
+
+from array import array
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS # 每翻一倍分成的桶数
+
+
+def _index(n):
+    if n < 2 * SUB_BUCKETS:
+        return n
+    shift = n.bit_length() - SUB_BITS - 1
+    return SUB_BUCKETS * shift + (n >> shift)
+
+
+def _lower(index):
+    # 桶的下限
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+
+
+class Histogram:
+    '''时间的直方图，record() 的参数是秒'''
+    def __init__(self, max_value=100.0, unit=1e-6) -> None:
+        self.unit = unit
+        self.max_value = max_value
+        self.buckets = array('Q', bytes(8 * (_index(int(max_value / unit)) + 1)))
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.buckets)):
+            self.buckets[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        n = int(value / self.unit)
+        index = _index(n) if n > 0 else 0
+        if index >= len(self.buckets):
+            index = len(self.buckets) - 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        '''把另一个直方图加进来，两个直方图的参数必须一样'''
+        for i, n in enumerate(other.buckets):
+            if n:
+                self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        '''p 是 0 到 100，返回桶的中间值（秒）'''
+        if not self.count:
+            return 0.0
+        target = max(1, int(self.count * p / 100 + 0.5))
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                value = (_lower(index) + _lower(index + 1)) / 2 * self.unit
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'min': self.min or 0.0,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max or 0.0,
+        }
+
+    def format(self, scale=1000, unit='ms') -> str:
+        s = self.summary()
+        return '{} 次，最小 {:.3f}，平均 {:.3f}，p50 {:.3f}，p90 {:.3f}，p99 {:.3f}，p99.9 {:.3f}，最大 {:.3f} {}'.format(
+            s['count'], s['min'] * scale, s['mean'] * scale, s['p50'] * scale, s['p90'] * scale,
+            s['p99'] * scale, s['p999'] * scale, s['max'] * scale, unit)
+
+    def items(self) -> list:
+        '''有数据的桶，[(下限, 上限, 次数)]，单位是秒'''
+        return [(_lower(i) * self.unit, _lower(i + 1) * self.unit, n) for i, n in enumerate(self.buckets) if n]
+
+    def bars(self, width=40, scale=1000, unit='ms') -> list:
+        '''用文本画直方图，只画有数据的桶'''
+        used = self.items()
+        if not used:
+            return []
+        peak = max(n for _, _, n in used)
+        return ['{:>10.3f} {} {:>8} {}'.format(lower * scale, unit, n, '#' * max(1, n * width // peak))
+                for lower, _, n in used]
+
+
+if __name__ == '__main__':
+    import random
+    import time
+    rnd = random.Random(0)
+    h = Histogram()
+    values = [rnd.expovariate(1000) for _ in range(200000)]
+    t = time.perf_counter()
+    for v in values:
+        h.record(v)
+    t = time.perf_counter() - t
+    values.sort()
+    for p in (50, 90, 99, 99.9):
+        exact = values[int(len(values) * p / 100) - 1]
+        assert abs(h.percentile(p) - exact) <= exact / SUB_BUCKETS + h.unit, (p, h.percentile(p), exact)
+    print(h.format())
+    print('记录一次 {:.2f} 微秒'.format(t / len(values) * 1e6))
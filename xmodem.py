@@ -0,0 +1,436 @@
+# XMODEM 和 YMODEM 文件传输，用来给 bootloader 烧写固件
+#   XMODEM：128 字节一块，'C' 开始是 CRC16，NAK 开始是校验和；XMODEM-1K 是 1024 字节一块
+#   YMODEM：批量发送，第 0 块是文件名和大小，文件的内容按照 XMODEM-1K 发送，最后一个空的第 0 块表示结束
+#   YMODEM-G：接收的一方发 'G' 开始，发送的一方不再等待每一块的应答，连续发送，出错只能整个取消
+# XMODEM 是停等协议，每一块都要等对方的 ACK，线路的利用率受往返时间限制；要流式发送用 YMODEM-G 或者 ZMODEM。
+# CRC16 是 CRC-16/XMODEM（多项式 0x1021，初始值 0），binascii.crc_hqx 就是这个算法，C 语言查表实现，
+# 比 Python 里边查表快得多，所以这里不再另外生成表。
+
+import binascii
+import os
+import time
+
+from file_sender import Transfer, TransferError, TransferCancelled
+
+SOH = 0x01 # 128 字节的块
+STX = 0x02 # 1024 字节的块
+EOT = 0x04
+ACK = 0x06
+NAK = 0x15
+CAN = 0x18
+SUB = 0x1a # 最后一块不满的时候补齐
+CRC_START = 0x43    # 'C'
+STREAM_START = 0x47 # 'G'
+
+# 取消：连续的 CAN，再用退格把对方终端上显示的删掉
+CANCEL_SEQUENCE = bytes([CAN] * 8 + [0x08] * 8)
+
+START_TIMEOUT = 60.0 # 发送的一方等待对方开始的时间，秒
+START_INTERVAL = 3.0 # 接收的一方每隔多久重发一次开始的字符
+BLOCK_TIMEOUT = 10.0 # 等待应答或者下一块的时间
+CHAR_TIMEOUT = 1.0   # 一块里边字符之间的超时
+MAX_RETRIES = 10
+
+
+def crc16(data, crc=0) -> int:
+    '''CRC-16/XMODEM'''
+    return binascii.crc_hqx(data, crc)
+
+
+def make_block(seq, data, size, pad=SUB, crc=True) -> bytes:
+    '''生成一块，data 不满 size 的时候用 pad 补齐'''
+    if len(data) < size:
+        data = bytes(data) + bytes([pad]) * (size - len(data))
+    seq &= 0xff
+    head = bytes((SOH if size == 128 else STX, seq, 0xff - seq))
+    tail = crc16(data).to_bytes(2, 'big') if crc else bytes((sum(data) & 0xff,))
+    return head + bytes(data) + tail
+
+
+def ymodem_header(name, size, mtime=0, mode=0) -> bytes:
+    '''YMODEM 第 0 块的内容：文件名、大小、修改时间（八进制）、权限（八进制）'''
+    info = '{} {:o} {:o}'.format(size, int(mtime), mode).encode('ascii')
+    return name.encode('utf-8') + b'\0' + info + b'\0'
+
+
+def parse_ymodem_header(data):
+    '''返回 (文件名, 大小, 修改时间)，文件名是空的表示批量传输结束'''
+    name, _, rest = bytes(data).partition(b'\0')
+    if not name:
+        return '', 0, 0
+    fields = rest.split(b'\0', 1)[0].split()
+    size = int(fields[0]) if fields else 0
+    mtime = int(fields[1], 8) if len(fields) > 1 else 0
+    return name.decode('utf-8', 'replace'), size, mtime
+
+
+class ModemSender(Transfer):
+    '''XMODEM/YMODEM 发送的公共部分'''
+    def __init__(self, session, block_size=1024, char_time=None) -> None:
+        super().__init__(session, char_time)
+        if block_size not in (128, 1024):
+            raise ValueError('每块只能是 128 或者 1024 字节')
+        self.block_size = block_size
+        self.crc = True
+        self.streaming = False # 对方发的是 'G'
+
+    def _wait_start(self):
+        # 等待对方的 'C'、'G' 或者 NAK，其他的字节（比如上一块的 ACK）忽略
+        channel = self.channel
+        deadline = time.perf_counter() + START_TIMEOUT
+        last = None
+        while True:
+            c = channel.read_byte(max(0.0, deadline - time.perf_counter()))
+            if c is None:
+                raise TransferError('对方没有开始接收')
+            if c == CRC_START or c == STREAM_START or c == NAK:
+                self.crc = c != NAK
+                self.streaming = c == STREAM_START
+                return
+            if c == CAN and last == CAN:
+                raise TransferError('对方取消')
+            last = c
+
+    def _wait_reply(self):
+        # 等待 ACK 或者 NAK，超时返回 None
+        channel = self.channel
+        deadline = time.perf_counter() + BLOCK_TIMEOUT
+        last = None
+        while True:
+            c = channel.read_byte(max(0.0, deadline - time.perf_counter()))
+            if c is None or c == ACK or c == NAK:
+                return c
+            if c == CAN and last == CAN:
+                raise TransferError('对方取消')
+            last = c
+
+    def _send_block(self, block):
+        channel = self.channel
+        if self.streaming:
+            channel.write(block)
+            if channel.available():
+                # 连续发送的时候对方只会发 CAN
+                data = channel.read_some(0)
+                if data.count(CAN) >= 2:
+                    raise TransferError('对方取消')
+            return
+        for _ in range(MAX_RETRIES):
+            channel.write(block)
+            if self._wait_reply() == ACK:
+                return
+            self.retries += 1
+        raise TransferError('重试次数太多')
+
+    def _send_data(self, f, seq=1):
+        # 文件的内容从第 seq 块开始发送，最后剩下不超过 128 字节的时候用短块，少发一些补齐的字节
+        buf = bytearray(self.block_size)
+        view = memoryview(buf)
+        while True:
+            if self.cancelled:
+                raise TransferCancelled('取消')
+            n = f.readinto(buf)
+            if not n:
+                break
+            size = 128 if n <= 128 else self.block_size
+            self._send_block(make_block(seq, view[:n], size, crc=self.crc))
+            self.transferred += n
+            seq += 1
+        view.release()
+
+    def _send_eot(self):
+        # YMODEM 的接收方第一次会回 NAK，再发一次
+        for _ in range(MAX_RETRIES):
+            self.channel.write(bytes((EOT,)))
+            if self._wait_reply() == ACK:
+                return
+        raise TransferError('对方没有确认结束')
+
+    def abort(self):
+        self.channel.write(CANCEL_SEQUENCE)
+
+
+class XmodemSender(ModemSender):
+    '''XMODEM 发送一个文件，block_size 是 128（XMODEM）或者 1024（XMODEM-1K）'''
+    def __init__(self, session, path, block_size=128, char_time=None) -> None:
+        super().__init__(session, block_size, char_time)
+        self.path = path
+        self.file_name = os.path.basename(path)
+        self.total = os.path.getsize(path)
+
+    def transfer(self):
+        self._wait_start()
+        with open(self.path, 'rb') as f:
+            self._send_data(f)
+        self._send_eot()
+        self.files.append(self.path)
+
+
+class YmodemSender(ModemSender):
+    '''YMODEM 批量发送，对方发 'G' 的时候按照 YMODEM-G 连续发送'''
+    def __init__(self, session, paths, char_time=None) -> None:
+        super().__init__(session, 1024, char_time)
+        self.paths = list(paths)
+        self.total = sum(os.path.getsize(path) for path in self.paths)
+
+    def transfer(self):
+        for path in self.paths:
+            self.file_name = os.path.basename(path)
+            st = os.stat(path)
+            header = ymodem_header(self.file_name, st.st_size, st.st_mtime, st.st_mode & 0o7777)
+            self._wait_start()
+            self._send_block(make_block(0, header, 128 if len(header) <= 128 else 1024, pad=0, crc=self.crc))
+            self._wait_start()
+            with open(path, 'rb') as f:
+                self._send_data(f)
+            self._send_eot()
+            self.files.append(path)
+        # 空的第 0 块表示结束
+        self._wait_start()
+        self._send_block(make_block(0, b'', 128, pad=0, crc=self.crc))
+        self.channel.flush()
+
+
+class ModemReceiver(Transfer):
+    '''XMODEM/YMODEM 接收的公共部分'''
+    def __init__(self, session, crc=True, streaming=False, char_time=None) -> None:
+        super().__init__(session, char_time)
+        self.crc = crc or streaming
+        self.streaming = streaming
+
+    def _start_char(self):
+        if self.streaming:
+            return STREAM_START
+        return CRC_START if self.crc else NAK
+
+    def _read_block(self, timeout):
+        # 返回 (序号, 数据)，EOT 返回 (None, None)，超时返回 None，校验错误返回 (-1, None)
+        channel = self.channel
+        deadline = time.perf_counter() + timeout
+        last = None
+        while True:
+            c = channel.read_byte(max(0.0, deadline - time.perf_counter()))
+            if c is None:
+                return None
+            if c == EOT:
+                return None, None
+            if c == SOH or c == STX:
+                break
+            if c == CAN and last == CAN:
+                raise TransferError('对方取消')
+            last = c
+        size = 128 if c == SOH else 1024
+        need = 2 + size + (2 if self.crc else 1)
+        packet = channel.read(need, CHAR_TIMEOUT + need * self.char_time)
+        if len(packet) < need or packet[0] != 0xff - packet[1]:
+            return -1, None
+        data = packet[2:2 + size]
+        if self.crc:
+            ok = crc16(data) == int.from_bytes(packet[-2:], 'big')
+        else:
+            ok = sum(data) & 0xff == packet[-1]
+        if not ok:
+            return -1, None
+        return packet[0], data
+
+    def _bad_block(self):
+        # 校验错误：连续发送的时候不能重发，只能取消；否则等线路安静以后 NAK
+        self.retries += 1
+        if self.streaming:
+            raise TransferError('数据错误')
+        if self.retries > MAX_RETRIES * 10:
+            raise TransferError('错误太多')
+        self.channel.purge(CHAR_TIMEOUT)
+        self.channel.write(bytes((NAK,)))
+
+    def _start(self, fallback=False):
+        # 发送开始的字符，直到对方发来第一块；fallback 表示对方不回应 'C' 的时候改成校验和
+        channel = self.channel
+        for attempt in range(int(START_TIMEOUT / START_INTERVAL)):
+            if fallback and attempt == MAX_RETRIES // 2 and not self.streaming:
+                self.crc = False
+            channel.write(bytes((self._start_char(),)))
+            block = self._read_block(START_INTERVAL)
+            if block is not None:
+                return block
+        raise TransferError('对方没有开始发送')
+
+    def _receive_data(self, f, size=None, ymodem=False, fallback=False):
+        # 接收文件的内容写到 f，size 是文件的大小（YMODEM），最后一块多出来的补齐的字节丢掉
+        channel = self.channel
+        seq = 1
+        written = 0
+        eot = 0
+        block = self._start(fallback)
+        while True:
+            if block is None:
+                self._bad_block()
+            else:
+                number, data = block
+                if number is None:
+                    # YMODEM 第一次 EOT 回 NAK，确认对方真的结束了
+                    eot += 1
+                    if ymodem and eot == 1 and not self.streaming:
+                        channel.write(bytes((NAK,)))
+                    else:
+                        channel.write(bytes((ACK,)))
+                        return written
+                elif number < 0:
+                    self._bad_block()
+                elif number == seq & 0xff:
+                    if size is not None:
+                        data = data[:size - written]
+                    f.write(data)
+                    written += len(data)
+                    self.transferred += len(data)
+                    seq += 1
+                    if not self.streaming:
+                        channel.write(bytes((ACK,)))
+                elif number == (seq - 1) & 0xff:
+                    channel.write(bytes((ACK,))) # 对方没有收到上次的 ACK，重发了
+                else:
+                    raise TransferError('块的序号不对：{}，应该是 {}'.format(number, seq & 0xff))
+            block = self._read_block(BLOCK_TIMEOUT)
+
+    def abort(self):
+        self.channel.write(CANCEL_SEQUENCE)
+
+
+class XmodemReceiver(ModemReceiver):
+    '''XMODEM 接收一个文件保存到 path，XMODEM 不知道文件的大小，最后一块补齐的 SUB 会保留'''
+    def __init__(self, session, path, crc=True, char_time=None) -> None:
+        super().__init__(session, crc, False, char_time)
+        self.path = path
+        self.file_name = os.path.basename(path)
+
+    def transfer(self):
+        with open(self.path, 'wb') as f:
+            self._receive_data(f, fallback=self.crc)
+        self.files.append(self.path)
+
+
+class YmodemReceiver(ModemReceiver):
+    '''YMODEM 批量接收，文件保存到 directory，streaming 表示用 YMODEM-G'''
+    def __init__(self, session, directory, streaming=False, char_time=None) -> None:
+        super().__init__(session, True, streaming, char_time)
+        self.directory = directory
+
+    def _receive_header(self):
+        # 接收第 0 块，返回 (文件名, 大小, 修改时间)
+        block = self._start()
+        while True:
+            if block is not None and block[0] == 0:
+                self.channel.write(bytes((ACK,)))
+                return parse_ymodem_header(block[1])
+            if block is not None and block[0] is None:
+                self.channel.write(bytes((ACK,))) # 上一个文件重复的 EOT
+            else:
+                self._bad_block()
+            block = self._read_block(BLOCK_TIMEOUT)
+
+    def transfer(self):
+        while True:
+            name, size, mtime = self._receive_header()
+            if not name:
+                break
+            # 只用文件名，不能写到目录的外边
+            path = os.path.join(self.directory, os.path.basename(name.replace('\\', '/')))
+            self.file_name = os.path.basename(path)
+            self.total = self.transferred + size
+            with open(path, 'wb') as f:
+                self._receive_data(f, size, ymodem=True)
+            if mtime:
+                os.utime(path, (mtime, mtime))
+            self.files.append(path)
+
+
+class PacedPort:
+    '''测试用：按照波特率限制写的速度，模拟真实的串口线路（写完一块要等这块在线路上传完）'''
+    def __init__(self, port, char_time) -> None:
+        self.port = port
+        self.char_time = char_time
+        self._busy_until = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.port.timeout = value
+
+    def write(self, data):
+        start = max(time.perf_counter(), self._busy_until)
+        self._busy_until = start + len(data) * self.char_time
+        wait = self._busy_until - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        return self.port.write(data)
+
+    def flush(self):
+        wait = self._busy_until - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+
+def benchmark_protocols(protocols, size=64 * 1024, baudrate=115200, files=1):
+    '''在 pty 上用每种协议传输 files 个随机文件，返回 [(协议, 字节/秒, 线路利用率)]'''
+    import tempfile
+    import serial
+    from file_sender import make_sender, make_receiver
+    from modbus_slave import PtyPort
+    from serial_session import char_time
+    ct = char_time(baudrate)
+    work = tempfile.mkdtemp()
+    paths = []
+    for i in range(files):
+        paths.append(os.path.join(work, 'firmware{}.bin'.format(i)))
+        with open(paths[-1], 'wb') as f:
+            f.write(os.urandom(size))
+    results = []
+    for protocol in protocols:
+        master, slave = os.openpty()
+        out = os.path.join(work, protocol)
+        os.mkdir(out)
+        # 两头都按照波特率限速
+        sender_port = PacedPort(serial.Serial(os.ttyname(slave), baudrate), ct)
+        receiver_port = PacedPort(PtyPort(master), ct)
+        target = os.path.join(out, os.path.basename(paths[0])) if protocol.startswith('xmodem') else out
+        receiver = make_receiver(protocol, receiver_port, target, char_time=ct)
+        sender = make_sender(protocol, sender_port, paths if files > 1 else paths[:1], char_time=ct)
+        receiver.start()
+        sender.start()
+        sender.join()
+        receiver.join(30)
+        sender_port.port.close()
+        receiver_port.port.close()
+        assert sender.error is None, (protocol, sender.error)
+        assert receiver.error is None, (protocol, receiver.error)
+        for path in sender.files:
+            with open(path, 'rb') as f, open(os.path.join(out, os.path.basename(path)), 'rb') as g:
+                sent, got = f.read(), g.read()
+            if protocol.startswith('xmodem'):
+                # XMODEM 最后一块补齐的 SUB 留在文件里边
+                assert not got[len(sent):].strip(bytes((SUB,))), protocol
+                got = got[:len(sent)]
+            assert sent == got, protocol
+        elapsed = sender.elapsed()
+        rate = sender.transferred / elapsed
+        results.append((protocol, rate, rate * ct))
+    return results
+
+
+def _self_test():
+    block = make_block(1, b'abc', 128)
+    assert len(block) == 133 and block[:3] == b'\x01\x01\xfe' and block[3:6] == b'abc' and block[6] == SUB
+    assert crc16(b'123456789') == 0x31c3 # CRC-16/XMODEM 的校验值
+    assert parse_ymodem_header(ymodem_header('a.bin', 1234, 0o1234, 0o644)) == ('a.bin', 1234, 0o1234)
+    assert parse_ymodem_header(bytes(128)) == ('', 0, 0)
+
+
+if __name__ == '__main__':
+    _self_test()
+    for protocol, rate, usage in benchmark_protocols(('xmodem', 'xmodem-1k', 'ymodem', 'ymodem-g'), files=2):
+        print('{:<10} {:>8.0f} 字节/秒，线路利用率 {:.0%}'.format(protocol, rate, usage))
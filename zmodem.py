@@ -0,0 +1,598 @@
+# ZMODEM 文件传输
+# 发送的一方不等每一块的应答，连续发送数据子包（ZCRCG），出错的时候接收的一方发 ZRPOS，
+# 发送的一方从那个位置重新发送，所以线路一直是满的，往返时间不影响速度。
+# 接收的一方在 ZRINIT 里边给了缓冲区的大小、或者设置了 window 的时候，每 window 个字节用 ZCRCW 结束一帧，
+# 等 ZACK 以后再发下一帧（分段的流式发送）。
+# 校验：对方支持的时候用 CRC32（zlib.crc32），否则用 CRC16（binascii.crc_hqx），都是 C 语言查表实现。
+# 转义：ZDLE 和 XON/XOFF（以及最高位是1的 XON/XOFF、DLE）转义成 ZDLE + (c ^ 0x40)，
+# 这些字节很少，每个字节值用一次 bytes.replace() 处理整个子包，不逐个字节循环；
+# 接收的时候用 find() 找 ZDLE，两个 ZDLE 之间的数据整段复制。
+# 只实现文件传输需要的部分：不支持 ZCOMMAND、压缩、加密、断点续传。
+
+import binascii
+import os
+import time
+import zlib
+
+from file_sender import Transfer, TransferError, TransferCancelled
+from xmodem import CANCEL_SEQUENCE, crc16, parse_ymodem_header
+
+ZPAD = 0x2a   # '*'
+ZDLE = 0x18
+ZBIN = 0x41   # 'A' 二进制帧头，CRC16
+ZHEX = 0x42   # 'B' 十六进制帧头
+ZBIN32 = 0x43 # 'C' 二进制帧头，CRC32
+XON = 0x11
+
+# 帧的类型
+ZRQINIT = 0
+ZRINIT = 1
+ZSINIT = 2
+ZACK = 3
+ZFILE = 4
+ZSKIP = 5
+ZNAK = 6
+ZABORT = 7
+ZFIN = 8
+ZRPOS = 9
+ZDATA = 10
+ZEOF = 11
+ZFERR = 12
+ZCRC = 13
+ZCHALLENGE = 14
+ZCOMPL = 15
+ZCAN = 16
+ZFREECNT = 17
+ZCOMMAND = 18
+
+# 数据子包的结尾
+ZCRCE = 0x68 # 'h' 帧结束，不需要应答
+ZCRCG = 0x69 # 'i' 帧继续，不需要应答
+ZCRCQ = 0x6a # 'j' 帧继续，需要 ZACK
+ZCRCW = 0x6b # 'k' 帧结束，需要 ZACK
+ZRUB0 = 0x6c # 'l' 0x7f
+ZRUB1 = 0x6d # 'm' 0xff
+
+# ZRINIT 的能力（ZF0）
+CANFDX = 0x01  # 全双工
+CANOVIO = 0x02 # 可以一边写文件一边接收
+CANBRK = 0x04
+CANFC32 = 0x20 # 支持 CRC32
+ESCCTL = 0x40  # 要求转义全部控制字符
+ESC8 = 0x80
+
+BLOCK_SIZE = 1024     # 每个数据子包的字节数
+MAX_SUBPACKET = 8192  # 接收的时候一个子包最多的字节数
+HEADER_TIMEOUT = 10.0 # 等待帧头的时间，秒
+MAX_ERRORS = 10
+
+_FLOW_CHARACTERS = bytes((0x11, 0x13, 0x91, 0x93)) # 线路上没有转义的 XON/XOFF 是流控，丢掉
+_ESCAPED = (0x10, 0x11, 0x13, 0x90, 0x91, 0x93)
+_CONTROL = tuple(c for c in range(256) if not c & 0x60 and c != ZDLE)
+
+
+class _Timeout(Exception):
+    pass
+
+
+class _BadData(Exception):
+    pass
+
+
+def zdle_escape(data, escape_control=False) -> bytes:
+    '''转义，escape_control 表示全部控制字符都转义'''
+    data = bytes(data).replace(b'\x18', b'\x18\x58')
+    for c in _CONTROL if escape_control else _ESCAPED:
+        if c in data:
+            data = data.replace(bytes((c,)), bytes((ZDLE, c ^ 0x40)))
+    return data
+
+
+def position(data) -> int:
+    '''帧头里边的位置，小端'''
+    return int.from_bytes(data, 'little')
+
+
+def position_bytes(pos) -> bytes:
+    return (pos & 0xffffffff).to_bytes(4, 'little')
+
+
+def hex_header(frame_type, data=bytes(4)) -> bytes:
+    '''十六进制的帧头，接收的一方发送的帧头都用这种'''
+    header = bytes((frame_type,)) + data
+    out = b'**\x18B' + binascii.hexlify(header + crc16(header).to_bytes(2, 'big')) + b'\r\x8a'
+    if frame_type not in (ZFIN, ZACK):
+        out += bytes((XON,))
+    return out
+
+
+def bin_header(frame_type, data=bytes(4), crc32=True, escape_control=False) -> bytes:
+    '''二进制的帧头'''
+    header = bytes((frame_type,)) + data
+    if crc32:
+        return bytes((ZPAD, ZDLE, ZBIN32)) + zdle_escape(header + zlib.crc32(header).to_bytes(4, 'little'), escape_control)
+    return bytes((ZPAD, ZDLE, ZBIN)) + zdle_escape(header + crc16(header).to_bytes(2, 'big'), escape_control)
+
+
+def subpacket(data, end, crc32=True, escape_control=False) -> bytes:
+    '''数据子包：转义以后的数据、ZDLE、结尾、校验（包括结尾的字节）'''
+    tail = bytes((end,))
+    if crc32:
+        crc = zlib.crc32(tail, zlib.crc32(data)).to_bytes(4, 'little')
+    else:
+        crc = crc16(tail, crc16(data)).to_bytes(2, 'big')
+    out = zdle_escape(data, escape_control) + bytes((ZDLE, end)) + zdle_escape(crc, escape_control)
+    if end == ZCRCW:
+        out += bytes((XON,))
+    return out
+
+
+class _Reader:
+    '''从 Channel 读取帧头和数据子包'''
+    def __init__(self, channel) -> None:
+        self.channel = channel
+        self.buf = bytearray()
+        self.pos = 0
+
+    def _fill(self, timeout) -> bool:
+        data = self.channel.read_some(max(0.0, timeout))
+        if not data:
+            return False
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += data.translate(None, _FLOW_CHARACTERS)
+        return True
+
+    def _byte(self, deadline) -> int:
+        while self.pos >= len(self.buf):
+            if not self._fill(deadline - time.perf_counter()):
+                raise _Timeout()
+        c = self.buf[self.pos]
+        self.pos += 1
+        return c
+
+    def _escaped_byte(self, deadline) -> int:
+        c = self._byte(deadline)
+        if c != ZDLE:
+            return c
+        return self._unescape(self._byte(deadline))
+
+    def _unescape(self, c):
+        if c == ZRUB0:
+            return 0x7f
+        if c == ZRUB1:
+            return 0xff
+        if c == ZDLE:
+            raise TransferError('对方取消')
+        if c & 0x60 == 0x40:
+            return c ^ 0x40
+        raise _BadData()
+
+    def pending_header(self) -> bool:
+        '''不等待，收到的数据里边有没有帧头的开始，没有的话丢掉'''
+        self._fill(0)
+        if self.buf.find(ZPAD, self.pos) < 0:
+            if self.buf.count(ZDLE, self.pos) >= 5:
+                raise TransferError('对方取消')
+            self.pos = len(self.buf)
+            return False
+        return True
+
+    def read_header(self, timeout):
+        '''返回 (类型, 4个字节, 帧头的格式)'''
+        deadline = time.perf_counter() + timeout
+        cans = 0
+        while True:
+            c = self._byte(deadline)
+            if c == ZDLE:
+                cans += 1
+                if cans >= 5:
+                    raise TransferError('对方取消')
+                continue
+            cans = 0
+            if c != ZPAD:
+                continue
+            while c == ZPAD:
+                c = self._byte(deadline)
+            if c != ZDLE:
+                continue
+            kind = self._byte(deadline)
+            if kind == ZHEX:
+                return self._hex_header(deadline)
+            if kind in (ZBIN, ZBIN32):
+                return self._bin_header(deadline, kind)
+
+    def _hex_header(self, deadline):
+        digits = bytes(self._byte(deadline) for _ in range(14))
+        try:
+            header = binascii.unhexlify(digits)
+        except binascii.Error:
+            raise _BadData()
+        if crc16(header[:5]) != int.from_bytes(header[5:], 'big'):
+            raise _BadData()
+        # 后边的 CR LF 收到了就丢掉，不等待
+        for _ in range(2):
+            if self.pos >= len(self.buf):
+                self._fill(0)
+            if self.pos < len(self.buf) and self.buf[self.pos] & 0x7f in (0x0d, 0x0a):
+                self.pos += 1
+        return header[0], header[1:5], ZHEX
+
+    def _bin_header(self, deadline, kind):
+        size = 5 + (4 if kind == ZBIN32 else 2)
+        header = bytes(self._escaped_byte(deadline) for _ in range(size))
+        if kind == ZBIN32:
+            ok = zlib.crc32(header[:5]) == int.from_bytes(header[5:], 'little')
+        else:
+            ok = crc16(header[:5]) == int.from_bytes(header[5:], 'big')
+        if not ok:
+            raise _BadData()
+        return header[0], header[1:5], kind
+
+    def read_subpacket(self, crc32, timeout):
+        '''返回 (数据, 结尾)'''
+        deadline = time.perf_counter() + timeout
+        out = bytearray()
+        while True:
+            buf = self.buf
+            index = buf.find(ZDLE, self.pos)
+            if index < 0:
+                out += buf[self.pos:]
+                self.pos = len(buf)
+                if len(out) > MAX_SUBPACKET:
+                    raise _BadData()
+                if not self._fill(deadline - time.perf_counter()):
+                    raise _Timeout()
+                continue
+            out += buf[self.pos:index]
+            self.pos = index + 1
+            c = self._byte(deadline)
+            if ZCRCE <= c <= ZCRCW:
+                size = 4 if crc32 else 2
+                crc = bytes(self._escaped_byte(deadline) for _ in range(size))
+                tail = bytes((c,))
+                if crc32:
+                    ok = zlib.crc32(tail, zlib.crc32(out)) == int.from_bytes(crc, 'little')
+                else:
+                    ok = crc16(tail, crc16(out)) == int.from_bytes(crc, 'big')
+                if not ok:
+                    raise _BadData()
+                return bytes(out), c
+            out.append(self._unescape(c))
+
+
+class ZmodemSender(Transfer):
+    '''ZMODEM 批量发送，window 是每多少个字节等一次应答，0 表示一直连续发送（对方要求的时候按照对方的缓冲区大小）'''
+    def __init__(self, session, paths, block_size=BLOCK_SIZE, window=0, char_time=None) -> None:
+        super().__init__(session, char_time)
+        self.paths = list(paths)
+        self.total = sum(os.path.getsize(path) for path in self.paths)
+        self.block_size = block_size
+        self.window = window
+        self.reader = _Reader(self.channel)
+        # 对方的能力，收到 ZRINIT 以后设置
+        self.crc32 = False
+        self.escape_control = False
+        self.segment = 0 # 每多少个字节用 ZCRCW 等应答
+
+    def _write_header(self, frame_type, data=bytes(4)):
+        self.channel.write(bin_header(frame_type, data, self.crc32, self.escape_control))
+
+    def _read_header(self, timeout=HEADER_TIMEOUT):
+        # 超时或者校验错误返回 (None, None)
+        try:
+            frame_type, data, _ = self.reader.read_header(timeout)
+            return frame_type, data
+        except (_Timeout, _BadData):
+            self.retries += 1
+            return None, None
+
+    def _get_receiver_init(self):
+        channel = self.channel
+        channel.write(b'rz\r' + hex_header(ZRQINIT))
+        for _ in range(MAX_ERRORS):
+            frame_type, data = self._read_header()
+            if frame_type == ZRINIT:
+                flags = data[3]
+                buffer_size = data[0] | data[1] << 8
+                self.crc32 = bool(flags & CANFC32)
+                self.escape_control = bool(flags & ESCCTL)
+                if not flags & CANOVIO:
+                    buffer_size = buffer_size or self.block_size
+                sizes = [size for size in (buffer_size, self.window) if size]
+                self.segment = min(sizes) if sizes else 0
+                return
+            if frame_type == ZCHALLENGE:
+                channel.write(hex_header(ZACK, data))
+            elif frame_type != ZRQINIT:
+                channel.write(hex_header(ZRQINIT))
+        raise TransferError('对方没有应答')
+
+    def transfer(self):
+        self._get_receiver_init()
+        left = self.total
+        for i, path in enumerate(self.paths):
+            self.file_name = os.path.basename(path)
+            st = os.stat(path)
+            info = '{} {:o} {:o} 0 {} {}'.format(st.st_size, int(st.st_mtime), st.st_mode & 0o7777,
+                                                  len(self.paths) - i, left).encode('ascii')
+            left -= st.st_size
+            base = self.transferred
+            pos = self._send_file_info(self.file_name.encode('utf-8') + b'\0' + info + b'\0', path)
+            if pos is not None:
+                with open(path, 'rb') as f:
+                    self._send_data(f, pos, base)
+                self.files.append(path)
+            self.transferred = base + st.st_size
+        self._finish()
+
+    def _send_file_info(self, info, path):
+        # 返回对方要求开始的位置，对方跳过这个文件的时候返回 None
+        for _ in range(MAX_ERRORS):
+            self._write_header(ZFILE)
+            self.channel.write(subpacket(info, ZCRCW, self.crc32, self.escape_control))
+            timeout = HEADER_TIMEOUT
+            while True:
+                frame_type, data = self._read_header(timeout)
+                if frame_type == ZRPOS:
+                    return position(data)
+                if frame_type == ZSKIP:
+                    return None
+                if frame_type == ZCRC:
+                    # 对方要文件的 CRC，用来判断是不是同一个文件
+                    with open(path, 'rb') as f:
+                        crc = zlib.crc32(f.read(position(data) or None))
+                    self.channel.write(hex_header(ZCRC, position_bytes(crc)))
+                    continue
+                if frame_type == ZRINIT:
+                    # 对方收到 ZRQINIT 的时候又发了一次 ZRINIT，ZRPOS 可能就在后边，等一会儿再重发
+                    timeout = 2.0
+                    continue
+                if frame_type in (None, ZNAK):
+                    break
+        raise TransferError('对方没有接收文件')
+
+    def _send_data(self, f, pos, base):
+        channel = self.channel
+        block_size = self.block_size
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        errors = 0
+        while True:
+            # 从 pos 开始一帧
+            f.seek(pos)
+            self.transferred = base + pos
+            self._write_header(ZDATA, position_bytes(pos))
+            restart = None
+            since_ack = 0
+            while True:
+                if self.cancelled:
+                    raise TransferCancelled('取消')
+                n = f.readinto(buf)
+                since_ack += n
+                if n < block_size:
+                    end = ZCRCE
+                elif self.segment and since_ack >= self.segment:
+                    end = ZCRCW
+                else:
+                    end = ZCRCG
+                channel.write(subpacket(view[:n], end, self.crc32, self.escape_control))
+                pos += n
+                self.transferred = base + pos
+                if end == ZCRCE:
+                    break
+                if end == ZCRCW:
+                    restart = self._wait_ack(pos)
+                    if restart is None:
+                        # ZCRCW 结束了这一帧，接着发下一帧
+                        since_ack = 0
+                        self._write_header(ZDATA, position_bytes(pos))
+                        continue
+                    break
+                if self.reader.pending_header():
+                    frame_type, data = self._read_header()
+                    if frame_type == ZRPOS:
+                        channel.write(subpacket(b'', ZCRCE, self.crc32, self.escape_control))
+                        restart = position(data)
+                        break
+            if restart is None:
+                restart = self._send_eof(pos)
+                if restart is None:
+                    view.release()
+                    return
+            errors += 1
+            self.retries += 1
+            if errors > MAX_ERRORS:
+                raise TransferError('错误太多')
+            pos = restart
+
+    def _wait_ack(self, pos):
+        # 等待 ZCRCW 的 ZACK，对方要求重发的时候返回位置
+        for _ in range(MAX_ERRORS):
+            frame_type, data = self._read_header()
+            if frame_type == ZACK and position(data) == pos:
+                return None
+            if frame_type == ZRPOS:
+                return position(data)
+        raise TransferError('对方没有应答')
+
+    def _send_eof(self, pos):
+        # 对方确认文件结束返回 None，要求重发的时候返回位置
+        for _ in range(MAX_ERRORS):
+            self._write_header(ZEOF, position_bytes(pos))
+            while True:
+                frame_type, data = self._read_header()
+                if frame_type in (ZRINIT, ZSKIP):
+                    return None
+                if frame_type == ZRPOS:
+                    return position(data)
+                if frame_type is None:
+                    break
+        raise TransferError('对方没有确认文件结束')
+
+    def _finish(self):
+        for _ in range(MAX_ERRORS):
+            self.channel.write(hex_header(ZFIN))
+            frame_type, _ = self._read_header()
+            if frame_type == ZFIN:
+                self.channel.write(b'OO')
+                break
+        self.channel.flush()
+
+    def abort(self):
+        self.channel.write(CANCEL_SEQUENCE)
+
+
+class ZmodemReceiver(Transfer):
+    '''ZMODEM 批量接收，文件保存到 directory'''
+    def __init__(self, session, directory, char_time=None) -> None:
+        super().__init__(session, char_time)
+        self.directory = directory
+        self.reader = _Reader(self.channel)
+        self.errors = 0
+
+    def _send_init(self):
+        self.channel.write(hex_header(ZRINIT, bytes((0, 0, 0, CANFDX | CANOVIO | CANFC32))))
+
+    def _error(self):
+        self.errors += 1
+        self.retries += 1
+        if self.errors > MAX_ERRORS:
+            raise TransferError('错误太多')
+
+    def transfer(self):
+        reader = self.reader
+        self._send_init()
+        while True:
+            try:
+                frame_type, data, kind = reader.read_header(HEADER_TIMEOUT)
+            except (_Timeout, _BadData):
+                self._error()
+                self._send_init()
+                continue
+            if frame_type == ZFILE:
+                try:
+                    info, _ = reader.read_subpacket(kind == ZBIN32, HEADER_TIMEOUT)
+                except (_Timeout, _BadData):
+                    self._error()
+                    self.channel.write(hex_header(ZNAK))
+                    continue
+                self._receive_file(info)
+            elif frame_type == ZSINIT:
+                try:
+                    reader.read_subpacket(kind == ZBIN32, HEADER_TIMEOUT)
+                    self.channel.write(hex_header(ZACK))
+                except (_Timeout, _BadData):
+                    self._error()
+                    self.channel.write(hex_header(ZNAK))
+            elif frame_type == ZFIN:
+                self.channel.write(hex_header(ZFIN))
+                self.channel.read(2, 1.0) # 对方最后发的 'OO'
+                return
+            else:
+                self._send_init()
+
+    def _receive_file(self, info):
+        name, size, mtime = parse_ymodem_header(info)
+        # 只用文件名，不能写到目录的外边
+        path = os.path.join(self.directory, os.path.basename(name.replace('\\', '/')))
+        self.file_name = os.path.basename(path)
+        base = self.transferred
+        self.total = base + size
+        reader = self.reader
+        pos = 0
+        with open(path, 'wb') as f:
+            self.channel.write(hex_header(ZRPOS, position_bytes(pos)))
+            while True:
+                try:
+                    frame_type, data, kind = reader.read_header(HEADER_TIMEOUT)
+                except (_Timeout, _BadData):
+                    self._error()
+                    self.channel.write(hex_header(ZRPOS, position_bytes(pos)))
+                    continue
+                if frame_type == ZDATA:
+                    if position(data) != pos:
+                        self._error()
+                        self.channel.write(hex_header(ZRPOS, position_bytes(pos)))
+                        continue
+                    pos = self._receive_frame(f, pos, base, kind == ZBIN32)
+                elif frame_type == ZEOF:
+                    if position(data) == pos:
+                        break
+                elif frame_type == ZFILE:
+                    # 对方没有收到 ZRPOS
+                    try:
+                        reader.read_subpacket(kind == ZBIN32, HEADER_TIMEOUT)
+                    except (_Timeout, _BadData):
+                        pass
+                    self.channel.write(hex_header(ZRPOS, position_bytes(pos)))
+                elif frame_type == ZFIN:
+                    raise TransferError('文件没有传输完')
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        self.files.append(path)
+        self.errors = 0
+        self._send_init()
+
+    def _receive_frame(self, f, pos, base, crc32):
+        # 接收一帧里边的数据子包，返回新的位置
+        reader = self.reader
+        channel = self.channel
+        while True:
+            try:
+                data, end = reader.read_subpacket(crc32, HEADER_TIMEOUT)
+            except (_Timeout, _BadData):
+                # 丢掉这一帧剩下的数据，让对方从 pos 重发
+                self._error()
+                channel.write(hex_header(ZRPOS, position_bytes(pos)))
+                return pos
+            f.write(data)
+            pos += len(data)
+            self.transferred = base + pos
+            if end == ZCRCW or end == ZCRCQ:
+                channel.write(hex_header(ZACK, position_bytes(pos)))
+            if end == ZCRCW or end == ZCRCE:
+                return pos
+
+    def abort(self):
+        self.channel.write(CANCEL_SEQUENCE)
+
+
+class _ChunkChannel:
+    # 测试用，每次返回一段数据
+    def __init__(self, chunks) -> None:
+        self.chunks = list(chunks)
+
+    def read_some(self, timeout):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+def _self_test():
+    data = os.urandom(4096) + bytes(range(256))
+    for crc32 in (True, False):
+        for escape_control in (True, False):
+            packet = subpacket(data, ZCRCG, crc32, escape_control) + hex_header(ZACK, position_bytes(1234))
+            packet += bin_header(ZDATA, position_bytes(5678), crc32, escape_control)
+            # 每次只给几个字节，检查跨越边界的转义
+            reader = _Reader(_ChunkChannel(packet[i:i + 7] for i in range(0, len(packet), 7)))
+            assert reader.read_subpacket(crc32, 1.0) == (data, ZCRCG)
+            assert reader.read_header(1.0) == (ZACK, position_bytes(1234), ZHEX)
+            assert reader.read_header(1.0) == (ZDATA, position_bytes(5678), ZBIN32 if crc32 else ZBIN)
+    escaped = zdle_escape(bytes(range(256)))
+    assert not set(escaped) & set(_ESCAPED)
+    bad = bytearray(subpacket(b'hello', ZCRCE))
+    bad[0] ^= 1
+    reader = _Reader(_ChunkChannel([bytes(bad)]))
+    try:
+        reader.read_subpacket(True, 0.1)
+        raise AssertionError('没有发现校验错误')
+    except _BadData:
+        pass
+
+
+if __name__ == '__main__':
+    from xmodem import benchmark_protocols
+    _self_test()
+    for protocol, rate, usage in benchmark_protocols(('zmodem',), files=2):
+        print('{:<10} {:>8.0f} 字节/秒，线路利用率 {:.0%}'.format(protocol, rate, usage))